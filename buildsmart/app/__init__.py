@@ -3,6 +3,7 @@ from app.extensions import db, migrate, login_manager, bcrypt, cors, socketio, l
 from app.config import config
 from app.utils.security_headers import setup_security_headers
 from app.utils.api_docs import get_swagger_config, get_swagger_template
+from app.utils.geo import register_sqlite_functions
 import os
 
 
@@ -16,6 +17,7 @@ def create_app(config_name=None):
     config[config_name].init_app(app)
     
     # Initialize extensions
+    register_sqlite_functions()
     db.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
@@ -97,6 +99,26 @@ def create_app(config_name=None):
         AnalyticsMetric, ReportSchedule
     )
     
+    # Keep the full-text search index in sync with indexed models
+    from app.services.search_service import register_search_index
+    register_search_index()
+    
+    # Keep the in-memory search suggestion index in sync with the catalog
+    from app.services.suggestion_service import register_suggestion_index
+    register_suggestion_index()
+    
+    # Drop cached category price snapshots when products or shops change
+    from app.ai.cost_estimator import register_price_snapshot_invalidation
+    register_price_snapshot_invalidation()
+    
+    # Invalidate cache tags of changed products, shops, orders, ... on commit
+    from app.services.cache_invalidation import register_cache_invalidation
+    register_cache_invalidation()
+    
+    # Apply order changes to the analytics rollups in the same transaction
+    from app.services.analytics_rollup_service import register_rollup_maintenance
+    register_rollup_maintenance()
+    
     # User loader function for Flask-Login
     @login_manager.user_loader
     def load_user(user_id):
@@ -134,4 +156,10 @@ def create_app(config_name=None):
     # Import and register socketio events
     from app import socketio_events  # This will register the socketio event handlers
     
+    # Precompute hot cache entries so the first requests after a deploy do not all miss;
+    # each worker warms itself once it serves, so CLI commands never start it
+    if app.config.get('CACHE_WARM_ON_STARTUP'):
+        from app.services.cache_warmer import CacheWarmer
+        CacheWarmer.warm_on_first_request(app)
+    
     return app
\ No newline at end of file
@@ -0,0 +1,203 @@
+"""
+Category price snapshots for cost estimation and shop optimization.
+
+The recommender needs, for every material category in a project, the
+cheapest offers overall (to estimate unit prices) and the cheapest offer
+from each shop (to plan which shops to visit). Both come from one bulk
+query ranked with ``ROW_NUMBER()`` window functions and are cached per
+category, so a recommendation costs at most one query. Cached snapshots
+are dropped when products or shops in their category change.
+
+Every such change also invalidates the ``prices`` cache tag, which
+caches of results derived from prices (such as whole recommendations)
+are stored under.
+"""
+from typing import Dict, Iterable, List
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, or_, select
+from sqlalchemy.orm import Session, object_session
+from app.extensions import db
+from app.models import Product, Shop
+from app.services.cache_service import CacheService
+
+# Number of cheapest offers averaged for a category's unit price
+ESTIMATE_SAMPLE_SIZE = 3
+
+PRICE_SNAPSHOT_TIMEOUT = 3600  # 1 hour; snapshots are also invalidated on change
+
+PRODUCT_FIELDS = ('id', 'name', 'category', 'price', 'unit', 'quantity_available', 'shop_id', 'is_available')
+SHOP_FIELDS = ('id', 'name', 'description', 'address', 'phone', 'email', 'latitude', 'longitude',
+               'rating', 'total_reviews', 'is_verified', 'is_active', 'owner_id')
+
+_PENDING_KEY = 'price_snapshot_categories'
+
+# Cache tag of everything derived from product prices and stock
+PRICES_TAG = 'prices'
+
+
+def price_snapshot_key(category: str) -> str:
+    """Get the cache key of a category's price snapshot."""
+    return CacheService.get_cache_key(CacheService.PREFIX_CATEGORY, category, 'prices')
+
+
+def get_category_prices(categories: Iterable[str]) -> Dict[str, Dict]:
+    """
+    Get price snapshots for material categories.
+
+    Each snapshot holds available products from verified shops that are
+    either among the category's ``ESTIMATE_SAMPLE_SIZE`` cheapest
+    (``price_rank``) or the cheapest in their shop (``shop_rank == 1``),
+    cheapest first, plus the shops they belong to.
+
+    Args:
+        categories: Material categories
+
+    Returns:
+        Dictionary mapping category to {'products': [...], 'shops': {id: {...}}}
+    """
+    categories = sorted(set(categories))
+    keys = [price_snapshot_key(category) for category in categories]
+    cached = CacheService.get_many(keys)
+
+    snapshots = {}
+    missing = []
+    for category, snapshot in zip(categories, cached):
+        if snapshot is None:
+            missing.append(category)
+        else:
+            snapshots[category] = snapshot
+
+    if missing:
+        loaded = _load_snapshots(missing)
+        CacheService.set_many(
+            {price_snapshot_key(category): snapshot for category, snapshot in loaded.items()},
+            timeout=PRICE_SNAPSHOT_TIMEOUT
+        )
+        snapshots.update(loaded)
+
+    return snapshots
+
+
+def cheapest_offers(snapshot: Dict, limit: int = ESTIMATE_SAMPLE_SIZE) -> List[Dict]:
+    """Get a category's cheapest products overall."""
+    return [product for product in snapshot['products'] if product['price_rank'] <= limit]
+
+
+def shop_offers(snapshot: Dict) -> List[Dict]:
+    """Get the cheapest product of each shop in a category."""
+    return [product for product in snapshot['products'] if product['shop_rank'] == 1]
+
+
+def _load_snapshots(categories: List[str]) -> Dict[str, Dict]:
+    order = (Product.price, Product.id)
+    ranked = select(
+        *(getattr(Product, field) for field in PRODUCT_FIELDS if field != 'is_available'),
+        *(getattr(Shop, field).label(f'shop_{field}') for field in SHOP_FIELDS if field != 'id'),
+        db.func.row_number().over(partition_by=Product.category, order_by=order).label('price_rank'),
+        db.func.row_number().over(partition_by=(Product.category, Product.shop_id), order_by=order).label('shop_rank'),
+    ).join(Shop, Shop.id == Product.shop_id).where(
+        Product.category.in_(categories),
+        Product.is_available == True,
+        Shop.is_verified == True
+    ).subquery()
+
+    rows = db.session.execute(
+        select(ranked).where(
+            or_(ranked.c.price_rank <= ESTIMATE_SAMPLE_SIZE, ranked.c.shop_rank == 1)
+        ).order_by(ranked.c.category, ranked.c.price_rank)
+    ).mappings()
+
+    snapshots = {category: {'products': [], 'shops': {}} for category in categories}
+    for row in rows:
+        snapshot = snapshots[row['category']]
+        snapshot['products'].append({
+            'id': row['id'],
+            'name': row['name'],
+            'category': row['category'],
+            'price': float(row['price']) if row['price'] is not None else 0.0,
+            'unit': row['unit'],
+            'quantity_available': row['quantity_available'],
+            'shop_id': row['shop_id'],
+            'price_rank': row['price_rank'],
+            'shop_rank': row['shop_rank'],
+        })
+        if row['shop_id'] not in snapshot['shops']:
+            shop = {field: row[f'shop_{field}'] for field in SHOP_FIELDS if field != 'id'}
+            shop['id'] = row['shop_id']
+            for field in ('latitude', 'longitude', 'rating'):
+                if shop[field] is not None:
+                    shop[field] = float(shop[field])
+            snapshot['shops'][row['shop_id']] = shop
+
+    return snapshots
+
+
+def _queue(target, categories: Iterable[str]) -> None:
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(_PENDING_KEY, set()).update(c for c in categories if c)
+
+
+def _product_changed(mapper, connection, target):
+    state = inspect(target)
+    changed = [field for field in PRODUCT_FIELDS if state.attrs[field].history.has_changes()]
+    if changed:
+        _queue(target, [target.category])
+
+
+def _category_set(target, value, oldvalue, initiator):
+    # The category a product moves out of loses an offer too
+    if isinstance(oldvalue, str) and oldvalue != value:
+        _queue(target, [oldvalue])
+
+
+def _product_deleted(mapper, connection, target):
+    _queue(target, [target.category])
+
+
+def _shop_changed(mapper, connection, target):
+    state = inspect(target)
+    if not any(state.attrs[field].history.has_changes() for field in SHOP_FIELDS):
+        return
+    categories = connection.execute(
+        select(Product.category).where(Product.shop_id == target.id).distinct()
+    ).scalars()
+    _queue(target, list(categories))
+
+
+def _invalidate_pending(session):
+    categories = session.info.pop(_PENDING_KEY, None)
+    if categories and has_app_context():
+        try:
+            CacheService.delete_many([price_snapshot_key(category) for category in categories])
+            CacheService.invalidate_tags(PRICES_TAG)
+        except Exception as e:
+            current_app.logger.error(f'Error invalidating price snapshots: {e}')
+
+
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+_registered = False
+
+
+def register_price_snapshot_invalidation() -> None:
+    """
+    Register ORM hooks that drop price snapshots of changed categories.
+
+    Affected categories are collected during flush and invalidated after
+    the transaction commits.
+    """
+    global _registered
+    if _registered:
+        return
+    _registered = True
+
+    event.listen(Product, 'after_insert', _product_changed)
+    event.listen(Product, 'after_update', _product_changed)
+    event.listen(Product, 'after_delete', _product_deleted)
+    event.listen(Product.category, 'set', _category_set, active_history=True)
+    event.listen(Shop, 'after_update', _shop_changed)
+    event.listen(Session, 'after_commit', _invalidate_pending)
+    event.listen(Session, 'after_rollback', _discard_pending)
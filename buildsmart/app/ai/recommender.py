@@ -3,11 +3,10 @@ AI Recommendation Engine for BuildSmart
 This module provides intelligent recommendations for construction materials and services
 """
 
-import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
-from app.models import Product, Service, Shop
-from app.extensions import db
+from app.models import Product
+from app.ai.text_matcher import get_text_model
+from app.ai.cost_estimator import get_category_prices, cheapest_offers, shop_offers
+from app.ai.shop_optimizer import ShoppingPlanOptimizer, DEFAULT_TIME_BUDGET_MS
 
 
 class MaterialRecommender:
@@ -16,8 +15,12 @@ class MaterialRecommender:
     Uses TF-IDF and cosine similarity for matching user needs to products
     """
     
+    DEFAULT_PROJECT_TYPE = '2_bedroom_house'
+    
+    # Custom specification fields that change quantities (see _adjust_quantities)
+    SPEC_FIELDS = ('area_sq_meters', 'floors')
+    
     def __init__(self):
-        self.vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
         self.material_database = self._load_material_database()
     
     def _load_material_database(self):
@@ -74,7 +77,7 @@ class MaterialRecommender:
             Dictionary containing recommended materials with quantities and categories
         """
         # Get base materials for project type
-        base_materials = self.material_database.get(project_type, self.material_database['2_bedroom_house'])
+        base_materials = self.material_database.get(project_type, self.material_database[self.DEFAULT_PROJECT_TYPE])
         
         # Apply custom adjustments if provided
         if custom_specs:
@@ -82,6 +85,59 @@ class MaterialRecommender:
         
         return base_materials
     
+    def match_description(self, project_description, limit=10):
+        """
+        Match a project description against project types and products
+        
+        Uses the precomputed TF-IDF model (see app.ai.text_matcher), so
+        no fitting happens per request.
+        
+        Args:
+            project_description: User's description of their project
+            limit: Maximum number of matching products
+        
+        Returns:
+            Dictionary with the best 'project_type' (None if nothing
+            matched), 'project_type_scores' and matching 'products', or
+            None when no model has been fitted
+        """
+        model = get_text_model()
+        if model is None or not project_description:
+            return None
+        
+        type_scores = [
+            (project_type, score) for project_type, score in model.match_project_types(project_description)
+            if project_type in self.material_database
+        ]
+        product_scores = model.match_products(project_description, limit=limit)
+        
+        products = []
+        if product_scores:
+            found = {
+                product.id: product for product in Product.query.filter(
+                    Product.id.in_([product_id for product_id, _ in product_scores]),
+                    Product.is_available == True
+                )
+            }
+            for product_id, score in product_scores:
+                product = found.get(product_id)
+                if product is not None:
+                    products.append({
+                        'id': product.id,
+                        'name': product.name,
+                        'category': product.category or '',
+                        'price': float(product.price) if product.price is not None else 0.0,
+                        'shop_id': product.shop_id,
+                        'score': round(score, 4),
+                    })
+        
+        best_type = type_scores[0] if type_scores and type_scores[0][1] > 0 else None
+        return {
+            'project_type': best_type[0] if best_type else None,
+            'project_type_scores': {project_type: round(score, 4) for project_type, score in type_scores},
+            'products': products,
+        }
+    
     def _adjust_quantities(self, materials, specs):
         """Adjust material quantities based on custom specifications"""
         adjusted = materials.copy()
@@ -117,17 +173,15 @@ class MaterialRecommender:
         cost_breakdown = {}
         total_cost = 0.0
         
+        # Cheapest offers from verified shops for every category in one lookup
+        price_snapshots = get_category_prices(m['category'] for m in materials.values())
+        
         for material_name, material_info in materials.items():
-            # Query products matching this material category from verified shops only
-            category = material_info['category']
-            products = Product.query.filter_by(
-                category=category,
-                is_available=True
-            ).join(Shop).filter(Shop.is_verified == True).order_by(Product.price).all()
+            products = cheapest_offers(price_snapshots[material_info['category']])
             
             if products:
-                # Use average price from available products - convert Decimal to float
-                avg_price = float(sum(float(p.price) for p in products[:3]) / min(len(products), 3))
+                # Use average price of the cheapest available products
+                avg_price = sum(p['price'] for p in products) / len(products)
                 quantity = material_info['quantity']
                 subtotal = avg_price * quantity
                 
@@ -221,9 +275,12 @@ class ShopOptimizer:
     Optimize shopping routes to minimize cost and distance
     """
     
-    def optimize_shopping_plan(self, materials, user_lat, user_lon, max_shops=5):
+    def __init__(self, time_budget_ms=DEFAULT_TIME_BUDGET_MS):
+        self.engine = ShoppingPlanOptimizer(time_budget_ms=time_budget_ms)
+    
+    def build_plan(self, materials, user_lat, user_lon, max_shops=5):
         """
-        Create an optimized shopping plan
+        Choose which shops to buy each material from
         
         Args:
             materials: Dictionary of required materials
@@ -232,109 +289,119 @@ class ShopOptimizer:
             max_shops: Maximum number of shops to visit
         
         Returns:
-            Optimized shopping plan with shops and products
+            Dictionary with 'stops' (shops in visiting order with the
+            products to buy there) and a cost 'summary'
         """
-        shopping_plan = []
-        material_categories = {m['category'] for m in materials.values()}
+        price_snapshots = get_category_prices(m['category'] for m in materials.values())
         
-        # Find shops with required products
-        shops_with_products = {}
+        # Each shop's cheapest offer per category, priced per unit
+        offers = {}
+        shops = {}
+        for category, snapshot in price_snapshots.items():
+            offers[category] = shop_offers(snapshot)
+            shops.update(snapshot['shops'])
         
-        for category in material_categories:
-            products = Product.query.filter_by(
-                category=category,
-                is_available=True
-            ).join(Shop).filter(Shop.is_verified == True).all()
-            
-            for product in products:
-                shop_id = product.shop_id
-                if shop_id not in shops_with_products:
-                    shops_with_products[shop_id] = {
-                        'shop': product.shop,
-                        'products': [],
-                        'total_cost': 0,
-                        'distance': product.shop.distance_to(user_lat, user_lon)
-                    }
-                
-                shops_with_products[shop_id]['products'].append(product)
-                shops_with_products[shop_id]['total_cost'] += float(product.price)
-        
-        # Score shops based on cost and distance
-        scored_shops = []
-        for shop_data in shops_with_products.values():
-            # Normalize cost and distance (lower is better)
-            cost_score = float(shop_data['total_cost'])
-            distance_score = float(shop_data['distance']) * 10  # Weight distance
-            
-            # Combined score (lower is better)
-            combined_score = float(cost_score) + float(distance_score)
-            
-            # Convert Shop object to dictionary
-            shop_obj = shop_data['shop']
+        requirements = [(name, info['category'], info['quantity']) for name, info in materials.items()]
+        shop_locations = {shop_id: (shop['latitude'], shop['longitude']) for shop_id, shop in shops.items()}
+        plan = self.engine.solve(requirements, offers, shop_locations, (user_lat, user_lon), max_shops)
+        
+        stops = []
+        for stop in plan['stops']:
+            shop_obj = shops[stop['shop_id']]
             shop_dict = {
-                'id': shop_obj.id or 0,
-                'name': shop_obj.name or '',
-                'description': shop_obj.description or '',
-                'address': shop_obj.address or '',
-                'phone': shop_obj.phone,
-                'email': shop_obj.email,
-                'latitude': float(shop_obj.latitude) if shop_obj.latitude else 0.0,
-                'longitude': float(shop_obj.longitude) if shop_obj.longitude else 0.0,
-                'rating': float(shop_obj.rating) if shop_obj.rating else 0.0,
-                'total_reviews': shop_obj.total_reviews or 0,
-                'is_verified': shop_obj.is_verified if shop_obj.is_verified is not None else False,
-                'is_active': shop_obj.is_active if shop_obj.is_active is not None else True,
-                'owner_id': shop_obj.owner_id or 0,
+                'id': shop_obj['id'] or 0,
+                'name': shop_obj['name'] or '',
+                'description': shop_obj['description'] or '',
+                'address': shop_obj['address'] or '',
+                'phone': shop_obj['phone'],
+                'email': shop_obj['email'],
+                'latitude': shop_obj['latitude'] or 0.0,
+                'longitude': shop_obj['longitude'] or 0.0,
+                'rating': shop_obj['rating'] or 0.0,
+                'total_reviews': shop_obj['total_reviews'] or 0,
+                'is_verified': shop_obj['is_verified'] if shop_obj['is_verified'] is not None else False,
+                'is_active': shop_obj['is_active'] if shop_obj['is_active'] is not None else True,
+                'owner_id': shop_obj['owner_id'] or 0,
             }
             
-            # Convert Product objects to dictionaries
             products_list = []
-            for prod in shop_data['products']:
+            for item in stop['items']:
+                prod = item['offer']
                 products_list.append({
-                    'id': prod.id or 0,
-                    'name': prod.name or '',
-                    'category': prod.category or '',
-                    'price': float(prod.price) if prod.price else 0.0,
-                    'unit': prod.unit or '',
-                    'quantity_available': prod.quantity_available or 0,
-                    'shop_id': prod.shop_id or 0,
+                    'id': prod['id'] or 0,
+                    'name': prod['name'] or '',
+                    'category': prod['category'] or '',
+                    'price': prod['price'],
+                    'unit': prod['unit'] or '',
+                    'quantity_available': prod['quantity_available'] or 0,
+                    'shop_id': prod['shop_id'] or 0,
+                    'material': item['material'],
+                    'quantity': item['quantity'],
+                    'subtotal': round(item['subtotal'], 2),
                 })
             
-            scored_shops.append({
+            stops.append({
                 'shop': shop_dict,
                 'products': products_list,
-                'total_cost': round(shop_data['total_cost'], 2),
-                'distance_km': round(shop_data['distance'], 2),
-                'score': combined_score
+                'total_cost': round(stop['subtotal'], 2),
+                'distance_km': round(stop['distance_km'], 2) if stop['distance_km'] is not None else None,
             })
         
-        # Sort by score and return top shops
-        scored_shops.sort(key=lambda x: x['score'])
-        return scored_shops[:max_shops]
+        summary = {
+            'material_cost': round(plan['material_cost'], 2),
+            'travel_km': round(plan['travel_km'], 2),
+            'travel_cost': round(plan['travel_cost'], 2),
+            'total_cost': round(plan['total_cost'], 2),
+            'unavailable': plan['unavailable'],
+        }
+        return {'stops': stops, 'summary': summary}
+    
+    def optimize_shopping_plan(self, materials, user_lat, user_lon, max_shops=5):
+        """
+        Create an optimized shopping plan
+        
+        Args:
+            materials: Dictionary of required materials
+            user_lat: User's latitude
+            user_lon: User's longitude
+            max_shops: Maximum number of shops to visit
+        
+        Returns:
+            Shops to visit, in order, with the products to buy at each
+        """
+        return self.build_plan(materials, user_lat, user_lon, max_shops)['stops']
 
 
-def generate_full_recommendation(user_id, project_description, project_type, 
-                                 custom_specs=None, user_lat=None, user_lon=None):
+def resolve_project_type(project_type, description_match):
+    """Use the given project type, else the one matched from the description"""
+    if project_type:
+        return project_type
+    return (description_match or {}).get('project_type') or MaterialRecommender.DEFAULT_PROJECT_TYPE
+
+
+def build_recommendation(project_type, custom_specs=None, user_lat=None, user_lon=None):
     """
-    Main function to generate complete recommendation
+    Build the parts of a recommendation that depend only on the project spec
+    
+    Materials, cost estimate, services and shopping plan are the same for
+    every description of the same project type, specs and location, which
+    makes them cacheable (see app.services.recommendation_service).
     
     Args:
-        user_id: User requesting recommendation
-        project_description: Description of the project
         project_type: Type of project
         custom_specs: Custom specifications
         user_lat: User latitude
         user_lon: User longitude
     
     Returns:
-        Complete recommendation dictionary
+        Recommendation dictionary without description matches
     """
     material_rec = MaterialRecommender()
     service_rec = ServiceRecommender()
     shop_opt = ShopOptimizer()
     
     # Generate material recommendations
-    materials = material_rec.recommend_materials(project_description, project_type, custom_specs)
+    materials = material_rec.recommend_materials(None, project_type, custom_specs)
     
     # Estimate costs
     cost_estimate = material_rec.estimate_cost(materials, (user_lat, user_lon) if user_lat else None)
@@ -344,8 +411,11 @@ def generate_full_recommendation(user_id, project_description, project_type,
     
     # Optimize shopping plan
     shopping_plan = []
+    shopping_summary = None
     if user_lat and user_lon:
-        shopping_plan = shop_opt.optimize_shopping_plan(materials, user_lat, user_lon)
+        plan = shop_opt.build_plan(materials, user_lat, user_lon)
+        shopping_plan = plan['stops']
+        shopping_summary = plan['summary']
     
     return {
         'project_type': project_type,
@@ -353,5 +423,31 @@ def generate_full_recommendation(user_id, project_description, project_type,
         'cost_estimate': cost_estimate,
         'services': services,
         'shopping_plan': shopping_plan,
+        'shopping_summary': shopping_summary,
         'confidence_score': 0.85  # Can be calculated based on data availability
-    }
\ No newline at end of file
+    }
+
+
+def generate_full_recommendation(user_id, project_description, project_type, 
+                                 custom_specs=None, user_lat=None, user_lon=None):
+    """
+    Main function to generate complete recommendation
+    
+    Args:
+        user_id: User requesting recommendation
+        project_description: Description of the project
+        project_type: Type of project (None = inferred from the description)
+        custom_specs: Custom specifications
+        user_lat: User latitude
+        user_lon: User longitude
+    
+    Returns:
+        Complete recommendation dictionary
+    """
+    # Match the description against project types and products
+    description_match = MaterialRecommender().match_description(project_description)
+    project_type = resolve_project_type(project_type, description_match)
+    
+    recommendation = build_recommendation(project_type, custom_specs, user_lat, user_lon)
+    recommendation['matched_products'] = description_match['products'] if description_match else []
+    return recommendation
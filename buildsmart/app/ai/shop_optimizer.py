@@ -0,0 +1,295 @@
+"""
+Shopping plan optimizer.
+
+Chooses which shops to buy each material from so that every material is
+covered by at most ``max_shops`` shops at the lowest total cost, where
+cost is the price of the materials plus the cost of a round trip from
+the customer through the chosen shops.
+
+This is a weighted set-cover / facility-selection problem. It is solved
+with a greedy construction followed by local search (drop, add and swap
+moves) over NumPy cost matrices, restarted from several seed shops and
+bounded by a latency budget so large catalogs still answer quickly. The
+best plan found within the budget is returned.
+"""
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from app.utils.geo import coordinate_arrays, haversine_distances
+
+# Approximate transport cost per kilometre travelled (UGX)
+DISTANCE_COST_PER_KM = 1000.0
+
+DEFAULT_TIME_BUDGET_MS = 100.0
+
+# Shops considered per material (cheapest offers) before optimizing
+CANDIDATES_PER_MATERIAL = 10
+
+# Additional searches started from other seed shops while time remains
+MAX_RESTARTS = 8
+
+
+class ShoppingPlanOptimizer:
+    """
+    Solver for multi-shop shopping plans.
+
+    Usage:
+        optimizer = ShoppingPlanOptimizer()
+        plan = optimizer.solve(requirements, offers, shop_locations, (lat, lon), max_shops=3)
+    """
+
+    def __init__(self, distance_cost_per_km: float = DISTANCE_COST_PER_KM,
+                 time_budget_ms: float = DEFAULT_TIME_BUDGET_MS,
+                 candidates_per_material: int = CANDIDATES_PER_MATERIAL):
+        self.distance_cost_per_km = distance_cost_per_km
+        self.time_budget_ms = time_budget_ms
+        self.candidates_per_material = candidates_per_material
+
+    def solve(self, requirements: Sequence[Tuple[str, str, float]], offers: Dict[str, List[Dict]],
+              shop_locations: Dict[int, Tuple[Optional[float], Optional[float]]],
+              origin: Tuple[float, float], max_shops: int = 5) -> Dict:
+        """
+        Find the cheapest plan covering the required materials.
+
+        Args:
+            requirements: (material name, category, quantity) tuples
+            offers: Category to list of offers, each with 'shop_id' and 'price' (unit price)
+            shop_locations: Shop ID to (latitude, longitude)
+            origin: Customer (latitude, longitude)
+            max_shops: Maximum number of shops to visit
+
+        Returns:
+            Dictionary with 'stops' (in visiting order, each with 'shop_id',
+            'distance_km' from the origin, 'items' and 'subtotal'),
+            'material_cost', 'travel_km', 'travel_cost', 'total_cost',
+            'unavailable' (materials no shop offers), 'elapsed_ms' and
+            'timed_out'
+        """
+        started = time.perf_counter()
+        deadline = started + self.time_budget_ms / 1000.0
+
+        problem = _Problem(requirements, offers, shop_locations, origin,
+                           self.distance_cost_per_km, self.candidates_per_material)
+        timed_out = False
+        selected: List[int] = []
+        if problem.n_shops and problem.n_materials and max_shops > 0:
+            selected, timed_out = problem.search(max_shops, deadline)
+
+        plan = problem.describe(selected)
+        plan['elapsed_ms'] = round((time.perf_counter() - started) * 1000.0, 2)
+        plan['timed_out'] = timed_out
+        return plan
+
+
+class _Problem:
+    """Cost matrices and objective for one optimization run."""
+
+    def __init__(self, requirements, offers, shop_locations, origin, distance_cost_per_km,
+                 candidates_per_material):
+        self.distance_cost_per_km = distance_cost_per_km
+
+        # Materials somebody sells become matrix columns; the rest are unavailable
+        self.materials = []
+        self.unavailable = []
+        for name, category, quantity in requirements:
+            if offers.get(category):
+                self.materials.append((name, category, quantity))
+            else:
+                self.unavailable.append(name)
+
+        # Candidate shops: the cheapest few for every material
+        candidates = []
+        seen = set()
+        for _, category, _ in self.materials:
+            ranked = sorted(offers[category], key=lambda offer: (offer['price'], offer['shop_id']))
+            for offer in ranked[:candidates_per_material]:
+                if offer['shop_id'] not in seen:
+                    seen.add(offer['shop_id'])
+                    candidates.append(offer['shop_id'])
+        self.shop_ids = candidates
+        self.n_shops = len(candidates)
+        self.n_materials = len(self.materials)
+        row = {shop_id: index for index, shop_id in enumerate(candidates)}
+
+        # cost[s, m]: cost of buying material m at shop s (inf if not sold there)
+        self.cost = np.full((self.n_shops, self.n_materials), np.inf)
+        self.offer = {}
+        for m, (_, category, quantity) in enumerate(self.materials):
+            for offer in offers[category]:
+                s = row.get(offer['shop_id'])
+                if s is not None and offer['price'] * quantity < self.cost[s, m]:
+                    self.cost[s, m] = offer['price'] * quantity
+                    self.offer[(s, m)] = offer
+
+        # Uncovered materials cost more than any feasible plan
+        finite = self.cost[np.isfinite(self.cost)]
+        self.penalty = (finite.max() if finite.size else 1.0) * (self.n_materials + 1)
+
+        # dist[i, j] between origin (index 0) and candidate shops (1..n)
+        lats, lons = coordinate_arrays(
+            [origin] + [shop_locations.get(shop_id, (None, None)) for shop_id in candidates]
+        )
+        self.located = ~np.isnan(lats)
+        dist = haversine_distances(lats[:, None], lons[:, None], lats[None, :], lons[None, :])
+        # Shops without coordinates add no known travel
+        self.dist = np.nan_to_num(dist, nan=0.0)
+        self.penalty += self.dist.max() * 2 * distance_cost_per_km * (self.n_shops + 1)
+
+        self._tours = {}
+
+    def material_costs(self, best_per_material: np.ndarray) -> np.ndarray:
+        """Sum per-material costs along the last axis, penalizing uncovered ones."""
+        return np.where(np.isinf(best_per_material), self.penalty, best_per_material).sum(axis=-1)
+
+    def tour(self, shops: Tuple[int, ...]) -> Tuple[float, List[int]]:
+        """Nearest-neighbour round trip from the origin through ``shops``."""
+        key = tuple(sorted(shops))
+        if key not in self._tours:
+            remaining = [s + 1 for s in key]
+            position, length, order = 0, 0.0, []
+            while remaining:
+                nearest = min(remaining, key=lambda point: self.dist[position, point])
+                length += self.dist[position, nearest]
+                order.append(nearest - 1)
+                remaining.remove(nearest)
+                position = nearest
+            length += self.dist[position, 0]
+            self._tours[key] = (length, order)
+        return self._tours[key]
+
+    def objective(self, shops: Sequence[int]) -> float:
+        if not shops:
+            return self.penalty * self.n_materials
+        best = self.cost[list(shops)].min(axis=0)
+        return float(self.material_costs(best)) + self.tour(tuple(shops))[0] * self.distance_cost_per_km
+
+    def best_addition(self, base: List[int], best: float, excluded: set, deadline: float):
+        """
+        Find the shop whose addition to ``base`` gives the lowest objective below ``best``.
+
+        Material costs for every candidate are computed in one vectorized
+        step; tours are only evaluated while a candidate's lower bound
+        (material cost plus the round trip to that shop alone) can still
+        beat ``best``.
+        """
+        base_min = self.cost[base].min(axis=0) if base else np.full(self.n_materials, np.inf)
+        material = self.material_costs(np.minimum(base_min[None, :], self.cost))
+        lower_bound = material + 2 * self.dist[0, 1:] * self.distance_cost_per_km
+
+        choice, choice_value = None, best
+        for t in np.argsort(lower_bound, kind='stable'):
+            if lower_bound[t] >= choice_value or time.perf_counter() > deadline:
+                break
+            if t in excluded:
+                continue
+            value = float(material[t]) + self.tour(tuple(base) + (int(t),))[0] * self.distance_cost_per_km
+            if value < choice_value:
+                choice, choice_value = int(t), value
+        return choice, choice_value
+
+    def search(self, max_shops: int, deadline: float) -> Tuple[List[int], bool]:
+        """
+        Local search from a greedy start, restarted from other seed shops.
+
+        Restarts begin with each of the most promising single shops forced
+        into the plan, which escapes local optima of the first search.
+        """
+        best, timed_out = self.local_search([], max_shops, deadline)
+        best_value = self.objective(best)
+
+        single = self.material_costs(self.cost) + 2 * self.dist[0, 1:] * self.distance_cost_per_km
+        seeds = [int(s) for s in np.argsort(single, kind='stable') if int(s) not in best]
+        for seed in seeds[:MAX_RESTARTS]:
+            if timed_out or time.perf_counter() > deadline:
+                return best, True
+            selected, timed_out = self.local_search([seed], max_shops, deadline)
+            value = self.objective(selected)
+            if value < best_value:
+                best, best_value = selected, value
+
+        return best, timed_out
+
+    def local_search(self, selected: List[int], max_shops: int, deadline: float) -> Tuple[List[int], bool]:
+        """Greedy construction followed by drop/add/swap local search."""
+        selected = list(selected)
+        value = self.objective(selected)
+
+        while len(selected) < max_shops:
+            shop, new_value = self.best_addition(selected, value, set(selected), deadline)
+            if shop is None:
+                break
+            selected.append(shop)
+            value = new_value
+
+        improved = True
+        while improved:
+            if time.perf_counter() > deadline:
+                return selected, True
+            improved = False
+            best_move, best_value = None, value
+
+            for s in selected:
+                rest = [other for other in selected if other != s]
+                drop_value = self.objective(rest)
+                if drop_value < best_value:
+                    best_move, best_value = rest, drop_value
+                shop, swap_value = self.best_addition(rest, best_value, set(selected), deadline)
+                if shop is not None:
+                    best_move, best_value = rest + [shop], swap_value
+
+            if len(selected) < max_shops:
+                shop, add_value = self.best_addition(selected, best_value, set(selected), deadline)
+                if shop is not None:
+                    best_move, best_value = selected + [shop], add_value
+
+            if best_move is not None:
+                selected, value, improved = best_move, best_value, True
+
+        return selected, time.perf_counter() > deadline
+
+    def describe(self, selected: List[int]) -> Dict:
+        unavailable = list(self.unavailable)
+        stops = []
+        material_cost = 0.0
+        travel_km = 0.0
+
+        if selected:
+            travel_km, order = self.tour(tuple(selected))
+            assigned = self.cost[order].argmin(axis=0)
+            for position, s in enumerate(order):
+                items = []
+                for m in np.flatnonzero(assigned == position):
+                    if not np.isfinite(self.cost[s, m]):
+                        continue
+                    name, category, quantity = self.materials[m]
+                    offer = self.offer[(s, m)]
+                    items.append({
+                        'material': name,
+                        'category': category,
+                        'quantity': quantity,
+                        'unit_price': offer['price'],
+                        'subtotal': float(self.cost[s, m]),
+                        'offer': offer,
+                    })
+                subtotal = sum(item['subtotal'] for item in items)
+                material_cost += subtotal
+                stops.append({
+                    'shop_id': self.shop_ids[s],
+                    'distance_km': float(self.dist[0, s + 1]) if self.located[s + 1] else None,
+                    'items': items,
+                    'subtotal': subtotal,
+                })
+            covered = {item['material'] for stop in stops for item in stop['items']}
+            unavailable += [name for name, _, _ in self.materials if name not in covered]
+        else:
+            unavailable += [name for name, _, _ in self.materials]
+
+        travel_cost = travel_km * self.distance_cost_per_km
+        return {
+            'stops': stops,
+            'material_cost': material_cost,
+            'travel_km': float(travel_km),
+            'travel_cost': float(travel_cost),
+            'total_cost': material_cost + float(travel_cost),
+            'unavailable': unavailable,
+        }
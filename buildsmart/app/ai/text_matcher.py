@@ -0,0 +1,228 @@
+"""
+Project description matching.
+
+Matches a customer's free-text project description against project type
+profiles and product descriptions using TF-IDF and cosine similarity.
+
+Fitting the vectorizer is too slow to do per request, so the model is
+fitted offline (``flask fit-text-model``) and saved to a directory:
+
+- ``vocabulary.json``: vocabulary, IDF weights, vectorizer settings and
+  the ids/keys of the matrix rows
+- ``products.npz`` / ``project_types.npz``: L2-normalized TF-IDF rows as
+  sparse matrices
+
+Each worker loads the model once and reloads it only when a new one is
+saved. A request then vectorizes its description with the stored
+vocabulary and scores it against the precomputed matrices with one
+sparse product.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+from flask import current_app
+from app.extensions import db
+from app.models import Product, Shop
+
+MODEL_VERSION = 1
+
+VOCABULARY_FILE = 'vocabulary.json'
+PRODUCTS_FILE = 'products.npz'
+PROJECT_TYPES_FILE = 'project_types.npz'
+
+# Number words distinguish project sizes ("two bedroom" vs "three bedroom")
+NUMBER_WORDS = {'one', 'two', 'three', 'four', 'five', 'six', 'eight', 'ten', 'twelve', 'fifteen',
+                'twenty', 'fifty', 'hundred', 'first', 'second', 'third'}
+STOP_WORDS = sorted(ENGLISH_STOP_WORDS - NUMBER_WORDS)
+
+# Vectorizer settings; single-character tokens keep "2 bedroom" distinct from "3 bedroom"
+VECTORIZER_PARAMS = {
+    'lowercase': True,
+    'stop_words': STOP_WORDS,
+    'token_pattern': r'(?u)\b\w+\b',
+    'ngram_range': (1, 2),
+    'max_features': 20000,
+}
+
+# Reference descriptions of the project types the recommender knows about
+PROJECT_TYPE_PROFILES = {
+    '2_bedroom_house': (
+        '2 bedroom house two bedroom home small residential house bungalow starter home '
+        'small family house two rooms sitting room kitchen'
+    ),
+    '3_bedroom_house': (
+        '3 bedroom house three bedroom home family house residential bungalow master bedroom '
+        'ensuite larger home three rooms sitting room dining kitchen'
+    ),
+    'commercial_building': (
+        'commercial building office block shops retail rental units storey building '
+        'warehouse business premises arcade plaza offices'
+    ),
+}
+
+
+class TextModel:
+    """Fitted TF-IDF model loaded from disk."""
+
+    def __init__(self, path: str, metadata: Dict, products: sparse.csr_matrix,
+                 project_types: sparse.csr_matrix):
+        self.path = path
+        self.metadata = metadata
+        self.products = products
+        self.project_types = project_types
+        self.product_ids = np.asarray(metadata['product_ids'], dtype=np.int64)
+        self.project_type_keys = list(metadata['project_types'])
+        self.idf = np.asarray(metadata['idf'], dtype=np.float64)
+
+        params = dict(metadata['params'])
+        params['ngram_range'] = tuple(params['ngram_range'])
+        params.pop('max_features', None)
+        # Counting with the stored vocabulary needs no fitting
+        self._counter = CountVectorizer(vocabulary=metadata['vocabulary'], **params)
+
+    def transform(self, texts: List[str]) -> sparse.csr_matrix:
+        """Vectorize texts into L2-normalized TF-IDF rows."""
+        counts = self._counter.transform(texts)
+        return normalize(counts.multiply(self.idf).tocsr())
+
+    def match_project_types(self, description: str) -> List[Tuple[str, float]]:
+        """
+        Score a description against every project type profile.
+
+        Returns:
+            (project type, cosine similarity) pairs, best first
+        """
+        scores = (self.project_types @ self.transform([description]).T).toarray().ravel()
+        order = np.argsort(-scores, kind='stable')
+        return [(self.project_type_keys[i], float(scores[i])) for i in order]
+
+    def match_products(self, description: str, limit: int = 10,
+                       min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """
+        Find the products whose descriptions best match a description.
+
+        Returns:
+            Up to ``limit`` (product ID, cosine similarity) pairs above
+            ``min_score``, best first
+        """
+        if not self.products.shape[0] or limit <= 0:
+            return []
+        scores = (self.products @ self.transform([description]).T).toarray().ravel()
+        candidates = np.flatnonzero(scores > min_score)
+        if candidates.size > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(self.product_ids[i]), float(scores[i])) for i in candidates]
+
+
+def _product_text(row) -> str:
+    return ' '.join(part for part in (row.name, row.brand, row.category, row.description) if part)
+
+
+def fit_text_model(path: str) -> Dict:
+    """
+    Fit the TF-IDF model on available products and project profiles and save it.
+
+    Files are written next to the old ones and moved into place, with the
+    vocabulary file last, so workers never load a half-written model.
+
+    Args:
+        path: Directory to save the model in
+
+    Returns:
+        Dictionary with the number of products and vocabulary terms
+    """
+    rows = db.session.execute(
+        db.select(Product.id, Product.name, Product.brand, Product.category, Product.description)
+        .join(Shop, Shop.id == Product.shop_id)
+        .where(Product.is_available == True, Shop.is_active == True)
+        .order_by(Product.id)
+    ).all()
+
+    project_types = list(PROJECT_TYPE_PROFILES)
+    product_texts = [_product_text(row) for row in rows]
+    vectorizer = TfidfVectorizer(**VECTORIZER_PARAMS)
+    matrix = vectorizer.fit_transform([PROJECT_TYPE_PROFILES[key] for key in project_types] + product_texts)
+    matrix = matrix.astype(np.float32).tocsr()
+
+    params = dict(VECTORIZER_PARAMS)
+    params['ngram_range'] = list(params['ngram_range'])
+    metadata = {
+        'version': MODEL_VERSION,
+        'fitted_at': datetime.utcnow().isoformat(),
+        'params': params,
+        'vocabulary': {term: int(index) for term, index in vectorizer.vocabulary_.items()},
+        'idf': vectorizer.idf_.tolist(),
+        'project_types': project_types,
+        'product_ids': [row.id for row in rows],
+    }
+
+    os.makedirs(path, exist_ok=True)
+    _save_npz(os.path.join(path, PROJECT_TYPES_FILE), matrix[:len(project_types)])
+    _save_npz(os.path.join(path, PRODUCTS_FILE), matrix[len(project_types):])
+    vocabulary_path = os.path.join(path, VOCABULARY_FILE)
+    with open(vocabulary_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    os.replace(vocabulary_path + '.tmp', vocabulary_path)
+
+    return {'products': len(rows), 'terms': len(metadata['vocabulary'])}
+
+
+def _save_npz(path: str, matrix: sparse.csr_matrix) -> None:
+    # save_npz appends .npz to names without it
+    tmp_path = path[:-len('.npz')] + '.tmp.npz'
+    sparse.save_npz(tmp_path, matrix)
+    os.replace(tmp_path, path)
+
+
+def load_text_model(path: str) -> TextModel:
+    """Load a saved model from ``path``."""
+    with open(os.path.join(path, VOCABULARY_FILE), encoding='utf-8') as f:
+        metadata = json.load(f)
+    if metadata.get('version') != MODEL_VERSION:
+        raise ValueError(f'Unsupported text model version: {metadata.get("version")}')
+    products = sparse.load_npz(os.path.join(path, PRODUCTS_FILE)).tocsr()
+    project_types = sparse.load_npz(os.path.join(path, PROJECT_TYPES_FILE)).tocsr()
+    return TextModel(path, metadata, products, project_types)
+
+
+# Per-worker model, keyed by directory and vocabulary file modification time
+_model_lock = threading.Lock()
+_loaded: Dict[str, Tuple[float, TextModel]] = {}
+
+
+def get_text_model() -> Optional[TextModel]:
+    """
+    Get this worker's copy of the configured model.
+
+    The model is loaded on first use and reloaded only after a new one is
+    saved. Returns None when no model is configured or fitted yet.
+    """
+    path = current_app.config.get('TEXT_MODEL_PATH')
+    if not path:
+        return None
+    try:
+        mtime = os.stat(os.path.join(path, VOCABULARY_FILE)).st_mtime
+    except OSError:
+        return None
+
+    entry = _loaded.get(path)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+
+    with _model_lock:
+        entry = _loaded.get(path)
+        if entry is None or entry[0] != mtime:
+            try:
+                entry = (mtime, load_text_model(path))
+            except Exception as e:
+                current_app.logger.error(f'Error loading text model from {path}: {e}')
+                return entry[1] if entry is not None else None
+            _loaded[path] = entry
+    return entry[1]
@@ -1,12 +1,14 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, current_app
+from flask import render_template, request, redirect, url_for, flash, jsonify, current_app, abort, Response
 from flask_login import login_required, current_user
 from app.blueprints.admin import admin_bp
 from app.models import User, Shop, Product, Order, Payment, Category, Review
 from app.extensions import db
 from app.services.payment_service import payment_service
 from app.services.analytics_service import AnalyticsService
+from app.services.cache_service import CacheService
 from app.utils.decorators import admin_required
 from datetime import datetime, timedelta, date
+import hmac
 
 
 @admin_bp.route('/dashboard')
@@ -388,3 +390,26 @@ def suspend_user(user_id):
     flash('User suspended successfully!', 'success')
     return redirect(url_for('admin.users'))
 
+
+@admin_bp.route('/metrics')
+def metrics():
+    """
+    Cache metrics of this worker in Prometheus text format.
+    
+    Readable by admins, or by scrapers sending ``Authorization: Bearer
+    <METRICS_TOKEN>``.
+    
+    Returns:
+        Response: Metrics text
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    supplied = request.headers.get('Authorization', '')
+    if not (token and hmac.compare_digest(supplied, f'Bearer {token}')):
+        if not current_user.is_authenticated or not current_user.is_admin_user():
+            abort(403)
+    
+    cache_metrics = CacheService.get_metrics()
+    if cache_metrics is None:
+        abort(404)
+    return Response(cache_metrics.render(CacheService.get_stats()),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
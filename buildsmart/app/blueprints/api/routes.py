@@ -3,10 +3,11 @@ from flask_login import login_required, current_user, login_user
 from app.models import (
     Shop, Product, Service, User, Order, Recommendation, Cart, CartItem,
     Comparison, Review, Address, Token, ProductImage, Wishlist, StockNotification,
-    SearchHistory, TrendingSearch, OrderStatus
+    OrderStatus
 )
 from app.extensions import db, limiter
-from app.ai.recommender import generate_full_recommendation
+from app.services.recommendation_service import RecommendationService
+from app.services.cache_service import CacheService
 from app.blueprints.api import api_bp
 from app.utils.error_handlers import (
     handle_api_error, handle_validation_error, handle_permission_error,
@@ -19,7 +20,12 @@ from app.utils.security import (
 )
 from app.services.email_service import EmailService
 from app.services.two_factor_service import TwoFactorService
+from app.services.search_service import SearchService
+from app.services.search_analytics_service import SearchAnalyticsService
 from app.utils.cart_utils import merge_guest_cart_to_user
+from app.utils.geo import coordinate_arrays, nearest_k, distance_expression
+from app.utils.query_optimization import encode_cursor, decode_cursor, keyset_filter
+from app.utils.response_cache import cache_public, cache_private
 from marshmallow import ValidationError
 from decimal import Decimal
 
@@ -32,24 +38,31 @@ rate_limit_email_verification = limiter.limit("5 per hour")
 
 @api_bp.route('/shops/nearby', methods=['GET'])
 def nearby_shops():
-    """Get shops near a location"""
+    """Get shops near a location, nearest first"""
     try:
         lat = request.args.get('lat', type=float)
         lon = request.args.get('lon', type=float)
         radius = request.args.get('radius', 10, type=float)  # km
+        limit = request.args.get('limit', type=int)  # k nearest shops
         
-        if not lat or not lon:
+        if lat is None or lon is None:
             return handle_validation_error({'lat': 'Latitude is required', 'lon': 'Longitude is required'})
         
-        # Get all verified shops
-        shops = Shop.query.filter_by(is_verified=True).all()
+        # Prefilter verified shops in SQL using the geohash index and bounding box
+        candidates = Shop.query.filter(
+            Shop.is_verified == True,
+            Shop.within_radius_filter(lat, lon, radius)
+        ).all()
+        
+        # Exact distance only for the candidates, k nearest selected without a full sort
+        lats, lons = coordinate_arrays((shop.latitude, shop.longitude) for shop in candidates)
+        indices, distances = nearest_k(
+            lat, lon, lats, lons,
+            k=limit if limit and limit > 0 else None,
+            radius_km=radius
+        )
         
-        # Filter by distance
-        nearby = []
-        for shop in shops:
-            distance = shop.distance_to(lat, lon)
-            if distance <= radius:
-                nearby.append({
+        nearby = [{
             'id': shop.id or 0,
             'name': shop.name or '',
             'description': shop.description or '',
@@ -63,11 +76,8 @@ def nearby_shops():
             'is_verified': shop.is_verified if shop.is_verified is not None else False,
             'is_active': shop.is_active if shop.is_active is not None else True,
             'owner_id': shop.owner_id or 0,
-            'distance_km': round(distance, 2),
-        })
-    
-        # Sort by distance
-        nearby.sort(key=lambda x: x['distance_km'])
+            'distance_km': round(float(distance), 2),
+        } for shop, distance in zip((candidates[i] for i in indices), distances)]
         
         return jsonify({
             'shops': nearby,
@@ -87,10 +97,8 @@ def search_shops():
     shops_query = Shop.query.filter_by(is_active=True)
     
     if query:
-        shops_query = shops_query.filter(
-            (Shop.name.ilike(f'%{query}%')) | 
-            (Shop.description.ilike(f'%{query}%'))
-        )
+        shops_query, relevance = SearchService.apply_text_search(shops_query, Shop, query)
+        shops_query = shops_query.order_by(relevance.desc(), Shop.id)
     
     # Limit results
     shops = shops_query.limit(limit).all()
@@ -122,8 +130,7 @@ def search_shops():
 @api_bp.route('/products/search', methods=['GET'])
 def search_products():
     """Search products with advanced filters, sorting, and search history tracking"""
-    from sqlalchemy import func, desc, asc
-    from math import radians, sin, cos, sqrt, atan2
+    from sqlalchemy import func
     from flask_login import current_user
     
     query = request.args.get('q', '')
@@ -139,19 +146,31 @@ def search_products():
     sort_by = request.args.get('sort_by', 'relevance')  # relevance, price_asc, price_desc, rating, distance
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 20, type=int)
+    cursor = request.args.get('cursor')  # keyset pagination, takes precedence over page
+    
+    has_location = user_lat is not None and user_lon is not None
+    
+    # Distance is computed in SQL so filtering, ordering and counts are global
+    distance = None
+    if has_location:
+        distance = distance_expression(
+            user_lat, user_lon, Shop.latitude, Shop.longitude, db.engine.dialect.name
+        )
+        products_query = db.session.query(Product, Shop, distance.label('distance_km'))
+    else:
+        products_query = db.session.query(Product, Shop)
     
     # Build base query with joins
-    products_query = db.session.query(Product, Shop).join(Shop, Product.shop_id == Shop.id).filter(
+    products_query = products_query.join(Shop, Product.shop_id == Shop.id).filter(
         Product.is_available == True,
         Shop.is_active == True
     )
     
-    # Text search
+    # Full-text search with relevance ranking
+    relevance = None
     if query:
-        products_query = products_query.filter(
-            (Product.name.ilike(f'%{query}%')) | 
-            (Product.description.ilike(f'%{query}%'))
-        )
+        products_query, relevance = SearchService.apply_text_search(products_query, Product, query)
+        products_query = products_query.add_columns(relevance.label('relevance'))
     
     # Category filter
     if category:
@@ -172,46 +191,62 @@ def search_products():
     if shop_verified is not None:
         products_query = products_query.filter(Shop.is_verified == shop_verified)
     
-    # Note: Distance filtering will be done after fetching results
-    # for better compatibility with different databases
+    # Distance filter: indexed bounding-box prefilter plus exact distance
+    if has_location and max_distance:
+        products_query = products_query.filter(
+            Shop.within_radius_filter(user_lat, user_lon, max_distance),
+            distance <= max_distance
+        )
     
-    # Sorting
+    # Sorting: (expression, direction, value of the row) with the product id
+    # as a unique tie-breaker so both offset and keyset pages are stable
+    shop_rating_keys = [
+        (func.coalesce(Shop.rating, 0.0), 'desc', lambda row: row.Shop.rating or 0.0),
+        (func.coalesce(Shop.total_reviews, 0), 'desc', lambda row: row.Shop.total_reviews or 0),
+    ]
     if sort_by == 'price_asc':
-        products_query = products_query.order_by(Product.price.asc())
+        sort_keys = [(Product.price, 'asc', lambda row: row.Product.price)]
     elif sort_by == 'price_desc':
-        products_query = products_query.order_by(Product.price.desc())
-    elif sort_by == 'rating':
-        products_query = products_query.order_by(Shop.rating.desc(), Shop.total_reviews.desc())
-    elif sort_by == 'distance' and user_lat and user_lon:
-        # Order by distance (calculate in Python after fetching)
-        # For now, just order by shop location
-        products_query = products_query.order_by(Shop.latitude, Shop.longitude)
+        sort_keys = [(Product.price, 'desc', lambda row: row.Product.price)]
+    elif sort_by == 'distance' and has_location:
+        sort_keys = [(distance, 'asc', lambda row: row.distance_km)]
+    elif sort_by == 'rating' or relevance is None:
+        sort_keys = list(shop_rating_keys)
     else:
-        # Default: relevance (by shop rating and review count for now)
-        products_query = products_query.order_by(Shop.rating.desc(), Shop.total_reviews.desc())
+        # Default: relevance (text rank, then shop rating and review count)
+        sort_keys = [(relevance, 'desc', lambda row: row.relevance)] + shop_rating_keys
+    sort_keys.append((Product.id, 'asc', lambda row: row.Product.id))
     
-    # Paginate
-    pagination = products_query.paginate(page=page, per_page=per_page, error_out=False)
+    products_query = products_query.order_by(*[
+        expr.desc() if direction == 'desc' else expr.asc()
+        for expr, direction, _ in sort_keys
+    ])
+    
+    if cursor:
+        # Keyset pagination: seek past the last row instead of OFFSET
+        cursor_values = decode_cursor(cursor)
+        if cursor_values is None or len(cursor_values) != len(sort_keys):
+            return handle_validation_error({'cursor': 'Invalid cursor'})
+        rows = products_query.filter(
+            keyset_filter([(expr, direction) for expr, direction, _ in sort_keys], cursor_values)
+        ).limit(per_page + 1).all()
+        # The extra row only tells whether there is a next page
+        has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        total = None
+        pages = None
+    else:
+        pagination = products_query.paginate(page=page, per_page=per_page, error_out=False)
+        rows = pagination.items
+        has_next = pagination.has_next
+        total = pagination.total
+        pages = pagination.pages
     
     # Build response with distance if user location provided
     products = []
-    for product, shop in pagination.items:
-        # Calculate distance if user location provided
-        distance_km = None
-        if user_lat and user_lon and shop.latitude and shop.longitude:
-            # Haversine formula
-            lat1, lon1 = radians(user_lat), radians(user_lon)
-            lat2, lon2 = radians(float(shop.latitude)), radians(float(shop.longitude))
-            dlat = lat2 - lat1
-            dlon = lon2 - lon1
-            a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-            c = 2 * atan2(sqrt(a), sqrt(1 - a))
-            distance_km = 6371 * c  # Earth radius in km
-            
-            # Filter by max_distance if specified
-            if max_distance and distance_km > max_distance:
-                continue  # Skip products outside max distance
-        
+    for row in rows:
+        product, shop = row.Product, row.Shop
+        distance_km = row.distance_km if has_location else None
         product_data = {
             'id': product.id or 0,
             'name': product.name or '',
@@ -237,51 +272,26 @@ def search_products():
         
         products.append(product_data)
     
-    # Re-sort by distance if requested (after calculating distances)
-    if sort_by == 'distance' and user_lat and user_lon:
-        products.sort(key=lambda p: p.get('distance_km', float('inf')))
+    next_cursor = None
+    if has_next and rows:
+        next_cursor = encode_cursor([value(rows[-1]) for _, _, value in sort_keys])
     
-    # Track search history
+    # Track search history; written in the background by the analytics buffer
     if query:
-        try:
-            # Save search history for authenticated users
-            if current_user.is_authenticated:
-                search_history = SearchHistory(
-                    user_id=current_user.id,
-                    query=query,
-                    search_type=search_type,
-                    results_count=len(products)
-                )
-                db.session.add(search_history)
-            
-            # Update trending searches
-            trending = TrendingSearch.query.filter_by(
-                query=query.lower().strip(),
-                search_type=search_type
-            ).first()
-            
-            if trending:
-                trending.increment()
-            else:
-                trending = TrendingSearch(
-                    query=query.lower().strip(),
-                    search_type=search_type,
-                    count=1
-                )
-                db.session.add(trending)
-            
-            db.session.commit()
-        except Exception as e:
-            from flask import current_app
-            current_app.logger.error(f'Error tracking search: {str(e)}')
-            db.session.rollback()
+        SearchAnalyticsService.record_search(
+            query,
+            search_type,
+            user_id=current_user.id if current_user.is_authenticated else None,
+            results_count=total if total is not None else len(products)
+        )
     
     return jsonify({
         'products': products,
-        'total': pagination.total,
-        'pages': pagination.pages,
-        'current_page': page,
-        'per_page': per_page
+        'total': total,
+        'pages': pages,
+        'current_page': None if cursor else page,
+        'per_page': per_page,
+        'next_cursor': next_cursor
     })
 
 
@@ -298,11 +308,11 @@ def api_recommend():
         if not is_valid:
             return handle_validation_error(field_errors)
         
-        project_type = data.get('project_type', '2_bedroom_house')
+        project_type = data.get('project_type')  # inferred from the description when omitted
         custom_specs = data.get('custom_specs', {})
         
         # Generate recommendation
-        recommendation = generate_full_recommendation(
+        recommendation = RecommendationService.get_recommendation(
             user_id=current_user.id,
             project_description=data['project_description'],
             project_type=project_type,
@@ -371,6 +381,7 @@ def search_services():
 
 
 @api_bp.route('/categories', methods=['GET'])
+@cache_public(timeout=3600, tags=[CacheService.PREFIX_CATEGORY])
 def get_categories():
     """Get all product categories"""
     try:
@@ -767,6 +778,7 @@ def api_disable_2fa():
 
 
 @api_bp.route('/shop/<int:shop_id>/products', methods=['GET'])
+@cache_public(timeout=600, tags=lambda shop_id: [CacheService.shop_tag(shop_id)])
 def shop_products(shop_id):
     """Get all products for a specific shop"""
     try:
@@ -916,6 +928,7 @@ def api_clear_comparisons():
 
 @api_bp.route('/user/dashboard', methods=['GET'])
 @login_required
+@cache_private(timeout=300)
 def api_user_dashboard():
     """API endpoint for user dashboard (returns JSON)"""
     try:
@@ -976,6 +989,7 @@ def api_user_dashboard():
 
 @api_bp.route('/user/orders', methods=['GET'])
 @login_required
+@cache_private(timeout=300)
 def api_user_orders():
     """API endpoint for user orders (returns JSON)"""
     try:
@@ -1262,6 +1276,45 @@ def api_user_recommendations():
         return handle_api_error(e)
 
 
+@api_bp.route('/user/recommendations', methods=['POST'])
+@login_required
+def api_create_recommendation():
+    """Save a generated recommendation"""
+    try:
+        is_valid, data = validate_json_request()
+        if not is_valid:
+            return handle_validation_error({'json': data})
+        
+        is_valid, field_errors = validate_required_fields(data, ['project_description', 'recommendation_data'])
+        if not is_valid:
+            return handle_validation_error(field_errors)
+        
+        rec = RecommendationService.save_recommendation(
+            user_id=current_user.id,
+            project_description=data['project_description'],
+            recommendation_data=data['recommendation_data'],
+            project_type=data.get('project_type'),
+            total_estimated_cost=data.get('total_estimated_cost')
+        )
+        
+        return jsonify({
+            'success': True,
+            'recommendation': {
+                'id': rec.id,
+                'project_type': rec.project_type,
+                'project_description': rec.project_description,
+                'total_estimated_cost': float(rec.total_estimated_cost) if rec.total_estimated_cost else None,
+                'recommendation_data': rec.recommendation_data,
+                'is_saved': True,
+                'user_id': rec.user_id,
+                'created_at': rec.created_at.isoformat() if rec.created_at else None,
+                'updated_at': rec.updated_at.isoformat() if rec.updated_at else None,
+            }
+        }), 201
+    except Exception as e:
+        return handle_api_error(e)
+
+
 # ============================================================
 # Address Book API Endpoints
 # ============================================================
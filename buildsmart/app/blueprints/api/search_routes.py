@@ -9,9 +9,11 @@ This module provides enhanced search functionality including:
 from flask import jsonify, request
 from flask_login import login_required, current_user
 from app.blueprints.api import api_bp
-from app.models import SearchHistory, TrendingSearch, Product, Shop
+from app.models import SearchHistory, TrendingSearch
 from app.extensions import db
 from app.utils.error_handlers import handle_api_error
+from app.services.suggestion_service import SuggestionService
+from app.utils.response_cache import cache_public
 from datetime import datetime, timedelta
 from sqlalchemy import func, desc
 
@@ -35,50 +37,8 @@ def get_search_suggestions():
                 'trending': []
             }), 200
         
-        suggestions = []
-        
-        # Get suggestions from product names
-        if search_type == 'products':
-            products = Product.query.filter(
-                Product.name.ilike(f'%{query}%')
-            ).limit(limit).all()
-            
-            suggestions = [{
-                'text': p.name,
-                'type': 'product',
-                'id': p.id
-            } for p in products]
-        
-        # Get suggestions from shop names
-        elif search_type == 'shops':
-            shops = Shop.query.filter(
-                Shop.name.ilike(f'%{query}%')
-            ).limit(limit).all()
-            
-            suggestions = [{
-                'text': s.name,
-                'type': 'shop',
-                'id': s.id
-            } for s in shops]
-        
-        # Get trending searches
-        trending = TrendingSearch.query.filter(
-            TrendingSearch.query.ilike(f'%{query}%'),
-            TrendingSearch.search_type == search_type
-        ).order_by(
-            desc(TrendingSearch.count),
-            desc(TrendingSearch.last_searched)
-        ).limit(5).all()
-        
-        trending_list = [{
-            'text': t.query,
-            'count': t.count
-        } for t in trending]
-        
-        return jsonify({
-            'suggestions': suggestions,
-            'trending': trending_list
-        }), 200
+        # Served from the in-memory suggestion index; no database queries
+        return jsonify(SuggestionService.suggest(query, search_type, limit=limit)), 200
         
     except Exception as e:
         return handle_api_error(e)
@@ -157,6 +117,7 @@ def delete_search_history(history_id):
 
 
 @api_bp.route('/search/trending', methods=['GET'])
+@cache_public(timeout=120)
 def get_trending_searches():
     """
     Get trending searches.
@@ -171,7 +132,8 @@ def get_trending_searches():
         
         cutoff_date = datetime.utcnow() - timedelta(days=days)
         
-        trending = TrendingSearch.query.filter(
+        # TrendingSearch.query is the column, not the query property
+        trending = db.session.query(TrendingSearch).filter(
             TrendingSearch.search_type == search_type,
             TrendingSearch.last_searched >= cutoff_date
         ).order_by(
@@ -3,6 +3,8 @@ from flask_login import login_required, current_user
 from app.blueprints.main import main_bp
 from app.models import Shop, Product, Service
 from app.extensions import db
+from app.services.search_service import SearchService
+from app.services.catalog_service import CatalogService
 
 
 @main_bp.route('/')
@@ -16,15 +18,13 @@ def index():
     Returns:
         str: Rendered home page template with featured content
     """
-    # Get featured shops and products
-    featured_shops = Shop.query.filter_by(is_verified=True, is_active=True).limit(6).all()
-    featured_products = Product.query.filter_by(is_available=True).limit(8).all()
-    featured_services = Service.query.filter_by(is_available=True).limit(6).all()
+    # Get featured shops and products (ids are cached)
+    featured = CatalogService.get_featured()
     
     return render_template('home.html', 
-                         featured_shops=featured_shops,
-                         featured_products=featured_products,
-                         featured_services=featured_services)
+                         featured_shops=featured['shops'],
+                         featured_products=featured['products'],
+                         featured_services=featured['services'])
 
 
 @main_bp.route('/about')
@@ -69,22 +69,22 @@ def search():
     
     if query:
         # Search products
-        products = Product.query.filter(
-            (Product.name.ilike(f'%{query}%')) | 
-            (Product.description.ilike(f'%{query}%'))
-        ).filter_by(is_available=True).limit(20).all()
+        products_query, relevance = SearchService.apply_text_search(
+            Product.query.filter_by(is_available=True), Product, query
+        )
+        products = products_query.order_by(relevance.desc(), Product.id).limit(20).all()
         
         # Search shops
-        shops = Shop.query.filter(
-            (Shop.name.ilike(f'%{query}%')) | 
-            (Shop.description.ilike(f'%{query}%'))
-        ).filter_by(is_active=True).limit(10).all()
+        shops_query, relevance = SearchService.apply_text_search(
+            Shop.query.filter_by(is_active=True), Shop, query
+        )
+        shops = shops_query.order_by(relevance.desc(), Shop.id).limit(10).all()
         
         # Search services
-        services = Service.query.filter(
-            (Service.title.ilike(f'%{query}%')) | 
-            (Service.description.ilike(f'%{query}%'))
-        ).filter_by(is_available=True).limit(10).all()
+        services_query, relevance = SearchService.apply_text_search(
+            Service.query.filter_by(is_available=True), Service, query
+        )
+        services = services_query.order_by(relevance.desc(), Service.id).limit(10).all()
     
     return render_template('search.html', 
                          query=query,
@@ -3,7 +3,7 @@ from flask_login import login_required, current_user
 from app.blueprints.user import user_bp
 from app.models import User, Order, Recommendation, Comparison, Cart, Shop, Address
 from app.extensions import db
-from app.ai.recommender import generate_full_recommendation
+from app.services.recommendation_service import RecommendationService
 
 
 @user_bp.route('/dashboard')
@@ -194,10 +194,10 @@ def get_recommendation():
         return jsonify({'error': 'Project description required'}), 400
     
     try:
-        recommendation = generate_full_recommendation(
+        recommendation = RecommendationService.get_recommendation(
             user_id=current_user.id,
             project_description=data['project_description'],
-            project_type=data.get('project_type', '2_bedroom_house'),
+            project_type=data.get('project_type'),
             custom_specs=data.get('custom_specs', {}),
             user_lat=current_user.latitude,
             user_lon=current_user.longitude
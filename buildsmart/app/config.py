@@ -50,7 +50,60 @@ class Config:
     CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')  # simple, redis, filesystem
     CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
     CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 300))  # 5 minutes
-    CACHE_KEY_PREFIX = 'buildsmart:'
+    # Bump to start from an empty key namespace when cached data changes shape
+    CACHE_VERSION = os.environ.get('CACHE_VERSION', '1')
+    CACHE_KEY_PREFIX = f'buildsmart:v{CACHE_VERSION}:'
+    CACHE_REFRESH_ASYNC = True  # refresh stale entries in a background thread
+    
+    # Cached value encoding (see app.utils.cache_serializer)
+    CACHE_SERIALIZER = os.environ.get('CACHE_SERIALIZER', 'json')  # json, msgpack, pickle
+    CACHE_COMPRESSION = os.environ.get('CACHE_COMPRESSION', 'zlib') or None  # zlib, zstd
+    CACHE_COMPRESS_THRESHOLD = int(os.environ.get('CACHE_COMPRESS_THRESHOLD', 1024))  # bytes
+    
+    # Per-worker in-memory cache (L1) in front of the cache backend (L2)
+    # auto: only with Redis, whose pub/sub tells other workers to drop their L1 copies
+    CACHE_L1_ENABLED = {'true': True, 'false': False}.get(os.environ.get('CACHE_L1_ENABLED', 'auto').lower(), 'auto')
+    CACHE_L1_MAX_BYTES = int(os.environ.get('CACHE_L1_MAX_BYTES', 32 * 1024 * 1024))
+    CACHE_L1_MAX_ITEM_BYTES = int(os.environ.get('CACHE_L1_MAX_ITEM_BYTES', 256 * 1024))
+    CACHE_L1_TTL = int(os.environ.get('CACHE_L1_TTL', 30))  # seconds; bounds staleness
+    CACHE_INVALIDATION_CHANNEL = 'buildsmart:cache-invalidation'
+    
+    # Cache warm-up (flask cache-warm, and optionally in each worker at startup)
+    CACHE_WARM_ON_STARTUP = os.environ.get('CACHE_WARM_ON_STARTUP', 'false').lower() == 'true'
+    CACHE_WARM_WORKERS = int(os.environ.get('CACHE_WARM_WORKERS', 4))  # tasks run at once
+    
+    # Cache metrics, served in Prometheus format at /admin/metrics
+    CACHE_METRICS_ENABLED = os.environ.get('CACHE_METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # bearer token for scrapers (admins can always read)
+    
+    # Search suggestion index shared across workers (None = per-worker only)
+    SUGGESTION_SNAPSHOT_PATH = os.environ.get(
+        'SUGGESTION_SNAPSHOT_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'suggestions.jsonl')
+    )
+    SUGGESTION_SYNC_INTERVAL = float(os.environ.get('SUGGESTION_SYNC_INTERVAL', 2.0))  # seconds
+    
+    # Fitted project description matching model (flask fit-text-model)
+    TEXT_MODEL_PATH = os.environ.get(
+        'TEXT_MODEL_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'text_model')
+    )
+    
+    # Search analytics are buffered in memory and written in batches
+    SEARCH_ANALYTICS_ASYNC = True
+    SEARCH_ANALYTICS_BUFFER_SIZE = int(os.environ.get('SEARCH_ANALYTICS_BUFFER_SIZE', 10000))
+    SEARCH_ANALYTICS_BATCH_SIZE = int(os.environ.get('SEARCH_ANALYTICS_BATCH_SIZE', 500))
+    SEARCH_ANALYTICS_FLUSH_INTERVAL = float(os.environ.get('SEARCH_ANALYTICS_FLUSH_INTERVAL', 2.0))  # seconds
+    
+    # Columnar analytics: order facts exported by month (flask analytics-export)
+    ANALYTICS_FACTS_PATH = os.environ.get(
+        'ANALYTICS_FACTS_PATH',
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'analytics_facts')
+    )
+    ANALYTICS_ENGINE = os.environ.get('ANALYTICS_ENGINE', 'rollups')  # rollups, facts (product/shop/category rankings)
+    
+    # Keep analytics rollups current as orders change (in the same transaction)
+    ANALYTICS_INCREMENTAL_ROLLUPS = os.environ.get('ANALYTICS_INCREMENTAL_ROLLUPS', 'true').lower() == 'true'
     
     # Database configuration
     @staticmethod
@@ -90,6 +143,14 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite:///:memory:')
     WTF_CSRF_ENABLED = False
+    SUGGESTION_SNAPSHOT_PATH = None
+    TEXT_MODEL_PATH = None
+    SEARCH_ANALYTICS_ASYNC = False  # flushed explicitly by tests
+    CACHE_REFRESH_ASYNC = False
+    CACHE_L1_ENABLED = False  # enabled explicitly by tests
+    CACHE_WARM_ON_STARTUP = False
+    ANALYTICS_INCREMENTAL_ROLLUPS = False  # enabled explicitly by tests
+    ANALYTICS_FACTS_PATH = None
 
 # Configuration mapping
 config = {
@@ -12,8 +12,17 @@ class AnalyticsMetric(db.Model):
     Model for storing analytics metrics.
     
     This model stores pre-calculated metrics for faster reporting.
+    
+    Daily rollups (see AnalyticsRollupService) set ``dimension`` to a key
+    naming what the row aggregates (``all``, ``shop:3``, ``product:12``,
+    ...), which is unique per metric and day. Metrics stored ad hoc leave
+    it empty.
     """
     __tablename__ = 'analytics_metrics'
+    __table_args__ = (
+        db.UniqueConstraint('metric_type', 'metric_date', 'metric_name', 'dimension',
+                            name='unique_analytics_metric_rollup'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     metric_type = db.Column(db.String(50), nullable=False, index=True)  # sales, orders, users, products, etc.
@@ -25,6 +34,8 @@ class AnalyticsMetric(db.Model):
     shop_id = db.Column(db.Integer, db.ForeignKey('shops.id'), nullable=True, index=True)
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=True, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=True, index=True)
+    dimension = db.Column(db.String(100), nullable=True)  # rollup key, e.g. shop:3
     
     # Metadata
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -34,6 +45,7 @@ class AnalyticsMetric(db.Model):
     shop = db.relationship('Shop', backref='analytics_metrics', lazy='select')
     category = db.relationship('Category', backref='analytics_metrics', lazy='select')
     user = db.relationship('User', backref='analytics_metrics', lazy='select')
+    product = db.relationship('Product', backref='analytics_metrics', lazy='select')
     
     def __repr__(self):
         return f'<AnalyticsMetric {self.metric_type}:{self.metric_name}={self.metric_value}>'
@@ -49,6 +61,8 @@ class AnalyticsMetric(db.Model):
             'shop_id': self.shop_id,
             'category_id': self.category_id,
             'user_id': self.user_id,
+            'product_id': self.product_id,
+            'dimension': self.dimension,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
@@ -16,6 +16,7 @@ class Recommendation(db.Model):
         total_estimated_cost (Decimal): Total estimated project cost
         recommendation_data (JSON): Full recommendation data as JSON
         is_saved (bool): Whether recommendation is saved by user
+        spec_hash (str): Hash of the normalized project spec and location cell
         created_at (datetime): Recommendation creation timestamp
         updated_at (datetime): Last update timestamp
         user_id (int): Foreign key to User
@@ -31,6 +32,7 @@ class Recommendation(db.Model):
     total_estimated_cost = db.Column(db.Numeric(12, 2))
     recommendation_data = db.Column(db.JSON, nullable=False)  # Store the full recommendation as JSON
     is_saved = db.Column(db.Boolean, default=False)
+    spec_hash = db.Column(db.String(64), index=True)  # see RecommendationService.spec_hash
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -1,6 +1,10 @@
 from datetime import datetime
+from sqlalchemy import and_, or_, event
 from app.extensions import db
-import math
+from app.utils.geo import (
+    haversine_km, bounding_box, encode_geohash, covering_geohashes,
+    GEOHASH_PRECISION, GEOHASH_PREFIX_UPPER
+)
 
 
 class Shop(db.Model):
@@ -20,6 +24,7 @@ class Shop(db.Model):
         email (str): Contact email
         latitude (float): GPS latitude for location services
         longitude (float): GPS longitude for location services
+        geohash (str): Geohash of the coordinates, used as a spatial index
         rating (float): Average customer rating (0.0-5.0)
         total_reviews (int): Total number of reviews
         is_verified (bool): Whether shop is verified by platform
@@ -43,6 +48,7 @@ class Shop(db.Model):
     email = db.Column(db.String(120))
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
+    geohash = db.Column(db.String(GEOHASH_PRECISION), index=True)
     rating = db.Column(db.Float, default=0.0)
     total_reviews = db.Column(db.Integer, default=0)
     is_verified = db.Column(db.Boolean, default=False)
@@ -71,20 +77,50 @@ class Shop(db.Model):
         Returns:
             float: Distance in kilometers
         """
-        # Haversine formula
-        R = 6371  # Earth's radius in kilometers
+        return haversine_km(self.latitude, self.longitude, lat, lon)
+    
+    def update_geohash(self):
+        """
+        Recompute the stored geohash from the current coordinates.
+        """
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+        else:
+            self.geohash = None
+    
+    @classmethod
+    def within_radius_filter(cls, lat, lon, radius_km):
+        """
+        Build a SQL prefilter for shops that may lie within a radius.
+        
+        Combines geohash cell ranges (served by the geohash index) with a
+        latitude/longitude bounding box. Every shop within the radius
+        matches; callers apply the exact Haversine distance to the
+        (small) candidate set.
         
-        lat1_rad = math.radians(self.latitude)
-        lat2_rad = math.radians(lat)
-        delta_lat = math.radians(lat - self.latitude)
-        delta_lon = math.radians(lon - self.longitude)
+        Args:
+            lat (float): Center latitude in decimal degrees
+            lon (float): Center longitude in decimal degrees
+            radius_km (float): Radius in kilometers
+            
+        Returns:
+            SQLAlchemy boolean clause
+        """
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        clause = and_(
+            cls.latitude.between(min_lat, max_lat),
+            cls.longitude.between(min_lon, max_lon)
+        )
         
-        a = (math.sin(delta_lat / 2) ** 2 + 
-             math.cos(lat1_rad) * math.cos(lat2_rad) * 
-             math.sin(delta_lon / 2) ** 2)
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+        cells = covering_geohashes(lat, lon, radius_km)
+        if cells:
+            cell_ranges = [
+                and_(cls.geohash >= cell, cls.geohash < cell + GEOHASH_PREFIX_UPPER)
+                for cell in sorted(cells)
+            ]
+            clause = and_(or_(*cell_ranges), clause)
         
-        return R * c
+        return clause
     
     def total_products_count(self):
         """
@@ -100,3 +136,10 @@ class Shop(db.Model):
     
     def __repr__(self):
         return f'<Shop {self.name}>'
+
+
+@event.listens_for(Shop, 'before_insert')
+@event.listens_for(Shop, 'before_update')
+def _sync_shop_geohash(mapper, connection, target):
+    """Keep the geohash index column in sync with the coordinates."""
+    target.update_geohash()
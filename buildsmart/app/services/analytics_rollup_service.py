@@ -0,0 +1,611 @@
+"""
+Daily analytics rollups.
+
+Orders of closed days are aggregated into ``AnalyticsMetric`` rows so
+reports over long ranges read a few rows per day instead of every order.
+Each row holds one measure of one day at one grain:
+
+- ``day``: platform totals (dimension ``all``)
+- ``shop``: per shop (``shop:<id>``)
+- ``customer``: per shop and customer (``shop:<id>:user:<id>``), so
+  distinct customers can be counted over any range
+- ``customer_month``: the same per calendar month (``metric_date`` is the
+  first of the month), so counting them over long ranges reads a row per
+  customer and month rather than per day (see ``sum_customer_metrics``)
+- ``product``: per product of paid orders (``product:<id>``)
+- ``category``: per category of paid orders (``category:<id>``)
+
+Order grains (day, shop) have ``orders``, ``paid_orders``,
+``delivered_orders``, ``sales`` (paid), ``discounts``, ``taxes`` and
+``refunds`` (completed refund returns, on the day of their order);
+customers (both grains) have ``orders`` and ``paid_orders``; products have
+``quantity``, ``revenue`` and ``order_items``; categories have
+``quantity``, ``revenue`` and ``orders``. Zero measures are not stored.
+
+``rollup()`` (``flask analytics-rollup``, run nightly) aggregates every
+closed day after the watermark (a bookkeeping row recording the last
+rolled-up day) and advances it. Reads
+(``sum_metrics``) take days up to the watermark from the rollups and
+aggregate the days after it, normally just today, from the orders.
+Orders changed after their day was rolled up are picked up by rolling
+recent days up again (``rollup(rebuild_days=...)``).
+
+With ``ANALYTICS_INCREMENTAL_ROLLUPS`` the rows are also kept current as
+orders change: session hooks (``register_rollup_maintenance``) aggregate
+the affected orders before and after each flush and add the difference
+to the rows with UPSERT increments in the same transaction, so placing,
+paying, cancelling or deleting an order, editing its items and completing
+a return update the rollups when they commit, and rolled-back changes
+leave them untouched. The changed orders are locked (``SELECT ... FOR
+UPDATE``) before their old contribution is read, so concurrent changes to
+one order apply one after the other instead of both subtracting the same
+old state; on MySQL this needs READ COMMITTED, as REPEATABLE READ keeps
+reading the snapshot from before the lock. ``rollup()`` then also rebuilds
+today and marks the watermark incremental, after which reads take every
+day from the rollups.
+Bulk ``UPDATE``/``DELETE`` statements bypass the hooks, as do products
+moving to another shop or category; the nightly rebuild of recent days
+corrects those.
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from flask import current_app, has_app_context
+from sqlalchemy import case, event, func
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+from app.extensions import db
+from app.models import AnalyticsMetric, Order, OrderItem, Product, ReturnRequest
+from app.utils.date_ranges import bucket_date, date_bucket, in_date_range
+
+GRAIN_DAY = 'day'
+GRAIN_SHOP = 'shop'
+GRAIN_CUSTOMER = 'customer'
+GRAIN_PRODUCT = 'product'
+GRAIN_CATEGORY = 'category'
+GRAIN_CUSTOMER_MONTH = 'customer_month'
+GRAINS = (GRAIN_DAY, GRAIN_SHOP, GRAIN_CUSTOMER, GRAIN_PRODUCT, GRAIN_CATEGORY, GRAIN_CUSTOMER_MONTH)
+
+ORDER_MEASURES = ('orders', 'paid_orders', 'delivered_orders', 'sales', 'discounts', 'taxes')
+
+# Columns identifying a rollup row (unique_analytics_metric_rollup)
+ROW_KEY = ('metric_type', 'metric_date', 'metric_name', 'dimension')
+
+# metric_type/metric_name of the row recording the last rolled-up day;
+# its value is 1 when later days are maintained incrementally
+WATERMARK_TYPE = 'rollup'
+WATERMARK_NAME = 'watermark'
+
+# Days aggregated per query and transaction while rolling up
+BATCH_DAYS = 31
+
+
+def dimension_key(grain: str, shop_id: Optional[int] = None, user_id: Optional[int] = None,
+                  product_id: Optional[int] = None, category_id: Optional[int] = None) -> str:
+    """Get the dimension key of a rollup row."""
+    if grain == GRAIN_SHOP:
+        return f'shop:{shop_id}'
+    if grain in (GRAIN_CUSTOMER, GRAIN_CUSTOMER_MONTH):
+        return f'shop:{shop_id}:user:{user_id}'
+    if grain == GRAIN_PRODUCT:
+        return f'product:{product_id}'
+    if grain == GRAIN_CATEGORY:
+        return f'category:{category_id}'
+    return 'all'
+
+
+def _decimal(value) -> Decimal:
+    if value is None:
+        return Decimal('0')
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def _next_month(day: date) -> date:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def _row(grain: str, measure: str, day: date, value, **ids) -> Dict:
+    return {
+        'metric_type': grain,
+        'metric_name': measure,
+        'metric_date': day,
+        'metric_value': _decimal(value),
+        'dimension': dimension_key(grain, **ids),
+        'shop_id': ids.get('shop_id'),
+        'user_id': ids.get('user_id'),
+        'product_id': ids.get('product_id'),
+        'category_id': ids.get('category_id'),
+    }
+
+
+class AnalyticsRollupService:
+    """Service for building and reading daily analytics rollups."""
+
+    @staticmethod
+    def aggregate(start_date: Optional[date], end_date: Optional[date], grains: Iterable[str] = GRAINS,
+                  shop_id: Optional[int] = None, order_ids: Optional[Iterable[int]] = None) -> List[Dict]:
+        """
+        Aggregate orders into rollup rows (without storing them).
+
+        Runs one grouped query per grain (the day grain is derived from the
+        shop grain, plus one query for refunds). Monthly rows only cover
+        the orders inside the range.
+
+        Args:
+            start_date: First day (None with order_ids: any day)
+            end_date: Last day, inclusive
+            grains: Grains to aggregate
+            shop_id: Only aggregate orders (or products) of this shop
+            order_ids: Only aggregate these orders (their contribution to
+                the rollups, as used for incremental updates)
+
+        Returns:
+            Row dictionaries with AnalyticsMetric column names
+        """
+        grains = set(grains)
+        dialect = db.session.get_bind().dialect.name
+        day = date_bucket(Order.created_at, 'day', dialect)
+        orders = []
+        if start_date is not None:
+            orders.append(in_date_range(Order.created_at, start_date, end_date))
+        if order_ids is not None:
+            orders.append(Order.id.in_(list(order_ids)))
+        paid = Order.payment_status == 'paid'
+        rows = []
+
+        if grains & {GRAIN_DAY, GRAIN_SHOP}:
+            query = db.session.query(
+                day, Order.shop_id,
+                func.count(Order.id),
+                func.sum(case((paid, 1), else_=0)),
+                func.sum(case((Order.status == 'delivered', 1), else_=0)),
+                func.sum(case((paid, Order.total_amount), else_=0)),
+                func.sum(Order.discount_amount),
+                func.sum(Order.tax_amount)
+            ).filter(*orders)
+            refunds = db.session.query(
+                day, Order.shop_id, func.sum(ReturnRequest.refund_amount)
+            ).join(Order, ReturnRequest.order_id == Order.id).filter(
+                *orders, ReturnRequest.status == 'completed', ReturnRequest.return_type == 'refund'
+            )
+            if shop_id is not None:
+                query = query.filter(Order.shop_id == shop_id)
+                refunds = refunds.filter(Order.shop_id == shop_id)
+            by_shop = defaultdict(lambda: defaultdict(Decimal))
+            for order_day, order_shop_id, *values in query.group_by(day, Order.shop_id):
+                for measure, value in zip(ORDER_MEASURES, values):
+                    by_shop[(bucket_date(order_day), order_shop_id)][measure] += _decimal(value)
+            for order_day, order_shop_id, value in refunds.group_by(day, Order.shop_id):
+                by_shop[(bucket_date(order_day), order_shop_id)]['refunds'] += _decimal(value)
+
+            totals = defaultdict(lambda: defaultdict(Decimal))
+            for (order_day, order_shop_id), measures in by_shop.items():
+                for measure, value in measures.items():
+                    if GRAIN_SHOP in grains:
+                        rows.append(_row(GRAIN_SHOP, measure, order_day, value, shop_id=order_shop_id))
+                    totals[order_day][measure] += value
+            if GRAIN_DAY in grains:
+                for order_day, measures in totals.items():
+                    rows += [_row(GRAIN_DAY, measure, order_day, value) for measure, value in measures.items()]
+
+        for grain, period in ((GRAIN_CUSTOMER, day),
+                              (GRAIN_CUSTOMER_MONTH, date_bucket(Order.created_at, 'month', dialect))):
+            if grain not in grains:
+                continue
+            query = db.session.query(
+                period, Order.shop_id, Order.customer_id,
+                func.count(Order.id),
+                func.sum(case((paid, 1), else_=0))
+            ).filter(*orders)
+            if shop_id is not None:
+                query = query.filter(Order.shop_id == shop_id)
+            for order_period, order_shop_id, customer_id, order_count, paid_orders in query.group_by(
+                    period, Order.shop_id, Order.customer_id):
+                ids = {'shop_id': order_shop_id, 'user_id': customer_id}
+                order_period = bucket_date(order_period)
+                rows.append(_row(grain, 'orders', order_period, order_count, **ids))
+                rows.append(_row(grain, 'paid_orders', order_period, paid_orders, **ids))
+
+        if GRAIN_PRODUCT in grains:
+            query = db.session.query(
+                day, OrderItem.product_id, Product.shop_id, Product.category_id,
+                func.sum(OrderItem.quantity),
+                func.sum(OrderItem.total_price),
+                func.count(OrderItem.id)
+            ).join(Order, OrderItem.order_id == Order.id).join(
+                Product, OrderItem.product_id == Product.id
+            ).filter(*orders, paid)
+            if shop_id is not None:
+                query = query.filter(Product.shop_id == shop_id)
+            for order_day, product_id, product_shop_id, category_id, *values in query.group_by(
+                    day, OrderItem.product_id, Product.shop_id, Product.category_id):
+                ids = {'product_id': product_id, 'shop_id': product_shop_id, 'category_id': category_id}
+                order_day = bucket_date(order_day)
+                for measure, value in zip(('quantity', 'revenue', 'order_items'), values):
+                    rows.append(_row(GRAIN_PRODUCT, measure, order_day, value, **ids))
+
+        if GRAIN_CATEGORY in grains and shop_id is None:
+            query = db.session.query(
+                day, Product.category_id,
+                func.sum(OrderItem.quantity),
+                func.sum(OrderItem.total_price),
+                func.count(func.distinct(OrderItem.order_id))
+            ).join(Order, OrderItem.order_id == Order.id).join(
+                Product, OrderItem.product_id == Product.id
+            ).filter(*orders, paid, Product.category_id.isnot(None))
+            for order_day, category_id, *values in query.group_by(day, Product.category_id):
+                order_day = bucket_date(order_day)
+                for measure, value in zip(('quantity', 'revenue', 'orders'), values):
+                    rows.append(_row(GRAIN_CATEGORY, measure, order_day, value, category_id=category_id))
+
+        return [row for row in rows if row['metric_value'] != 0]
+
+    @staticmethod
+    def get_watermark() -> Optional[date]:
+        """Get the last day whose orders are rolled up (None if nothing is)."""
+        row = AnalyticsRollupService._watermark_row()
+        return row[0] if row else None
+
+    @staticmethod
+    def is_incremental() -> bool:
+        """Check whether the days after the watermark are kept current by the order hooks."""
+        row = AnalyticsRollupService._watermark_row()
+        return bool(row and row[1] == 1 and incremental_rollups_enabled())
+
+    @staticmethod
+    def _watermark_row() -> Optional[Tuple[date, Decimal]]:
+        return db.session.query(AnalyticsMetric.metric_date, AnalyticsMetric.metric_value).filter(
+            AnalyticsMetric.metric_type == WATERMARK_TYPE,
+            AnalyticsMetric.metric_name == WATERMARK_NAME
+        ).first()
+
+    @staticmethod
+    def split_range(start_date: date, end_date: date) -> Tuple[Optional[Tuple[date, date]],
+                                                               Optional[Tuple[date, date]]]:
+        """
+        Split a range of days into the part answered by rollups and the live part.
+
+        Returns:
+            (rolled, live): (first, last) day pairs, or None for an empty part
+        """
+        row = AnalyticsRollupService._watermark_row()
+        watermark = row[0] if row else None
+        if watermark is not None and row[1] == 1 and incremental_rollups_enabled():
+            return (start_date, end_date), None
+        if watermark is None or start_date > watermark:
+            return None, (start_date, end_date)
+        if end_date <= watermark:
+            return (start_date, end_date), None
+        return (start_date, watermark), (watermark + timedelta(days=1), end_date)
+
+    @staticmethod
+    def rollup(until: Optional[date] = None, rebuild_days: int = 0) -> List[Tuple[date, date]]:
+        """
+        Roll up closed days after the watermark and advance it.
+
+        The first run backfills from the first order. Days are aggregated
+        in batches of BATCH_DAYS, each replacing that range's rollup rows
+        and committed on its own, so an interrupted run resumes where it
+        stopped.
+
+        With ANALYTICS_INCREMENTAL_ROLLUPS, rolling up to yesterday also
+        rebuilds today, which the order hooks keep current from then on,
+        and marks the watermark incremental.
+
+        Args:
+            until: Last day to roll up (default and maximum: yesterday)
+            rebuild_days: Also roll up again this many days up to the
+                watermark, to pick up late changes to their orders
+
+        Returns:
+            List of (first, last) day pairs rolled up
+        """
+        yesterday = date.today() - timedelta(days=1)
+        until = min(until or yesterday, yesterday)
+        watermark = AnalyticsRollupService.get_watermark()
+        if watermark is None:
+            first_order = db.session.query(func.min(Order.created_at)).scalar()
+            start = first_order.date() if first_order else until + timedelta(days=1)
+        else:
+            start = watermark + timedelta(days=1) - timedelta(days=max(rebuild_days, 0))
+
+        batches = []
+        while start <= until:
+            end = min(start + timedelta(days=BATCH_DAYS - 1), until)
+            AnalyticsRollupService._replace(start, end)
+            if watermark is None or end > watermark:
+                watermark = end
+                AnalyticsRollupService._set_watermark(watermark)
+            db.session.commit()
+            batches.append((start, end))
+            start = end + timedelta(days=1)
+
+        incremental = incremental_rollups_enabled() and until == yesterday
+        if incremental:
+            AnalyticsRollupService._replace(date.today(), date.today())
+        # Without orders before today every closed day is trivially rolled up
+        AnalyticsRollupService._set_watermark(watermark or until, incremental=incremental)
+        db.session.commit()
+        return batches
+
+    @staticmethod
+    def _replace(start_date: date, end_date: date) -> None:
+        daily = [grain for grain in GRAINS if grain != GRAIN_CUSTOMER_MONTH]
+        first_month, last_month = start_date.replace(day=1), end_date.replace(day=1)
+        db.session.query(AnalyticsMetric).filter(
+            AnalyticsMetric.metric_type.in_(daily),
+            AnalyticsMetric.metric_date >= start_date,
+            AnalyticsMetric.metric_date <= end_date,
+            AnalyticsMetric.dimension.isnot(None)
+        ).delete(synchronize_session=False)
+        # Monthly rows are rebuilt whole for every month the range touches
+        db.session.query(AnalyticsMetric).filter(
+            AnalyticsMetric.metric_type == GRAIN_CUSTOMER_MONTH,
+            AnalyticsMetric.metric_date >= first_month,
+            AnalyticsMetric.metric_date <= last_month,
+            AnalyticsMetric.dimension.isnot(None)
+        ).delete(synchronize_session=False)
+        rows = AnalyticsRollupService.aggregate(start_date, end_date, grains=daily)
+        rows += AnalyticsRollupService.aggregate(first_month, _next_month(last_month) - timedelta(days=1),
+                                                 grains=[GRAIN_CUSTOMER_MONTH])
+        if rows:
+            now = datetime.utcnow()
+            db.session.execute(AnalyticsMetric.__table__.insert(),
+                               [dict(row, created_at=now, updated_at=now) for row in rows])
+
+    @staticmethod
+    def _set_watermark(day: date, incremental: bool = False) -> None:
+        db.session.query(AnalyticsMetric).filter(
+            AnalyticsMetric.metric_type == WATERMARK_TYPE,
+            AnalyticsMetric.metric_name == WATERMARK_NAME
+        ).delete(synchronize_session=False)
+        db.session.add(AnalyticsMetric(
+            metric_type=WATERMARK_TYPE, metric_name=WATERMARK_NAME, metric_value=1 if incremental else 0,
+            metric_date=day, dimension='all'
+        ))
+
+    @staticmethod
+    def sum_metrics(grain: str, start_date: date, end_date: date, group_by: Sequence[str] = (),
+                    measures: Optional[Sequence[str]] = None,
+                    **filters) -> Dict[tuple, Dict[str, Decimal]]:
+        """
+        Sum rollup measures over a range of days.
+
+        Days up to the watermark (every day, when the rollups are
+        maintained incrementally) are summed from the rollup rows, later
+        days are aggregated from the orders.
+
+        Args:
+            grain: Grain to read (GRAIN_DAY, GRAIN_SHOP, ...)
+            start_date: First day
+            end_date: Last day, inclusive
+            group_by: Row fields to group by (e.g. 'metric_date', 'shop_id',
+                'product_id'); empty for a grand total
+            measures: Measures to read (default: all)
+            **filters: Row fields to match, e.g. shop_id=3 or shop_id=[3, 4]
+
+        Returns:
+            Dictionary of group values (a tuple in group_by order) to
+            {measure: total}
+        """
+        totals = defaultdict(lambda: defaultdict(Decimal))
+        rolled, live = AnalyticsRollupService.split_range(start_date, end_date)
+
+        if rolled:
+            AnalyticsRollupService._sum_rows(totals, grain, rolled[0], rolled[1], group_by, measures, filters)
+
+        if live:
+            shop_id = filters.get('shop_id')
+            rows = AnalyticsRollupService.aggregate(
+                live[0], live[1], grains=[grain], shop_id=shop_id if isinstance(shop_id, int) else None
+            )
+            for row in rows:
+                if measures and row['metric_name'] not in measures:
+                    continue
+                if not all(row[name] in value if isinstance(value, (list, tuple, set)) else row[name] == value
+                           for name, value in filters.items()):
+                    continue
+                totals[tuple(row[name] for name in group_by)][row['metric_name']] += row['metric_value']
+
+        return {keys: dict(measures_) for keys, measures_ in totals.items()}
+
+    @staticmethod
+    def sum_customer_metrics(start_date: date, end_date: date, group_by: Sequence[str] = (),
+                             measures: Optional[Sequence[str]] = None,
+                             **filters) -> Dict[tuple, Dict[str, Decimal]]:
+        """
+        Sum per-customer measures over a range of days.
+
+        Gives the same totals as ``sum_metrics(GRAIN_CUSTOMER, ...)``, but
+        whole calendar months in the rolled-up part of the range are read
+        from the monthly rows; only the days before the first and after the
+        last whole month are read per day. A year of distinct customers
+        costs a row per customer, shop, month and measure rather than per
+        day the customer ordered. That still grows with the number of
+        customers; unlike a distinct-count sketch it stays exact and can be
+        kept current by the incremental deltas.
+
+        Args:
+            start_date: First day
+            end_date: Last day, inclusive
+            group_by: Row fields to group by, e.g. ('shop_id', 'user_id')
+            measures: Measures to read (default: all)
+            **filters: Row fields to match, e.g. shop_id=[3, 4]
+
+        Returns:
+            Dictionary of group values (a tuple in group_by order) to
+            {measure: total}
+        """
+        rolled, _ = AnalyticsRollupService.split_range(start_date, end_date)
+        first = last = None
+        if rolled:
+            first = rolled[0] if rolled[0].day == 1 else _next_month(rolled[0])
+            last = rolled[1] if _next_month(rolled[1]) - timedelta(days=1) == rolled[1] \
+                else rolled[1].replace(day=1) - timedelta(days=1)
+        if first is None or first > last:
+            return AnalyticsRollupService.sum_metrics(GRAIN_CUSTOMER, start_date, end_date, group_by,
+                                                      measures, **filters)
+
+        totals = defaultdict(lambda: defaultdict(Decimal))
+        AnalyticsRollupService._sum_rows(totals, GRAIN_CUSTOMER_MONTH, first, last, group_by, measures, filters)
+        for edge_start, edge_end in ((start_date, first - timedelta(days=1)), (last + timedelta(days=1), end_date)):
+            if edge_start > edge_end:
+                continue
+            edge = AnalyticsRollupService.sum_metrics(GRAIN_CUSTOMER, edge_start, edge_end, group_by,
+                                                      measures, **filters)
+            for keys, values in edge.items():
+                for measure, value in values.items():
+                    totals[keys][measure] += value
+        return {keys: dict(measures_) for keys, measures_ in totals.items()}
+
+    @staticmethod
+    def _sum_rows(totals: Dict, grain: str, start_date: date, end_date: date, group_by: Sequence[str],
+                  measures: Optional[Sequence[str]], filters: Dict) -> None:
+        columns = [getattr(AnalyticsMetric, name) for name in group_by]
+        query = db.session.query(
+            *columns, AnalyticsMetric.metric_name, func.sum(AnalyticsMetric.metric_value)
+        ).filter(
+            AnalyticsMetric.metric_type == grain,
+            AnalyticsMetric.metric_date >= start_date,
+            AnalyticsMetric.metric_date <= end_date,
+            AnalyticsMetric.dimension.isnot(None)
+        )
+        if measures:
+            query = query.filter(AnalyticsMetric.metric_name.in_(measures))
+        for name, value in filters.items():
+            column = getattr(AnalyticsMetric, name)
+            query = query.filter(column.in_(value) if isinstance(value, (list, tuple, set)) else column == value)
+        for *keys, measure, value in query.group_by(*columns, AnalyticsMetric.metric_name):
+            totals[tuple(keys)][measure] += _decimal(value)
+
+
+def incremental_rollups_enabled() -> bool:
+    """Check whether ANALYTICS_INCREMENTAL_ROLLUPS is on for the current app."""
+    return has_app_context() and bool(current_app.config.get('ANALYTICS_INCREMENTAL_ROLLUPS'))
+
+
+# --- incremental maintenance -------------------------------------------------
+
+_FLUSH_KEY = 'analytics_rollup_flush'
+
+
+def _order_of(instance) -> Tuple[Optional[int], Optional[Order]]:
+    if isinstance(instance, Order):
+        return instance.id, instance
+    if isinstance(instance, (OrderItem, ReturnRequest)):
+        return instance.order_id, instance.order if instance.order_id is None else None
+    return None, None
+
+
+def _contributions(order_ids: Iterable[int]) -> Dict[tuple, Dict]:
+    rows = AnalyticsRollupService.aggregate(None, None, order_ids=order_ids)
+    return {tuple(row[column] for column in ROW_KEY): row for row in rows}
+
+
+def _lock_orders(order_ids: Iterable[int]) -> None:
+    # Wait for transactions changing the same orders (in id order, to avoid
+    # deadlocks); SQLite does not render FOR UPDATE but serializes writers
+    db.session.query(Order.id).filter(Order.id.in_(list(order_ids))).order_by(
+        Order.id).with_for_update().all()
+
+
+def _collect_orders(session, flush_context, instances):
+    session.info.pop(_FLUSH_KEY, None)
+    if not incremental_rollups_enabled():
+        return
+
+    dirty = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    order_ids, orders = set(), []
+    for instance in list(session.new) + dirty + list(session.deleted):
+        order_id, order = _order_of(instance)
+        if order_id is not None:
+            order_ids.add(order_id)
+        elif order is not None:
+            # New order: it gets its id during the flush
+            orders.append(order)
+    if not order_ids and not orders:
+        return
+
+    # What the orders add to the rollups before the flush changes them
+    before = {}
+    if order_ids:
+        _lock_orders(order_ids)
+        before = _contributions(order_ids)
+    session.info[_FLUSH_KEY] = (before, order_ids, orders)
+
+
+def _apply_order_deltas(session, flush_context):
+    pending = session.info.pop(_FLUSH_KEY, None)
+    if pending is None:
+        return
+
+    before, order_ids, orders = pending
+    order_ids = order_ids | {order.id for order in orders if order.id is not None}
+    after = _contributions(order_ids)
+    deltas = []
+    for key in before.keys() | after.keys():
+        value = (after[key]['metric_value'] if key in after else 0) - \
+            (before[key]['metric_value'] if key in before else 0)
+        if value:
+            deltas.append(dict(after.get(key) or before[key], metric_value=value))
+    if deltas:
+        _upsert_deltas(deltas)
+
+
+def _upsert_deltas(rows: List[Dict]) -> None:
+    table = AnalyticsMetric.__table__
+    dialect = db.session.get_bind().dialect.name
+    now = datetime.utcnow()
+    rows = [dict(row, created_at=now, updated_at=now) for row in rows]
+
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = dialect_insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[column] for column in ROW_KEY],
+            set_={
+                'metric_value': table.c.metric_value + statement.excluded.metric_value,
+                'updated_at': statement.excluded.updated_at,
+            }
+        )
+        db.session.execute(statement)
+    elif dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table).values(rows)
+        statement = statement.on_duplicate_key_update(
+            metric_value=table.c.metric_value + statement.inserted.metric_value,
+            updated_at=statement.inserted.updated_at,
+        )
+        db.session.execute(statement)
+    else:
+        for row in rows:
+            updated = db.session.execute(
+                table.update().where(*[table.c[column] == row[column] for column in ROW_KEY]).values(
+                    metric_value=table.c.metric_value + row['metric_value'], updated_at=now
+                )
+            ).rowcount
+            if not updated:
+                db.session.execute(table.insert().values(row))
+
+
+def _discard_flush(session):
+    session.info.pop(_FLUSH_KEY, None)
+
+
+_registered = False
+
+
+def register_rollup_maintenance() -> None:
+    """
+    Register session hooks that keep the rollups current as orders change.
+
+    The hooks do nothing unless ANALYTICS_INCREMENTAL_ROLLUPS is set.
+    """
+    global _registered
+    if _registered:
+        return
+    _registered = True
+
+    event.listen(Session, 'before_flush', _collect_orders)
+    event.listen(Session, 'after_flush', _apply_order_deltas)
+    event.listen(Session, 'after_rollback', _discard_flush)
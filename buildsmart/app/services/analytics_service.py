@@ -3,94 +3,123 @@ Analytics service for data aggregation and reporting.
 
 This service provides methods for generating analytics data,
 creating reports, and aggregating metrics.
+
+Date ranges are inclusive ranges of days, filtered as half-open
+``created_at`` windows so the ``created_at`` indexes stay usable (see
+app.utils.date_ranges). Order figures are read from daily rollups for
+days that are rolled up and aggregated from the orders for the rest,
+normally just today (see AnalyticsRollupService), so reports over long
+ranges cost the same however many orders they cover. With
+``ANALYTICS_ENGINE = 'facts'`` the product, shop and category rankings
+are grouped from exported order facts instead (see OrderFactsService).
 """
-from datetime import datetime, timedelta, date
+from datetime import date
 from decimal import Decimal
 from typing import Dict, List, Optional, Tuple
-from sqlalchemy import func, and_, or_
+from sqlalchemy import func
 from app.extensions import db
-from app.models import (
-    Order, OrderItem, Product, Shop, User, Category,
-    Payment, Review, AnalyticsMetric, OrderStatus
+from app.services.analytics_rollup_service import (
+    AnalyticsRollupService, GRAIN_DAY, GRAIN_SHOP, GRAIN_PRODUCT, GRAIN_CATEGORY
 )
+from app.services.cache_service import CacheService
+from app.services.order_facts_service import OrderFactsService
+from app.utils.date_ranges import in_date_range, period_start, resolve_date_range
+from app.models import Product, Shop, User, Category, AnalyticsMetric
+
+
+def _decimal(value) -> Decimal:
+    """Convert an aggregate (None, Decimal, int or float depending on the backend) to Decimal."""
+    if value is None:
+        return Decimal('0.00')
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def _ranked(totals: Dict[tuple, Dict[str, Decimal]], measure: str, limit: Optional[int] = None) -> List[Tuple]:
+    """Order sum_metrics() groups with a positive ``measure`` by it, largest first."""
+    ranked = sorted(
+        ((keys[0], measures) for keys, measures in totals.items()
+         if keys[0] is not None and measures.get(measure, 0) > 0),
+        key=lambda item: (-item[1][measure], item[0])
+    )
+    return ranked[:limit] if limit is not None else ranked
+
+
+def _names(*columns, ids, join: Optional[Tuple] = None) -> Dict:
+    """Look up ``columns`` (the first being the id) for ids, in one query."""
+    if not ids:
+        return {}
+    query = db.session.query(*columns)
+    if join is not None:
+        query = query.join(*join)
+    return {row[0]: row[1:] for row in query.filter(columns[0].in_(list(ids)))}
 
 
 class AnalyticsService:
     """Service for analytics and reporting operations."""
     
+    OVERVIEW_CACHE_TIMEOUT = 300  # 5 minutes; new or changed orders invalidate it sooner
+    
     @staticmethod
-    def get_sales_overview(start_date: Optional[date] = None, end_date: Optional[date] = None) -> Dict:
+    def get_sales_overview(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                           shop_id: Optional[int] = None) -> Dict:
         """
         Get sales overview statistics.
         
+        The API, the admin analytics page, reports and shop analytics all
+        use this. Results are cached per date range and shop, and tagged
+        ``analytics``, which order changes bump.
+        
         Args:
             start_date: Start date for filtering (default: 30 days ago)
             end_date: End date for filtering (default: today)
+            shop_id: Only count orders of this shop
         
         Returns:
             Dict containing sales statistics
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
-        
-        # Total sales
-        total_sales_query = db.session.query(func.sum(Order.total_amount)).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        
+        parts = ['sales_overview', start_date.isoformat(), end_date.isoformat()]
+        if shop_id is not None:
+            parts.append(f'shop{shop_id}')
+        cache_key = CacheService.get_cache_key(CacheService.PREFIX_ANALYTICS, *parts)
+        return CacheService.get_or_set(
+            cache_key, lambda: AnalyticsService._compute_sales_overview(start_date, end_date, shop_id),
+            timeout=AnalyticsService.OVERVIEW_CACHE_TIMEOUT, tags=[CacheService.PREFIX_ANALYTICS]
         )
-        total_sales = total_sales_query.scalar() or Decimal('0.00')
-        
-        # Total orders
-        total_orders = Order.query.filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date
-            )
-        ).count()
+    
+    @staticmethod
+    def _compute_sales_overview(start_date: date, end_date: date, shop_id: Optional[int] = None) -> Dict:
+        """
+        Compute sales overview statistics for a date range (uncached).
         
-        # Completed orders
-        completed_orders = Order.query.filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.status == OrderStatus.DELIVERED
-            )
-        ).count()
+        Rolled-up days are summed from the daily rollups; the remaining
+        days come from one scan of their orders using conditional
+        aggregation (``SUM(CASE ...)``, which unlike ``COUNT(*) FILTER``
+        works on every backend).
+        """
+        if shop_id is None:
+            totals = AnalyticsRollupService.sum_metrics(GRAIN_DAY, start_date, end_date)
+        else:
+            totals = AnalyticsRollupService.sum_metrics(GRAIN_SHOP, start_date, end_date, shop_id=shop_id)
+        measures = totals.get((), {})
+        
+        total_sales = _decimal(measures.get('sales'))
+        total_orders = int(measures.get('orders', 0))
+        completed_orders = int(measures.get('delivered_orders', 0))
         
         # Average order value
         avg_order_value = (total_sales / total_orders) if total_orders > 0 else Decimal('0.00')
         
-        # Discounts applied
-        total_discounts = db.session.query(func.sum(Order.discount_amount)).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.discount_amount.isnot(None)
-            )
-        ).scalar() or Decimal('0.00')
-        
-        # Taxes collected
-        total_taxes = db.session.query(func.sum(Order.tax_amount)).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.tax_amount.isnot(None)
-            )
-        ).scalar() or Decimal('0.00')
-        
         return {
             'total_sales': float(total_sales),
             'total_orders': total_orders,
             'completed_orders': completed_orders,
             'pending_orders': total_orders - completed_orders,
             'avg_order_value': float(avg_order_value),
-            'total_discounts': float(total_discounts),
-            'total_taxes': float(total_taxes),
+            'total_discounts': float(_decimal(measures.get('discounts'))),
+            'total_taxes': float(_decimal(measures.get('taxes'))),
+            'total_refunds': float(_decimal(measures.get('refunds'))),
             'start_date': start_date.isoformat(),
             'end_date': end_date.isoformat()
         }
@@ -109,39 +138,29 @@ class AnalyticsService:
         Returns:
             List of dictionaries with date and sales data
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
-        
-        # Build query based on group_by
-        if group_by == 'day':
-            date_format = func.date(Order.created_at)
-        elif group_by == 'week':
-            date_format = func.date_trunc('week', Order.created_at)
-        elif group_by == 'month':
-            date_format = func.date_trunc('month', Order.created_at)
-        else:
-            date_format = func.date(Order.created_at)
-        
-        results = db.session.query(
-            date_format.label('period'),
-            func.sum(Order.total_amount).label('sales'),
-            func.count(Order.id).label('orders')
-        ).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).group_by(date_format).order_by(date_format).all()
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        
+        daily = AnalyticsRollupService.sum_metrics(GRAIN_DAY, start_date, end_date, ('metric_date',),
+                                                   measures=('sales', 'paid_orders'))
+        return AnalyticsService._trends(daily, group_by, 'period')
+    
+    @staticmethod
+    def _trends(daily: Dict[tuple, Dict[str, Decimal]], group_by: str, label: str) -> List[Dict]:
+        """Bucket daily paid sales into periods (weeks and months start on their first day)."""
+        periods = {}
+        for (day,), measures in daily.items():
+            if not measures.get('paid_orders'):
+                continue
+            period = periods.setdefault(period_start(day, group_by), [Decimal('0'), 0])
+            period[0] += measures.get('sales', 0)
+            period[1] += int(measures['paid_orders'])
         
         trends = []
-        for period, sales, orders in results:
+        for period, (sales, orders) in sorted(periods.items()):
             trends.append({
-                'period': period.isoformat() if isinstance(period, date) else str(period),
-                'sales': float(sales or 0),
-                'orders': orders or 0
+                label: period.isoformat(),
+                'sales': float(sales),
+                'orders': orders
             })
         
         return trends
@@ -160,41 +179,28 @@ class AnalyticsService:
         Returns:
             List of dictionaries with product sales data
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
-        
-        results = db.session.query(
-            Product.id,
-            Product.name,
-            Product.shop_id,
-            Shop.name.label('shop_name'),
-            func.sum(OrderItem.quantity).label('total_quantity'),
-            func.sum(OrderItem.total_price).label('total_revenue'),
-            func.count(OrderItem.id).label('order_count')
-        ).join(OrderItem, Product.id == OrderItem.product_id).join(
-            Order, OrderItem.order_id == Order.id
-        ).join(Shop, Product.shop_id == Shop.id).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).group_by(Product.id, Product.name, Product.shop_id, Shop.name).order_by(
-            func.sum(OrderItem.quantity).desc()
-        ).limit(limit).all()
+        if OrderFactsService.is_enabled():
+            return OrderFactsService.get_top_products(limit, start_date, end_date)
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        
+        totals = AnalyticsRollupService.sum_metrics(GRAIN_PRODUCT, start_date, end_date, ('product_id',))
+        top = _ranked(totals, 'quantity', limit)
+        names = _names(Product.id, Product.name, Product.shop_id, Shop.name,
+                       ids=[product_id for product_id, _ in top], join=(Shop, Product.shop_id == Shop.id))
         
         products = []
-        for product_id, product_name, shop_id, shop_name, quantity, revenue, order_count in results:
+        for product_id, measures in top:
+            if product_id not in names:
+                continue
+            product_name, shop_id, shop_name = names[product_id]
             products.append({
                 'product_id': product_id,
                 'product_name': product_name,
                 'shop_id': shop_id,
                 'shop_name': shop_name,
-                'total_quantity': int(quantity or 0),
-                'total_revenue': float(revenue or 0),
-                'order_count': order_count or 0
+                'total_quantity': int(measures.get('quantity', 0)),
+                'total_revenue': float(measures.get('revenue', 0)),
+                'order_count': int(measures.get('order_items', 0))
             })
         
         return products
@@ -213,37 +219,41 @@ class AnalyticsService:
         Returns:
             List of dictionaries with shop performance data
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
-        
-        results = db.session.query(
-            Shop.id,
-            Shop.name,
-            func.sum(Order.total_amount).label('total_revenue'),
-            func.count(Order.id).label('total_orders'),
-            func.avg(Order.total_amount).label('avg_order_value'),
-            func.count(func.distinct(Order.customer_id)).label('unique_customers')
-        ).join(Order, Shop.id == Order.shop_id).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).group_by(Shop.id, Shop.name).order_by(
-            func.sum(Order.total_amount).desc()
-        ).limit(limit).all()
+        if OrderFactsService.is_enabled():
+            return OrderFactsService.get_top_shops(limit, start_date, end_date)
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        
+        totals = AnalyticsRollupService.sum_metrics(GRAIN_SHOP, start_date, end_date, ('shop_id',),
+                                                    measures=('sales', 'paid_orders'))
+        top = sorted(
+            ((keys[0], measures) for keys, measures in totals.items() if measures.get('paid_orders', 0) > 0),
+            key=lambda item: (-item[1].get('sales', 0), item[0])
+        )[:limit]
+        top_ids = [shop_id for shop_id, _ in top]
+        names = _names(Shop.id, Shop.name, ids=top_ids)
+        
+        # Distinct paying customers over the whole range, per shop
+        customers = {}
+        if top_ids:
+            pairs = AnalyticsRollupService.sum_customer_metrics(start_date, end_date, ('shop_id', 'user_id'),
+                                                                measures=('paid_orders',), shop_id=top_ids)
+            for (shop_id, _), measures in pairs.items():
+                if measures.get('paid_orders', 0) > 0:
+                    customers[shop_id] = customers.get(shop_id, 0) + 1
         
         shops = []
-        for shop_id, shop_name, revenue, orders, avg_value, customers in results:
+        for shop_id, measures in top:
+            if shop_id not in names:
+                continue
+            revenue = _decimal(measures.get('sales'))
+            orders = int(measures['paid_orders'])
             shops.append({
                 'shop_id': shop_id,
-                'shop_name': shop_name,
-                'total_revenue': float(revenue or 0),
-                'total_orders': orders or 0,
-                'avg_order_value': float(avg_value or 0),
-                'unique_customers': customers or 0
+                'shop_name': names[shop_id][0],
+                'total_revenue': float(revenue),
+                'total_orders': orders,
+                'avg_order_value': float(revenue / orders),
+                'unique_customers': customers.get(shop_id, 0)
             })
         
         return shops
@@ -261,39 +271,33 @@ class AnalyticsService:
         Returns:
             List of dictionaries with category performance data
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
-        
-        results = db.session.query(
-            Category.id,
-            Category.name,
-            func.sum(OrderItem.total_price).label('total_revenue'),
-            func.sum(OrderItem.quantity).label('total_quantity'),
-            func.count(func.distinct(OrderItem.order_id)).label('order_count'),
-            func.count(func.distinct(OrderItem.product_id)).label('product_count')
-        ).join(Product, Category.id == Product.category_id).join(
-            OrderItem, Product.id == OrderItem.product_id
-        ).join(Order, OrderItem.order_id == Order.id).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).group_by(Category.id, Category.name).order_by(
-            func.sum(OrderItem.total_price).desc()
-        ).all()
+        if OrderFactsService.is_enabled():
+            return OrderFactsService.get_category_performance(start_date, end_date)
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        
+        totals = AnalyticsRollupService.sum_metrics(GRAIN_CATEGORY, start_date, end_date, ('category_id',))
+        ranked = _ranked(totals, 'revenue')
+        
+        # Distinct products sold over the whole range, per category
+        product_counts = {}
+        pairs = AnalyticsRollupService.sum_metrics(GRAIN_PRODUCT, start_date, end_date,
+                                                   ('category_id', 'product_id'), measures=('order_items',))
+        for (category_id, _), measures in pairs.items():
+            if measures.get('order_items', 0) > 0:
+                product_counts[category_id] = product_counts.get(category_id, 0) + 1
+        names = _names(Category.id, Category.name, ids=[category_id for category_id, _ in ranked])
         
         categories = []
-        for cat_id, cat_name, revenue, quantity, orders, products in results:
+        for cat_id, measures in ranked:
+            if cat_id not in names:
+                continue
             categories.append({
                 'category_id': cat_id,
-                'category_name': cat_name,
-                'total_revenue': float(revenue or 0),
-                'total_quantity': int(quantity or 0),
-                'order_count': orders or 0,
-                'product_count': products or 0
+                'category_name': names[cat_id][0],
+                'total_revenue': float(measures.get('revenue', 0)),
+                'total_quantity': int(measures.get('quantity', 0)),
+                'order_count': int(measures.get('orders', 0)),
+                'product_count': product_counts.get(cat_id, 0)
             })
         
         return categories
@@ -311,29 +315,20 @@ class AnalyticsService:
         Returns:
             Dictionary with user statistics
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
+        start_date, end_date = resolve_date_range(start_date, end_date)
         
         # Total users
         total_users = User.query.count()
         
         # New users in period
         new_users = User.query.filter(
-            and_(
-                func.date(User.created_at) >= start_date,
-                func.date(User.created_at) <= end_date
-            )
+            in_date_range(User.created_at, start_date, end_date)
         ).count()
         
         # Active users (users who placed orders)
-        active_users = db.session.query(func.count(func.distinct(Order.customer_id))).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date
-            )
-        ).scalar() or 0
+        customers = AnalyticsRollupService.sum_customer_metrics(start_date, end_date, ('user_id',),
+                                                                measures=('orders',))
+        active_users = sum(1 for measures in customers.values() if measures.get('orders', 0) > 0)
         
         # Users by type
         users_by_type = db.session.query(
@@ -366,86 +361,40 @@ class AnalyticsService:
         Returns:
             Dictionary with shop analytics
         """
-        if not start_date:
-            start_date = date.today() - timedelta(days=30)
-        if not end_date:
-            end_date = date.today()
+        start_date, end_date = resolve_date_range(start_date, end_date)
         
         # Shop orders
-        orders_query = Order.query.filter_by(shop_id=shop_id).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date
-            )
-        )
-        
-        total_orders = orders_query.count()
-        total_revenue = db.session.query(func.sum(Order.total_amount)).filter_by(
-            shop_id=shop_id
-        ).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).scalar() or Decimal('0.00')
+        overview = AnalyticsService.get_sales_overview(start_date, end_date, shop_id=shop_id)
+        total_orders = overview['total_orders']
+        total_revenue = overview['total_sales']
         
         # Top products for shop
-        top_products = db.session.query(
-            Product.id,
-            Product.name,
-            func.sum(OrderItem.quantity).label('quantity'),
-            func.sum(OrderItem.total_price).label('revenue')
-        ).join(OrderItem, Product.id == OrderItem.product_id).join(
-            Order, OrderItem.order_id == Order.id
-        ).filter(
-            and_(
-                Product.shop_id == shop_id,
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).group_by(Product.id, Product.name).order_by(
-            func.sum(OrderItem.quantity).desc()
-        ).limit(10).all()
+        totals = AnalyticsRollupService.sum_metrics(GRAIN_PRODUCT, start_date, end_date, ('product_id',),
+                                                    measures=('quantity', 'revenue'), shop_id=shop_id)
+        top = _ranked(totals, 'quantity', 10)
+        names = _names(Product.id, Product.name, ids=[product_id for product_id, _ in top])
         
         products = []
-        for product_id, product_name, quantity, revenue in top_products:
+        for product_id, measures in top:
+            if product_id not in names:
+                continue
             products.append({
                 'product_id': product_id,
-                'product_name': product_name,
-                'quantity': int(quantity or 0),
-                'revenue': float(revenue or 0)
+                'product_name': names[product_id][0],
+                'quantity': int(measures.get('quantity', 0)),
+                'revenue': float(measures.get('revenue', 0))
             })
         
         # Sales trends
-        trends = db.session.query(
-            func.date(Order.created_at).label('date'),
-            func.sum(Order.total_amount).label('sales'),
-            func.count(Order.id).label('orders')
-        ).filter_by(shop_id=shop_id).filter(
-            and_(
-                func.date(Order.created_at) >= start_date,
-                func.date(Order.created_at) <= end_date,
-                Order.payment_status == 'paid'
-            )
-        ).group_by(func.date(Order.created_at)).order_by(
-            func.date(Order.created_at)
-        ).all()
-        
-        sales_trends = []
-        for order_date, sales, orders in trends:
-            sales_trends.append({
-                'date': order_date.isoformat(),
-                'sales': float(sales or 0),
-                'orders': orders or 0
-            })
+        daily = AnalyticsRollupService.sum_metrics(GRAIN_SHOP, start_date, end_date, ('metric_date',),
+                                                   measures=('sales', 'paid_orders'), shop_id=shop_id)
+        sales_trends = AnalyticsService._trends(daily, 'day', 'date')
         
         return {
             'shop_id': shop_id,
             'total_orders': total_orders,
-            'total_revenue': float(total_revenue),
-            'avg_order_value': float(total_revenue / total_orders) if total_orders > 0 else 0.0,
+            'total_revenue': total_revenue,
+            'avg_order_value': overview['avg_order_value'],
             'top_products': products,
             'sales_trends': sales_trends,
             'start_date': start_date.isoformat(),
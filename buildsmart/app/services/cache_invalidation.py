@@ -0,0 +1,147 @@
+"""
+Automatic cache invalidation.
+
+Session hooks that work out which cache tags a transaction affects and
+invalidate them once it commits, so cached pages and queries tagged with
+a product, shop, category or user never outlive a change to it:
+
+- ``Product``: the product, its shop (old and new), its category and search
+- ``Shop``: the shop and search
+- ``Service``: search
+- ``Category``: the category and the category list
+- ``Order``: the customer, the shop and analytics
+- ``Review``: the reviewer and the reviewed shop/product
+- ``Recommendation``: the user
+
+Tags are collected in ``after_flush``, while the flushed changes and their
+attribute history are still visible, and invalidated in one batch in
+``after_commit``; rolled-back changes invalidate nothing.
+"""
+from typing import Callable, Dict, Iterable, List, Set
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from app.models import Product, Shop, Service, Category, Order, Review, Recommendation
+from app.services.cache_service import CacheService
+
+_PENDING_KEY = 'cache_invalidation_pending'
+
+
+def _values(instance, field: str) -> List:
+    """Current and previous values of an attribute, as far as the flush knows."""
+    history = inspect(instance).attrs[field].history
+    values = list(history.added) + list(history.unchanged) + list(history.deleted)
+    if not values:
+        values = [getattr(instance, field, None)]
+    return [value for value in values if value is not None]
+
+
+def _product_tags(product: Product) -> List[str]:
+    tags = [CacheService.product_tag(product.id), CacheService.PREFIX_SEARCH]
+    tags += [CacheService.shop_tag(shop_id) for shop_id in _values(product, 'shop_id')]
+    tags += [CacheService.category_tag(category) for category in _values(product, 'category')]
+    return tags
+
+
+def _shop_tags(shop: Shop) -> List[str]:
+    return [CacheService.shop_tag(shop.id), CacheService.PREFIX_SEARCH]
+
+
+def _service_tags(service: Service) -> List[str]:
+    return [CacheService.PREFIX_SEARCH]
+
+
+def _category_tags(category: Category) -> List[str]:
+    tags = [CacheService.category_tag(category.id), CacheService.PREFIX_CATEGORY]
+    tags += [CacheService.category_tag(name) for name in _values(category, 'name')]
+    return tags
+
+
+def _order_tags(order: Order) -> List[str]:
+    tags = [CacheService.PREFIX_ANALYTICS]
+    tags += [CacheService.user_tag(user_id) for user_id in _values(order, 'customer_id')]
+    tags += [CacheService.shop_tag(shop_id) for shop_id in _values(order, 'shop_id')]
+    return tags
+
+
+def _review_tags(review: Review) -> List[str]:
+    tags = [CacheService.user_tag(user_id) for user_id in _values(review, 'user_id')]
+    tags += [CacheService.shop_tag(shop_id) for shop_id in _values(review, 'shop_id')]
+    tags += [CacheService.product_tag(product_id) for product_id in _values(review, 'product_id')]
+    return tags
+
+
+def _recommendation_tags(recommendation: Recommendation) -> List[str]:
+    return [CacheService.user_tag(user_id) for user_id in _values(recommendation, 'user_id')]
+
+
+# Tags affected by a change to an instance of each model
+TAGGERS: Dict[type, Callable[[object], List[str]]] = {
+    Product: _product_tags,
+    Shop: _shop_tags,
+    Service: _service_tags,
+    Category: _category_tags,
+    Order: _order_tags,
+    Review: _review_tags,
+    Recommendation: _recommendation_tags,
+}
+
+
+def affected_tags(instances: Iterable[object]) -> Set[str]:
+    """
+    Get the cache tags affected by changes to ``instances``.
+
+    Args:
+        instances: Changed model instances (others are ignored)
+
+    Returns:
+        Set of tag names
+    """
+    tags = set()
+    for instance in instances:
+        tagger = TAGGERS.get(type(instance))
+        if tagger is not None:
+            tags.update(tagger(instance))
+    return tags
+
+
+def _collect(session, flush_context):
+    dirty = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    tags = affected_tags(list(session.new) + dirty + list(session.deleted))
+    if tags:
+        session.info.setdefault(_PENDING_KEY, set()).update(tags)
+
+
+def _invalidate_pending(session):
+    tags = session.info.pop(_PENDING_KEY, None)
+    if tags and has_app_context():
+        try:
+            # Plain keys named after an entity tag are dropped too, as in invalidate_shop()
+            CacheService.delete_many(sorted(tags))
+            CacheService.invalidate_tags(*tags)
+        except Exception as e:
+            current_app.logger.error(f'Error invalidating cache tags: {e}')
+
+
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+_registered = False
+
+
+def register_cache_invalidation() -> None:
+    """
+    Register session hooks that invalidate cache tags of changed models.
+
+    Affected tags are collected during flush and invalidated after the
+    transaction commits.
+    """
+    global _registered
+    if _registered:
+        return
+    _registered = True
+
+    event.listen(Session, 'after_flush', _collect)
+    event.listen(Session, 'after_commit', _invalidate_pending)
+    event.listen(Session, 'after_rollback', _discard_pending)
@@ -3,12 +3,61 @@ Cache service for managing application caching.
 
 This service provides methods for caching query results,
 API responses, and other frequently accessed data.
+
+Invalidation is tag based. Cached entries can be stored with tags such
+as ``shop:12`` or ``category:4``; every tag has a generation counter in
+the cache and the current generations of an entry's tags are folded into
+its key. Invalidating a tag increments its counter, which makes every
+entry stored under the old generation unreachable (it then expires on
+its own). This costs one O(1) operation regardless of how many entries
+carry the tag, and works the same on every cache backend because it only
+needs get/set/add.
+
+``get_or_set`` protects expensive values from cache stampedes:
+
+- single flight: on a miss, one caller computes while the others wait
+  for its result (a lock per key within the process, plus an ``add``
+  lock in the cache shared by all workers, which is SET NX on Redis)
+- probabilistic early expiration: the closer an entry is to expiring and
+  the longer it took to compute, the likelier a caller refreshes it early
+- stale-while-revalidate: with ``stale_ttl`` an expired entry is still
+  served while one caller refreshes it in the background
+- ``cache_none``: None results can be cached; entries are stored in an
+  envelope so a cached None is distinguishable from a miss
+
+Reads go through a per-worker in-memory LRU (L1, see
+app.utils.local_cache) before the Flask-Caching backend (L2) when
+``CACHE_L1_ENABLED`` is set. Writes update both tiers and tell the other
+workers to drop their L1 copies, which needs Redis pub/sub to reach
+other processes; by default (``'auto'``) L1 is only used with Redis. Tag
+generation counters are always read from L2, so invalidating a tag takes
+effect in every worker at once on every backend.
+
+Every operation is counted per key prefix and outcome, with latency and
+value size histograms (see app.utils.cache_metrics), unless
+``CACHE_METRICS_ENABLED`` is off.
+
+Values are stored as self-describing payloads (see
+app.utils.cache_serializer): JSON (or msgpack) for plain data, compressed
+above ``CACHE_COMPRESS_THRESHOLD`` bytes. ORM instances are rejected with
+UncacheableValueError unless ``allow_orm=True`` is passed. Keys are
+namespaced by ``CACHE_VERSION`` (through the backend key prefix), so a
+deploy that changes what is cached can start from a clean namespace.
 """
+import math
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from functools import wraps
-from typing import Optional, Callable, Any
+from typing import Optional, Callable, Any, Dict, List, Sequence
 from datetime import timedelta
 from flask import current_app, has_app_context
 from app.extensions import cache
+from app.utils.cache_metrics import CacheMetrics, key_prefix
+from app.utils.cache_serializer import CacheCodec, UncacheableValueError
+from app.utils.local_cache import CLEAR_ALL, LRUCache, RedisInvalidationBus, local_bus, new_origin
 
 
 class CacheService:
@@ -22,6 +71,8 @@ class CacheService:
     PREFIX_ORDER = 'order'
     PREFIX_SEARCH = 'search'
     PREFIX_ANALYTICS = 'analytics'
+    PREFIX_RECOMMENDATION = 'recommendation'
+    PREFIX_TAG = 'tag'
     
     @staticmethod
     def get_cache_key(prefix: str, identifier: Any, *args, **kwargs) -> str:
@@ -51,24 +102,30 @@ class CacheService:
         return ':'.join(key_parts)
     
     @staticmethod
-    def get(key: str) -> Optional[Any]:
+    def get(key: str, tags: Optional[Sequence[str]] = None) -> Optional[Any]:
         """
         Get value from cache.
         
         Args:
             key: Cache key
+            tags: Tags the value was stored with
         
         Returns:
             Cached value or None
         """
+        started = time.perf_counter()
         try:
-            return cache.get(key)
-        except Exception:
+            value = _tiers().get(CacheService.tagged_key(key, tags) if tags else key)
+        except Exception as e:
             # If cache fails, return None (graceful degradation)
+            _record_error('get', key, started, e)
             return None
+        _record('get', key, 'miss' if value is None else 'hit', started)
+        return value
     
     @staticmethod
-    def set(key: str, value: Any, timeout: Optional[int] = None) -> bool:
+    def set(key: str, value: Any, timeout: Optional[int] = None,
+            tags: Optional[Sequence[str]] = None, allow_orm: bool = False) -> bool:
         """
         Set value in cache.
         
@@ -76,16 +133,103 @@ class CacheService:
             key: Cache key
             value: Value to cache
             timeout: Timeout in seconds (None = use default)
+            tags: Tags to invalidate the value by (see invalidate_tags)
+            allow_orm: Allow ORM instances in the value (stored with pickle)
         
         Returns:
             True if successful, False otherwise
+        
+        Raises:
+            UncacheableValueError: If the value holds ORM instances and
+                allow_orm is False
         """
+        started = time.perf_counter()
         try:
-            cache.set(key, value, timeout=timeout)
-            return True
-        except Exception:
+            written = _tiers().set_many({CacheService.tagged_key(key, tags) if tags else key: value},
+                                        timeout, allow_orm=allow_orm)
+        except UncacheableValueError:
+            raise
+        except Exception as e:
             # If cache fails, return False (graceful degradation)
+            _record_error('set', key, started, e)
             return False
+        _record('set', key, 'ok', started)
+        _record_sizes(written)
+        return True
+    
+    @staticmethod
+    def tag_key(tag: str) -> str:
+        """Get the cache key holding a tag's generation counter."""
+        return f"{CacheService.PREFIX_TAG}:{tag}"
+    
+    @staticmethod
+    def get_tag_versions(tags: Sequence[str]) -> List[int]:
+        """
+        Get the current generation of each tag, in one round trip.
+        
+        Tags without a counter (never invalidated or evicted) get one
+        seeded from the clock, so a re-created counter never repeats a
+        generation that entries may still be stored under.
+        
+        Args:
+            tags: Tag names
+        
+        Returns:
+            List of generations, in tag order
+        """
+        keys = [CacheService.tag_key(tag) for tag in tags]
+        # Never from L1: a worker must see another worker's invalidation at once
+        versions = CacheService.get_many(keys, use_l1=False)
+        missing = [i for i, version in enumerate(versions) if version is None]
+        if missing:
+            try:
+                for i in missing:
+                    cache.add(keys[i], _initial_generation(), timeout=0)
+                for i, version in zip(missing, cache.get_many(*[keys[i] for i in missing])):
+                    versions[i] = version
+            except Exception:
+                pass
+        return [int(version or 0) for version in versions]
+    
+    @staticmethod
+    def tagged_key(key: str, tags: Sequence[str]) -> str:
+        """
+        Fold the current generations of ``tags`` into ``key``.
+        
+        Args:
+            key: Cache key
+            tags: Tag names
+        
+        Returns:
+            Key that changes whenever one of the tags is invalidated
+        """
+        tags = sorted(set(tags))
+        versions = CacheService.get_tag_versions(tags)
+        return f"{key}:g:{'.'.join(str(version) for version in versions)}"
+    
+    @staticmethod
+    def invalidate_tags(*tags: str) -> None:
+        """
+        Invalidate every entry stored with any of ``tags``.
+        
+        Each tag costs one increment of its generation counter (an atomic
+        INCR on Redis).
+        
+        Args:
+            *tags: Tag names
+        """
+        atomic = hasattr(getattr(cache, 'cache', None), '_write_client')
+        for tag in set(tags):
+            key = CacheService.tag_key(tag)
+            try:
+                cache.add(key, _initial_generation(), timeout=0)
+                if atomic:
+                    cache.inc(key)
+                else:
+                    # Generic inc() re-sets the counter with the default timeout
+                    cache.set(key, int(cache.get(key) or _initial_generation()) + 1, timeout=0)
+            except Exception:
+                pass
     
     @staticmethod
     def delete(key: str) -> bool:
@@ -98,16 +242,99 @@ class CacheService:
         Returns:
             True if successful, False otherwise
         """
+        started = time.perf_counter()
+        try:
+            _tiers().delete_many([key])
+        except Exception as e:
+            _record_error('delete', key, started, e)
+            return False
+        _record('delete', key, 'ok', started)
+        return True
+    
+    @staticmethod
+    def get_many(keys: List[str], use_l1: bool = True) -> List[Optional[Any]]:
+        """
+        Get several values from cache in one round trip.
+        
+        Args:
+            keys: Cache keys
+            use_l1: Read through this worker's L1 (False: backend only)
+        
+        Returns:
+            List of cached values (None for misses), in key order
+        """
+        if not keys:
+            return []
+        started = time.perf_counter()
         try:
-            cache.delete(key)
+            values = _tiers().get_many(keys, use_l1=use_l1)
+        except Exception as e:
+            _record_error('get_many', keys[0], started, e, count=len(keys))
+            return [None] * len(keys)
+        _record_batch('get_many', keys, values, started)
+        return values
+    
+    @staticmethod
+    def set_many(mapping: Dict[str, Any], timeout: Optional[int] = None, allow_orm: bool = False) -> bool:
+        """
+        Set several values in cache in one round trip.
+        
+        Args:
+            mapping: Dictionary of cache key to value
+            timeout: Timeout in seconds (None = use default)
+            allow_orm: Allow ORM instances in the values (stored with pickle)
+        
+        Returns:
+            True if successful, False otherwise
+        
+        Raises:
+            UncacheableValueError: If a value holds ORM instances and
+                allow_orm is False
+        """
+        if not mapping:
             return True
-        except Exception:
+        started = time.perf_counter()
+        try:
+            written = _tiers().set_many(mapping, timeout, allow_orm=allow_orm)
+        except UncacheableValueError:
+            raise
+        except Exception as e:
+            _record_error('set_many', next(iter(mapping)), started, e, count=len(mapping))
             return False
+        _record_batch('set_many', list(mapping), None, started)
+        _record_sizes(written)
+        return True
+    
+    @staticmethod
+    def delete_many(keys: List[str]) -> bool:
+        """
+        Delete several values from cache.
+        
+        Args:
+            keys: Cache keys
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        if not keys:
+            return True
+        started = time.perf_counter()
+        try:
+            _tiers().delete_many(keys)
+        except Exception as e:
+            _record_error('delete_many', keys[0], started, e, count=len(keys))
+            return False
+        _record_batch('delete_many', keys, None, started)
+        return True
     
     @staticmethod
     def delete_pattern(pattern: str) -> int:
         """
-        Delete all keys matching a pattern.
+        Delete all keys matching a pattern (Redis only).
+        
+        Walks the keyspace, so prefer tags (invalidate_tags) for anything
+        on a request path. Other backends cannot list keys and delete
+        nothing.
         
         Args:
             pattern: Pattern to match (e.g., 'shop:*')
@@ -116,15 +343,59 @@ class CacheService:
             Number of keys deleted
         """
         try:
-            # Get all keys matching the pattern
-            keys = cache.cache._read_client.keys(pattern)
-            if keys:
-                cache.cache._write_client.delete(*keys)
-                return len(keys)
-            return 0
+            backend = cache.cache
+            # Keys are stored with the backend's prefix
+            pattern = f"{getattr(backend, 'key_prefix', '')}{pattern}"
+            deleted = 0
+            batch = []
+            for key in backend._read_client.scan_iter(match=pattern, count=500):
+                batch.append(key)
+                if len(batch) >= 500:
+                    deleted += backend._write_client.delete(*batch)
+                    batch = []
+            if batch:
+                deleted += backend._write_client.delete(*batch)
+            _tiers().forget([CLEAR_ALL])
+            return deleted
         except Exception:
             return 0
     
+    @staticmethod
+    def get_stats() -> Dict[str, Dict[str, Any]]:
+        """
+        Get hit/miss counters per cache tier for this worker.
+        
+        Returns:
+            Dictionary with 'l1' (in-process LRU; 'enabled' False when
+            off) and 'l2' (shared backend) counters
+        """
+        return _tiers().stats()
+    
+    @staticmethod
+    def get_metrics() -> Optional[CacheMetrics]:
+        """
+        Get this worker's cache metrics.
+        
+        Returns:
+            CacheMetrics, or None when CACHE_METRICS_ENABLED is off
+        """
+        return _metrics()
+    
+    @staticmethod
+    def record_event(operation: str, prefix: str, outcome: str, seconds: Optional[float] = None) -> None:
+        """
+        Count a cache event that does not go through get/set (e.g. a cached response).
+        
+        Args:
+            operation: Operation name
+            prefix: Metrics label (key prefix, endpoint, ...)
+            outcome: Outcome (hit, miss, ...)
+            seconds: Latency, if measured
+        """
+        metrics = _metrics()
+        if metrics is not None:
+            metrics.record(operation, prefix, outcome, seconds=seconds)
+    
     @staticmethod
     def clear() -> bool:
         """
@@ -134,101 +405,521 @@ class CacheService:
             True if successful, False otherwise
         """
         try:
-            cache.clear()
+            _tiers().clear()
             return True
         except Exception:
             return False
     
     @staticmethod
-    def get_or_set(key: str, func: Callable, timeout: Optional[int] = None) -> Any:
+    def get_or_set(key: str, func: Callable, timeout: Optional[int] = None,
+                   tags: Optional[Sequence[str]] = None, stale_ttl: int = 0,
+                   cache_none: bool = False, beta: float = 1.0, allow_orm: bool = False) -> Any:
         """
         Get value from cache or set it if not present.
         
+        Concurrent misses for the same key compute the value once (see the
+        module docstring for the stampede protections).
+        
         Args:
             key: Cache key
             func: Function to call if cache miss
             timeout: Timeout in seconds
+            tags: Tags to invalidate the value by
+            stale_ttl: Seconds an expired value may still be served while it
+                is refreshed in the background (0 = never serve stale).
+                ``func`` must then not depend on the request context.
+            cache_none: Cache None results instead of recomputing them
+            beta: Eagerness of early expiration (0 = only refresh on expiry)
+            allow_orm: Allow ORM instances in the value (stored with pickle)
         
         Returns:
             Cached or computed value
         """
-        value = CacheService.get(key)
-        if value is None:
-            value = func()
-            CacheService.set(key, value, timeout=timeout)
-        return value
+        if tags:
+            key = CacheService.tagged_key(key, tags)
+        timeout = _resolve_timeout(timeout)
+        
+        entry = _get_entry(key)
+        if entry is not None:
+            now = time.time()
+            expires = entry.get('expires')
+            if expires is None or not _refresh_due(entry, now, beta):
+                _record('get_or_set', key, 'hit')
+                return entry['value']
+            
+            expired = now >= expires
+            if not expired or stale_ttl:
+                # Still servable: whoever takes the refresh lock refreshes it
+                token = _acquire_refresh_lock(key)
+                if token is not None:
+                    if expired:
+                        _schedule_refresh(key, func, timeout, stale_ttl, cache_none, allow_orm, token)
+                    else:
+                        _record('get_or_set', key, 'early_refresh')
+                        try:
+                            return _compute_and_store(key, func, timeout, stale_ttl, cache_none, allow_orm)
+                        finally:
+                            _release_refresh_lock(key, token)
+                _record('get_or_set', key, 'stale' if expired else 'hit')
+                return entry['value']
+        
+        return _single_flight(key, func, timeout, stale_ttl, cache_none, allow_orm)
+    
+    @staticmethod
+    def shop_tag(shop_id: int) -> str:
+        return f"{CacheService.PREFIX_SHOP}:{shop_id}"
+    
+    @staticmethod
+    def product_tag(product_id: int) -> str:
+        return f"{CacheService.PREFIX_PRODUCT}:{product_id}"
+    
+    @staticmethod
+    def user_tag(user_id: int) -> str:
+        return f"{CacheService.PREFIX_USER}:{user_id}"
+    
+    @staticmethod
+    def category_tag(category_id: Any) -> str:
+        return f"{CacheService.PREFIX_CATEGORY}:{category_id}"
     
     @staticmethod
     def invalidate_shop(shop_id: int) -> None:
         """Invalidate all cache entries for a shop."""
-        patterns = [
-            f"{CacheService.PREFIX_SHOP}:{shop_id}",
-            f"{CacheService.PREFIX_SHOP}:{shop_id}:*",
-            f"{CacheService.PREFIX_PRODUCT}:*:shop:{shop_id}",
-            f"{CacheService.PREFIX_SEARCH}:*:shop:{shop_id}",
-            f"{CacheService.PREFIX_ANALYTICS}:shop:{shop_id}*"
-        ]
-        for pattern in patterns:
-            CacheService.delete_pattern(pattern)
+        CacheService.delete(CacheService.shop_tag(shop_id))
+        CacheService.invalidate_tags(CacheService.shop_tag(shop_id))
     
     @staticmethod
     def invalidate_product(product_id: int) -> None:
         """Invalidate all cache entries for a product."""
-        patterns = [
-            f"{CacheService.PREFIX_PRODUCT}:{product_id}",
-            f"{CacheService.PREFIX_PRODUCT}:{product_id}:*",
-            f"{CacheService.PREFIX_SEARCH}:*:product:{product_id}",
-            f"{CacheService.PREFIX_CATEGORY}:*:product:{product_id}"
-        ]
-        for pattern in patterns:
-            CacheService.delete_pattern(pattern)
+        CacheService.delete(CacheService.product_tag(product_id))
+        CacheService.invalidate_tags(CacheService.product_tag(product_id))
     
     @staticmethod
     def invalidate_user(user_id: int) -> None:
         """Invalidate all cache entries for a user."""
-        patterns = [
-            f"{CacheService.PREFIX_USER}:{user_id}",
-            f"{CacheService.PREFIX_USER}:{user_id}:*",
-            f"{CacheService.PREFIX_ORDER}:*:user:{user_id}"
-        ]
-        for pattern in patterns:
-            CacheService.delete_pattern(pattern)
+        CacheService.delete(CacheService.user_tag(user_id))
+        CacheService.invalidate_tags(CacheService.user_tag(user_id))
     
     @staticmethod
-    def invalidate_category(category_id: int) -> None:
+    def invalidate_category(category_id: Any) -> None:
         """Invalidate all cache entries for a category."""
-        patterns = [
-            f"{CacheService.PREFIX_CATEGORY}:{category_id}",
-            f"{CacheService.PREFIX_CATEGORY}:{category_id}:*",
-            f"{CacheService.PREFIX_PRODUCT}:*:category:{category_id}",
-            f"{CacheService.PREFIX_SEARCH}:*:category:{category_id}"
-        ]
-        for pattern in patterns:
-            CacheService.delete_pattern(pattern)
+        CacheService.delete(CacheService.category_tag(category_id))
+        CacheService.invalidate_tags(CacheService.category_tag(category_id))
     
     @staticmethod
     def invalidate_search() -> None:
         """Invalidate all search cache entries."""
-        CacheService.delete_pattern(f"{CacheService.PREFIX_SEARCH}:*")
+        CacheService.invalidate_tags(CacheService.PREFIX_SEARCH)
     
     @staticmethod
     def invalidate_analytics() -> None:
         """Invalidate all analytics cache entries."""
-        CacheService.delete_pattern(f"{CacheService.PREFIX_ANALYTICS}:*")
+        CacheService.invalidate_tags(CacheService.PREFIX_ANALYTICS)
+
+
+_TIERS_KEY = 'cache_tiers'
+
+
+class _CacheTiers:
+    """L1 (per-process LRU, optional) in front of the Flask-Caching backend (L2)."""
+    
+    def __init__(self, app):
+        self.codec = CacheCodec(
+            serializer=app.config.get('CACHE_SERIALIZER', 'json'),
+            compression=app.config.get('CACHE_COMPRESSION', 'zlib'),
+            compress_threshold=app.config.get('CACHE_COMPRESS_THRESHOLD', 1024),
+        )
+        self.l1 = None
+        self.bus = None
+        self.origin = new_origin()
+        self.l2_counters = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+        
+        backend = app.extensions['cache'][cache]
+        client = getattr(backend, '_write_client', None)
+        pubsub = client is not None and hasattr(client, 'pubsub')
+        enabled = app.config.get('CACHE_L1_ENABLED', False)
+        if enabled == 'auto':
+            # Without pub/sub, other processes' L1 copies would outlive writes
+            enabled = pubsub
+        if enabled:
+            self.l1 = LRUCache(
+                max_bytes=app.config.get('CACHE_L1_MAX_BYTES', 32 * 1024 * 1024),
+                max_item_bytes=app.config.get('CACHE_L1_MAX_ITEM_BYTES', 256 * 1024),
+                default_ttl=app.config.get('CACHE_L1_TTL', 30),
+            )
+            if pubsub:
+                self.bus = RedisInvalidationBus(
+                    client, app.config.get('CACHE_INVALIDATION_CHANNEL', 'buildsmart:cache-invalidation'),
+                    logger=app.logger
+                )
+            else:
+                self.bus = local_bus
+            self.bus.subscribe(self.origin, self.l1.discard)
+    
+    def get(self, key: str) -> Any:
+        return self.get_many([key])[0]
+    
+    def get_many(self, keys: List[str], use_l1: bool = True) -> List[Any]:
+        values = [None] * len(keys)
+        missing = list(range(len(keys)))
+        use_l1 = use_l1 and self.l1 is not None
+        if use_l1:
+            missing = []
+            for i, key in enumerate(keys):
+                payload = self.l1.get(key)
+                if payload is None:
+                    missing.append(i)
+                else:
+                    values[i] = self.codec.decode(payload)
+        if not missing:
+            return values
+        
+        fetched = cache.get_many(*[keys[i] for i in missing])
+        hits = 0
+        for i, payload in zip(missing, fetched):
+            if payload is not None:
+                hits += 1
+                if use_l1:
+                    self._fill(keys[i], payload, None)
+                values[i] = self.codec.decode(payload)
+        with self._lock:
+            self.l2_counters['hits'] += hits
+            self.l2_counters['misses'] += len(missing) - hits
+        return values
+    
+    def set_many(self, mapping: Dict[str, Any], timeout: Optional[int],
+                 allow_orm: bool = False) -> Dict[str, tuple]:
+        """Encode and store values; returns {key: (payload size, serializer)}."""
+        payloads = {}
+        written = {}
+        for key, value in mapping.items():
+            payloads[key], serializer = self.codec.encode(value, allow_orm=allow_orm)
+            written[key] = (len(payloads[key]), serializer)
+        if len(payloads) == 1:
+            (key, payload), = payloads.items()
+            cache.set(key, payload, timeout=timeout)
+        else:
+            cache.set_many(payloads, timeout=timeout)
+        if self.l1 is not None:
+            for key, payload in payloads.items():
+                self._fill(key, payload, timeout)
+            self._publish(list(payloads))
+        return written
+    
+    def delete_many(self, keys: List[str]) -> None:
+        if len(keys) == 1:
+            cache.delete(keys[0])
+        else:
+            cache.delete_many(*keys)
+        self.forget(keys)
+    
+    def clear(self) -> None:
+        cache.clear()
+        self.forget([CLEAR_ALL])
+    
+    def forget(self, keys: List[str]) -> None:
+        """Drop keys from this worker's L1 and tell the other workers to."""
+        if self.l1 is not None:
+            self.l1.discard(keys)
+            self._publish(keys)
+    
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            l2 = dict(self.l2_counters)
+        l1 = dict(self.l1.stats(), enabled=True) if self.l1 is not None else {'enabled': False}
+        return {'l1': l1, 'l2': l2}
+    
+    def _fill(self, key: str, payload: Any, timeout: Optional[int]) -> None:
+        if not isinstance(payload, bytes):
+            # Values written to the backend directly
+            try:
+                payload, _ = self.codec.encode(payload)
+            except Exception:
+                self.l1.discard([key])
+                return
+        # timeout 0 means "no expiry" to the backend; L1 still applies its own TTL
+        self.l1.set(key, payload, ttl=timeout or None)
+    
+    def _publish(self, keys: List[str]) -> None:
+        if self.bus is not None and keys:
+            self.bus.publish(self.origin, keys)
+
+
+def _tiers() -> _CacheTiers:
+    """Get the cache tiers of the current application."""
+    app = current_app._get_current_object()
+    tiers = app.extensions.get(_TIERS_KEY)
+    if tiers is None:
+        tiers = app.extensions.setdefault(_TIERS_KEY, _CacheTiers(app))
+    return tiers
+
+
+_METRICS_KEY = 'cache_metrics'
+
+
+def _metrics() -> Optional[CacheMetrics]:
+    """Get the cache metrics of the current application (None when disabled)."""
+    if not has_app_context():
+        return None
+    app = current_app._get_current_object()
+    if not app.config.get('CACHE_METRICS_ENABLED', True):
+        return None
+    metrics = app.extensions.get(_METRICS_KEY)
+    if metrics is None:
+        metrics = app.extensions.setdefault(_METRICS_KEY, CacheMetrics())
+    return metrics
+
+
+def _record(operation: str, key: str, outcome: str, started: Optional[float] = None, count: int = 1) -> None:
+    """Count an operation on ``key``; ``started`` is its perf_counter() start time."""
+    metrics = _metrics()
+    if metrics is not None:
+        seconds = time.perf_counter() - started if started is not None else None
+        metrics.record(operation, key_prefix(key), outcome, count=count, seconds=seconds)
+
+
+def _record_error(operation: str, key: str, started: float, error: Exception, count: int = 1) -> None:
+    _record(operation, key, 'error', started, count=count)
+    if has_app_context():
+        current_app.logger.debug(f'Cache {operation} failed for {key}: {error}')
+
+
+def _record_batch(operation: str, keys: List[str], values: Optional[List[Any]], started: float) -> None:
+    """Count a batch operation per key prefix (hits/misses when ``values`` are given)."""
+    metrics = _metrics()
+    if metrics is None:
+        return
+    outcomes: Dict[tuple, int] = {}
+    for i, key in enumerate(keys):
+        outcome = 'ok' if values is None else ('miss' if values[i] is None else 'hit')
+        label = (key_prefix(key), outcome)
+        outcomes[label] = outcomes.get(label, 0) + 1
+    seconds = time.perf_counter() - started
+    for i, ((prefix, outcome), count) in enumerate(outcomes.items()):
+        # The batch latency is observed once, under the first key's prefix
+        metrics.record(operation, prefix, outcome, count=count, seconds=seconds if i == 0 else None)
+
+
+def _record_sizes(written: Dict[str, tuple]) -> None:
+    """Observe the size and serializer of payloads written to the cache."""
+    metrics = _metrics()
+    if metrics is None:
+        return
+    for key, (size, serializer) in written.items():
+        metrics.observe_size(key_prefix(key), size)
+        metrics.record('serialize', key_prefix(key), serializer)
+
+
+def _initial_generation() -> int:
+    # Microseconds since the epoch: larger than any counter issued before
+    return time.time_ns() // 1000
+
+
+def _resolve_tags(tags: Optional[Any], args: tuple, kwargs: dict) -> Optional[List[str]]:
+    """Tags given as a list or as a function of the decorated call's arguments."""
+    if callable(tags):
+        return list(tags(*args, **kwargs))
+    return list(tags) if tags else None
+
+
+# Marks values stored by get_or_set, which carry freshness metadata
+_ENTRY_MARKER = '__cache_entry__'
 
+# How long a refresh may hold its lock, and how long others wait for it
+REFRESH_LOCK_TIMEOUT = 30
+REFRESH_WAIT = 5.0
+_POLL_INTERVAL = 0.05
 
-def cached(timeout: int = 300, key_prefix: str = 'view'):
+
+class _KeyLocks:
+    """Per-key locks for this worker, dropped once no thread holds or waits for them."""
+    
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks: Dict[str, List] = {}  # key -> [lock, holders and waiters]
+    
+    @contextmanager
+    def hold(self, key: str):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._mutex:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+    
+    def __len__(self) -> int:
+        with self._mutex:
+            return len(self._locks)
+
+
+# Per-process single-flight locks
+_KEY_LOCKS = _KeyLocks()
+
+
+def _resolve_timeout(timeout: Optional[int]) -> int:
+    if timeout is not None:
+        return timeout
+    if has_app_context():
+        return current_app.config.get('CACHE_DEFAULT_TIMEOUT', 300)
+    return 300
+
+
+def _get_entry(key: str) -> Optional[Dict]:
+    """Get a get_or_set entry; plain values stored by set() count as fresh."""
+    value = CacheService.get(key)
+    if value is None:
+        return None
+    if isinstance(value, dict) and value.get(_ENTRY_MARKER):
+        return value
+    return {'value': value, 'expires': None, 'delta': 0.0}
+
+
+def _refresh_due(entry: Dict, now: float, beta: float) -> bool:
+    """
+    Probabilistic early expiration ("XFetch").
+    
+    An entry is refreshed once ``now - delta * beta * ln(rand)`` passes its
+    expiry, where ``delta`` is how long it took to compute, so slow values
+    start refreshing ahead of time and callers rarely all miss at once.
+    """
+    gap = entry.get('delta', 0.0) * beta * -math.log(1.0 - random.random())
+    return now + gap >= entry['expires']
+
+
+def _compute_and_store(key: str, func: Callable, timeout: int, stale_ttl: int, cache_none: bool,
+                       allow_orm: bool = False) -> Any:
+    started = time.time()
+    timer = time.perf_counter()
+    try:
+        value = func()
+    except Exception:
+        _record('compute', key, 'error', timer)
+        raise
+    _record('compute', key, 'ok', timer)
+    if value is None and not cache_none:
+        return value
+    finished = time.time()
+    entry = {
+        _ENTRY_MARKER: True,
+        'value': value,
+        'expires': finished + timeout if timeout else None,
+        'delta': finished - started,
+    }
+    # Expired entries stay in the backend for the stale window
+    CacheService.set(key, entry, timeout=timeout + stale_ttl if timeout else timeout, allow_orm=allow_orm)
+    return value
+
+
+def _lock_key(key: str) -> str:
+    return f"lock:{key}"
+
+
+def _acquire_refresh_lock(key: str) -> Optional[str]:
+    """Take the cross-worker lock for recomputing ``key`` (SET NX on Redis)."""
+    token = uuid.uuid4().hex
+    try:
+        if cache.add(_lock_key(key), token, timeout=REFRESH_LOCK_TIMEOUT):
+            return token
+        return None
+    except Exception:
+        # Without a working cache there is nothing to coordinate through
+        return token
+
+
+def _release_refresh_lock(key: str, token: str) -> None:
+    try:
+        if cache.get(_lock_key(key)) == token:
+            cache.delete(_lock_key(key))
+    except Exception:
+        pass
+
+
+def _single_flight(key: str, func: Callable, timeout: int, stale_ttl: int, cache_none: bool,
+                   allow_orm: bool) -> Any:
+    """
+    Compute a missing value once across threads and workers.
+    
+    Threads of this worker take turns on the key's lock; whoever also gets
+    the cross-worker lock computes the value while holding both. While
+    another worker holds the cross-worker lock, the key's lock is released
+    between polls so this worker's threads wait for the result without
+    queueing behind each other.
+    """
+    deadline = time.time() + REFRESH_WAIT
+    outcome = 'hit'
+    while True:
+        with _KEY_LOCKS.hold(key):
+            # Another thread or worker may have filled it meanwhile
+            entry = _get_entry(key)
+            if entry is not None and (entry['expires'] is None or time.time() < entry['expires']):
+                _record('get_or_set', key, outcome)
+                return entry['value']
+            
+            token = _acquire_refresh_lock(key)
+            if token is not None or time.time() >= deadline:
+                _record('get_or_set', key, 'miss')
+                try:
+                    return _compute_and_store(key, func, timeout, stale_ttl, cache_none, allow_orm)
+                finally:
+                    if token is not None:
+                        _release_refresh_lock(key, token)
+        
+        # Another worker is computing it: wait for its result
+        outcome = 'waited'
+        time.sleep(_POLL_INTERVAL)
+
+
+def _schedule_refresh(key: str, func: Callable, timeout: int, stale_ttl: int, cache_none: bool,
+                      allow_orm: bool, token: str) -> None:
+    """Refresh an entry in the background while its stale value is served."""
+    if not has_app_context() or not current_app.config.get('CACHE_REFRESH_ASYNC', True):
+        try:
+            _compute_and_store(key, func, timeout, stale_ttl, cache_none, allow_orm)
+        except Exception as e:
+            if has_app_context():
+                current_app.logger.error(f'Error refreshing cache entry {key}: {e}')
+        finally:
+            _release_refresh_lock(key, token)
+        return
+    
+    app = current_app._get_current_object()
+    
+    def refresh():
+        with app.app_context():
+            try:
+                _compute_and_store(key, func, timeout, stale_ttl, cache_none, allow_orm)
+            except Exception as e:
+                app.logger.error(f'Error refreshing cache entry {key}: {e}')
+            finally:
+                _release_refresh_lock(key, token)
+    
+    threading.Thread(target=refresh, name='cache-refresh', daemon=True).start()
+
+
+def cached(timeout: int = 300, key_prefix: str = 'view', tags: Optional[Any] = None,
+           stale_ttl: int = 0, cache_none: bool = False, allow_orm: bool = False):
     """
     Decorator to cache view function results.
     
     Args:
         timeout: Cache timeout in seconds (default: 5 minutes)
         key_prefix: Cache key prefix
+        tags: Invalidation tags, or a function of the call's arguments returning them
+        stale_ttl: Seconds to serve an expired result while refreshing it
+        cache_none: Cache None results
+        allow_orm: Allow ORM instances in the result (stored with pickle)
     
     Usage:
-        @cached(timeout=600)
-        def my_view():
-            return render_template('index.html')
+        @cached(timeout=600, tags=lambda shop_id: [CacheService.shop_tag(shop_id)])
+        def shop_page(shop_id):
+            return render_template('shop.html')
     """
     def decorator(func: Callable) -> Callable:
         @wraps(func)
@@ -236,35 +927,34 @@ def cached(timeout: int = 300, key_prefix: str = 'view'):
             # Generate cache key from function name and arguments
             cache_key = CacheService.get_cache_key(key_prefix, func.__name__, *args, **kwargs)
             
-            # Try to get from cache
-            cached_value = CacheService.get(cache_key)
-            if cached_value is not None:
-                return cached_value
-            
-            # Execute function
-            result = func(*args, **kwargs)
-            
-            # Cache the result
-            CacheService.set(cache_key, result, timeout=timeout)
-            
-            return result
+            # Get from cache, computing it once on a miss
+            return CacheService.get_or_set(
+                cache_key, lambda: func(*args, **kwargs), timeout=timeout,
+                tags=_resolve_tags(tags, args, kwargs), stale_ttl=stale_ttl, cache_none=cache_none,
+                allow_orm=allow_orm
+            )
         
         return wrapper
     return decorator
 
 
-def cached_query(timeout: int = 300, key_func: Optional[Callable] = None):
+def cached_query(timeout: int = 300, key_func: Optional[Callable] = None, tags: Optional[Any] = None,
+                 stale_ttl: int = 0, cache_none: bool = False, allow_orm: bool = False):
     """
     Decorator to cache database query results.
     
     Args:
         timeout: Cache timeout in seconds (default: 5 minutes)
         key_func: Optional function to generate cache key from arguments
+        tags: Invalidation tags, or a function of the call's arguments returning them
+        stale_ttl: Seconds to serve an expired result while refreshing it
+        cache_none: Cache None results
+        allow_orm: Allow ORM instances in the result (stored with pickle)
     
     Usage:
         @cached_query(timeout=600)
-        def get_products():
-            return Product.query.all()
+        def get_product_ids():
+            return [p.id for p in Product.query.with_entities(Product.id)]
     """
     def decorator(func: Callable) -> Callable:
         @wraps(func)
@@ -275,18 +965,12 @@ def cached_query(timeout: int = 300, key_func: Optional[Callable] = None):
             else:
                 cache_key = CacheService.get_cache_key('query', func.__name__, *args, **kwargs)
             
-            # Try to get from cache
-            cached_value = CacheService.get(cache_key)
-            if cached_value is not None:
-                return cached_value
-            
-            # Execute function
-            result = func(*args, **kwargs)
-            
-            # Cache the result
-            CacheService.set(cache_key, result, timeout=timeout)
-            
-            return result
+            # Get from cache, computing it once on a miss
+            return CacheService.get_or_set(
+                cache_key, lambda: func(*args, **kwargs), timeout=timeout,
+                tags=_resolve_tags(tags, args, kwargs), stale_ttl=stale_ttl, cache_none=cache_none,
+                allow_orm=allow_orm
+            )
         
         return wrapper
     return decorator
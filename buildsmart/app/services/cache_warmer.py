@@ -0,0 +1,135 @@
+"""
+Cache warm-up.
+
+Precomputes the entries the first requests after a deploy would otherwise
+all miss: featured content on the home page, the category list, trending
+searches, the suggestion index and the analytics overview.
+
+Tasks run in parallel on a small thread pool, each in its own app
+context, and report how long they took. ``flask cache-warm`` fills a
+shared backend (e.g. Redis) once per deploy; with ``CACHE_WARM_ON_STARTUP``
+every worker also warms itself in the background when it serves its first
+request, which is what fills per-process caches (the L1 cache, the
+suggestion index).
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+from flask import current_app
+from app.extensions import db
+from app.services.analytics_service import AnalyticsService
+from app.services.catalog_service import CatalogService
+from app.services.suggestion_service import SuggestionService
+
+
+def _get(path: str) -> None:
+    """Request a cached GET endpoint so its response is stored."""
+    response = current_app.test_client().get(path)
+    if response.status_code != 200:
+        raise RuntimeError(f'GET {path} returned {response.status_code}')
+
+
+class CacheWarmer:
+    """Service for warming hot cache entries."""
+
+    DEFAULT_WORKERS = 4
+
+    # Warm-up tasks by name, in reporting order
+    TASKS: Dict[str, Callable[[], object]] = {
+        'home:featured': CatalogService.get_featured_ids,
+        'api:categories': lambda: _get('/api/categories'),
+        'api:search:trending': lambda: _get('/api/search/trending'),
+        'search:suggestions': SuggestionService.load,
+        'analytics:sales_overview': AnalyticsService.get_sales_overview,
+    }
+
+    @staticmethod
+    def warm(app, names: Optional[Iterable[str]] = None, max_workers: Optional[int] = None) -> List[Dict]:
+        """
+        Run warm-up tasks in parallel.
+
+        Args:
+            app: Flask application
+            names: Tasks to run (default: all)
+            max_workers: Maximum number of tasks running at once
+                (default: CACHE_WARM_WORKERS)
+
+        Returns:
+            One dictionary per task with 'name', 'ok', 'seconds' and 'error'
+        """
+        names = list(CacheWarmer.TASKS) if names is None else list(names)
+        unknown = [name for name in names if name not in CacheWarmer.TASKS]
+        if unknown:
+            raise ValueError(f"Unknown warm-up tasks: {', '.join(unknown)}")
+        if not names:
+            return []
+
+        max_workers = max_workers or app.config.get('CACHE_WARM_WORKERS', CacheWarmer.DEFAULT_WORKERS)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names))),
+                                thread_name_prefix='cache-warm') as pool:
+            return list(pool.map(lambda name: CacheWarmer._run(app, name), names))
+
+    @staticmethod
+    def _run(app, name: str) -> Dict:
+        with app.app_context():
+            started = time.perf_counter()
+            error = None
+            try:
+                CacheWarmer.TASKS[name]()
+            except Exception as e:
+                error = str(e)
+                app.logger.error(f'Cache warm-up task {name} failed: {e}')
+            finally:
+                db.session.remove()
+            return {'name': name, 'ok': error is None, 'seconds': time.perf_counter() - started,
+                    'error': error}
+
+    @staticmethod
+    def warm_in_background(app) -> threading.Thread:
+        """
+        Warm the cache in a daemon thread without delaying startup.
+
+        Args:
+            app: Flask application
+
+        Returns:
+            The started thread
+        """
+        def run():
+            started = time.perf_counter()
+            results = CacheWarmer.warm(app)
+            failed = [result['name'] for result in results if not result['ok']]
+            app.logger.info(f'Cache warmed in {time.perf_counter() - started:.2f}s '
+                            f'({len(results) - len(failed)}/{len(results)} tasks ok)')
+
+        thread = threading.Thread(target=run, name='cache-warm', daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def warm_on_first_request(app) -> None:
+        """
+        Start the background warm-up when a process serves its first request.
+
+        ``create_app`` also runs for every ``flask`` CLI command, which never
+        serves a request, and a thread started in a ``gunicorn --preload``
+        master does not exist in the forked workers. Keying the start on the
+        process ID warms each serving process exactly once.
+
+        Args:
+            app: Flask application
+        """
+        lock = threading.Lock()
+        state = {'pid': None}
+
+        @app.before_request
+        def start_cache_warm_up():
+            pid = os.getpid()
+            if state['pid'] == pid:
+                return
+            with lock:
+                if state['pid'] != pid:
+                    state['pid'] = pid
+                    CacheWarmer.warm_in_background(app)
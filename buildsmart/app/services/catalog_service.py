@@ -0,0 +1,60 @@
+"""
+Catalog service.
+
+Featured content for the home page. The featured shops, products and
+services are picked once and cached as lists of ids (tagged ``search``,
+which any catalog change bumps); each request loads the rows with one
+``IN`` query per model.
+"""
+from typing import Dict, List
+from app.models import Shop, Product, Service
+from app.services.cache_service import CacheService
+from app.utils.query_optimization import load_by_ids
+
+
+class CatalogService:
+    """Service for featured catalog content."""
+
+    FEATURED_KEY = 'home:featured'
+    FEATURED_TIMEOUT = 600  # 10 minutes; catalog changes invalidate it sooner
+
+    # Number of featured items per section
+    FEATURED_LIMITS = {'shops': 6, 'products': 8, 'services': 6}
+
+    @staticmethod
+    def get_featured_ids() -> Dict[str, List[int]]:
+        """
+        Get the ids of the featured shops, products and services.
+
+        Returns:
+            Dictionary with 'shops', 'products' and 'services' id lists
+        """
+        def pick() -> Dict[str, List[int]]:
+            limits = CatalogService.FEATURED_LIMITS
+            return {
+                'shops': [row.id for row in Shop.query.with_entities(Shop.id)
+                          .filter_by(is_verified=True, is_active=True).limit(limits['shops'])],
+                'products': [row.id for row in Product.query.with_entities(Product.id)
+                             .filter_by(is_available=True).limit(limits['products'])],
+                'services': [row.id for row in Service.query.with_entities(Service.id)
+                             .filter_by(is_available=True).limit(limits['services'])],
+            }
+
+        return CacheService.get_or_set(CatalogService.FEATURED_KEY, pick,
+                                       timeout=CatalogService.FEATURED_TIMEOUT,
+                                       tags=[CacheService.PREFIX_SEARCH])
+
+    @staticmethod
+    def get_featured() -> Dict[str, list]:
+        """
+        Get the featured shops, products and services.
+
+        Returns:
+            Dictionary with 'shops', 'products' and 'services' model lists
+        """
+        ids = CatalogService.get_featured_ids()
+        return {
+            'shops': load_by_ids(Shop.query, ids['shops']),
+            'products': load_by_ids(Product.query, ids['products']),
+            'services': load_by_ids(Service.query, ids['services']),
+        }
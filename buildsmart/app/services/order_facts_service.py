@@ -0,0 +1,390 @@
+"""
+Columnar analytics over exported order facts.
+
+Ad-hoc reports that slice orders by product, shop and category join
+``orders``, ``order_items``, ``products``, ``shops`` and ``categories``
+on the primary database. ``flask analytics-export`` runs that join
+offline and writes the result, one denormalized row per order item
+(orders without items get one row without item columns), to local files
+partitioned by the month of the order::
+
+    <ANALYTICS_FACTS_PATH>/month=2024-03/facts.parquet
+    <ANALYTICS_FACTS_PATH>/_export.json
+
+Files are Parquet when pyarrow or fastparquet is installed and CSV
+otherwise. Exports are incremental: only months with orders created or
+updated since the previous export are written again, each replacing its
+partition atomically. ``full=True`` rewrites every month and drops
+partitions of months without orders, which also removes deleted orders.
+
+With ``ANALYTICS_ENGINE = 'facts'`` the top products, top shops and
+category performance reports group the facts of the months in range
+with pandas instead of querying the database. They are as fresh as the
+last export. Each worker keeps the partitions it read in memory until
+their files change.
+"""
+import json
+import os
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+import pandas as pd
+from flask import current_app
+from sqlalchemy import distinct, or_
+from app.extensions import db
+from app.models import Category, Order, OrderItem, Product, Shop
+from app.utils.date_ranges import bucket_date, date_bucket, date_window, in_date_range, resolve_date_range
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no cover - optional dependency
+    pyarrow = None
+
+try:
+    import fastparquet
+except ImportError:  # pragma: no cover - optional dependency
+    fastparquet = None
+
+EXPORT_VERSION = 1
+STATE_FILE = '_export.json'
+
+# Orders updated this long before an export started are exported again by
+# the next one, so transactions still open during an export are not missed
+EXPORT_OVERLAP = timedelta(minutes=5)
+
+# Fact columns and their pandas dtypes
+FACT_COLUMNS = {
+    'order_id': 'int64',
+    'created_at': 'datetime64[ns]',
+    'status': 'string',
+    'payment_status': 'string',
+    'order_total': 'float64',
+    'customer_id': 'Int64',
+    'shop_id': 'Int64',
+    'shop_name': 'string',
+    'order_item_id': 'Int64',
+    'product_id': 'Int64',
+    'product_name': 'string',
+    'category_id': 'Int64',
+    'category_name': 'string',
+    'quantity': 'Int64',
+    'total_price': 'float64',
+}
+
+
+def parquet_engine() -> Optional[str]:
+    """Get the installed pandas Parquet engine (None if there is none)."""
+    if pyarrow is not None:
+        return 'pyarrow'
+    if fastparquet is not None:
+        return 'fastparquet'
+    return None
+
+
+def _month_key(day: date) -> str:
+    return day.strftime('%Y-%m')
+
+
+def _month_range(month: str) -> Tuple[date, date]:
+    first = datetime.strptime(month, '%Y-%m').date()
+    following = (first + timedelta(days=32)).replace(day=1)
+    return first, following - timedelta(days=1)
+
+
+def _typed(facts: pd.DataFrame) -> pd.DataFrame:
+    facts = facts.reindex(columns=list(FACT_COLUMNS))
+    facts['created_at'] = pd.to_datetime(facts['created_at'])
+    return facts.astype(FACT_COLUMNS)
+
+
+# Per-worker partitions, keyed by file path and modification time
+_partitions_lock = threading.Lock()
+_partitions: Dict[str, Tuple[float, pd.DataFrame]] = {}
+
+# Per-worker export states, keyed the same way; read on every report while enabled
+_states: Dict[str, Tuple[float, Optional[Dict]]] = {}
+
+
+class OrderFactsService:
+    """Service for exporting order facts and reporting from them."""
+
+    @staticmethod
+    def get_path() -> Optional[str]:
+        """Get the configured facts directory (None when not configured)."""
+        return current_app.config.get('ANALYTICS_FACTS_PATH')
+
+    @staticmethod
+    def get_state() -> Optional[Dict]:
+        """Get the state of the last export (None if nothing was exported)."""
+        path = OrderFactsService.get_path()
+        if not path:
+            return None
+        state_path = os.path.join(path, STATE_FILE)
+        try:
+            mtime = os.stat(state_path).st_mtime
+        except OSError:
+            return None
+
+        entry = _states.get(state_path)
+        if entry is None or entry[0] != mtime:
+            try:
+                with open(state_path, encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+            if state is not None and state.get('version') != EXPORT_VERSION:
+                state = None
+            entry = _states[state_path] = (mtime, state)
+        return dict(entry[1]) if entry[1] is not None else None
+
+    @staticmethod
+    def is_enabled() -> bool:
+        """
+        Check whether reports should be answered from the exported facts.
+
+        The engine setting is checked first, so with the default engine no
+        file is touched; the export state is cached until its file changes.
+        """
+        return (current_app.config.get('ANALYTICS_ENGINE') == 'facts'
+                and OrderFactsService.get_state() is not None)
+
+    @staticmethod
+    def export(full: bool = False) -> Dict:
+        """
+        Export order facts of the months changed since the last export.
+
+        Args:
+            full: Export every month again and drop months without orders
+
+        Returns:
+            Dictionary with 'months' (exported, as 'YYYY-MM'), 'rows' and
+            'format'
+
+        Raises:
+            ValueError: If ANALYTICS_FACTS_PATH is not configured
+        """
+        path = OrderFactsService.get_path()
+        if not path:
+            raise ValueError('ANALYTICS_FACTS_PATH is not configured')
+
+        started = datetime.utcnow()
+        state = None if full else OrderFactsService.get_state()
+        month = date_bucket(Order.created_at, 'month', db.session.get_bind().dialect.name)
+        query = db.session.query(distinct(month)).filter(Order.created_at.isnot(None))
+        if state is not None:
+            since = datetime.fromisoformat(state['exported_at']) - EXPORT_OVERLAP
+            query = query.filter(or_(Order.created_at >= since, Order.updated_at >= since))
+        months = sorted(_month_key(bucket_date(value)) for value, in query)
+
+        os.makedirs(path, exist_ok=True)
+        engine = parquet_engine()
+        rows = 0
+        for key in months:
+            rows += OrderFactsService._export_month(path, key, engine)
+        if state is None:
+            # Nothing older survives a full export
+            for name in os.listdir(path):
+                if name.startswith('month=') and name[len('month='):] not in months:
+                    OrderFactsService._remove_partition(os.path.join(path, name))
+
+        state_path = os.path.join(path, STATE_FILE)
+        with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': EXPORT_VERSION,
+                'exported_at': started.isoformat(),
+                'format': 'parquet' if engine else 'csv',
+            }, f)
+        os.replace(state_path + '.tmp', state_path)
+
+        return {'months': months, 'rows': rows, 'format': 'parquet' if engine else 'csv'}
+
+    @staticmethod
+    def _export_month(path: str, month: str, engine: Optional[str]) -> int:
+        first, last = _month_range(month)
+        query = db.session.query(
+            Order.id.label('order_id'),
+            Order.created_at,
+            Order.status,
+            Order.payment_status,
+            Order.total_amount.label('order_total'),
+            Order.customer_id,
+            Order.shop_id,
+            Shop.name.label('shop_name'),
+            OrderItem.id.label('order_item_id'),
+            OrderItem.product_id,
+            Product.name.label('product_name'),
+            Product.category_id,
+            Category.name.label('category_name'),
+            OrderItem.quantity,
+            OrderItem.total_price
+        ).select_from(Order).outerjoin(
+            Shop, Order.shop_id == Shop.id
+        ).outerjoin(
+            OrderItem, OrderItem.order_id == Order.id
+        ).outerjoin(
+            Product, OrderItem.product_id == Product.id
+        ).outerjoin(
+            Category, Product.category_id == Category.id
+        ).filter(in_date_range(Order.created_at, first, last)).order_by(Order.id, OrderItem.id)
+        facts = _typed(pd.read_sql(query.statement, db.session.connection()))
+
+        directory = os.path.join(path, f'month={month}')
+        os.makedirs(directory, exist_ok=True)
+        name = 'facts.parquet' if engine else 'facts.csv'
+        tmp_path = os.path.join(directory, f'facts.tmp.{name.rsplit(".", 1)[1]}')
+        if engine:
+            facts.to_parquet(tmp_path, engine=engine, index=False)
+        else:
+            facts.to_csv(tmp_path, index=False, date_format='%Y-%m-%dT%H:%M:%S.%f')
+        os.replace(tmp_path, os.path.join(directory, name))
+        # A partition written in the other format is now stale
+        for other in ('facts.parquet', 'facts.csv'):
+            if other != name and os.path.exists(os.path.join(directory, other)):
+                os.remove(os.path.join(directory, other))
+        return len(facts)
+
+    @staticmethod
+    def _remove_partition(directory: str) -> None:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    @staticmethod
+    def load_facts(start_date: date, end_date: date) -> pd.DataFrame:
+        """
+        Load the facts of orders created in a range of days.
+
+        Only partitions of months overlapping the range are read.
+
+        Args:
+            start_date: First day
+            end_date: Last day, inclusive
+
+        Returns:
+            DataFrame with FACT_COLUMNS
+        """
+        path = OrderFactsService.get_path()
+        frames = []
+        month = start_date.replace(day=1)
+        while month <= end_date:
+            frame = OrderFactsService._load_partition(os.path.join(path, f'month={_month_key(month)}'))
+            if frame is not None:
+                frames.append(frame)
+            month = (month + timedelta(days=32)).replace(day=1)
+        if not frames:
+            return _typed(pd.DataFrame(columns=list(FACT_COLUMNS)))
+
+        facts = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        start, end = date_window(start_date, end_date)
+        return facts[(facts['created_at'] >= start) & (facts['created_at'] < end)]
+
+    @staticmethod
+    def _load_partition(directory: str) -> Optional[pd.DataFrame]:
+        for name in ('facts.parquet', 'facts.csv'):
+            file_path = os.path.join(directory, name)
+            try:
+                mtime = os.stat(file_path).st_mtime
+            except OSError:
+                continue
+
+            entry = _partitions.get(file_path)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+            with _partitions_lock:
+                entry = _partitions.get(file_path)
+                if entry is None or entry[0] != mtime:
+                    if name == 'facts.parquet':
+                        facts = pd.read_parquet(file_path, engine=parquet_engine())
+                    else:
+                        facts = pd.read_csv(file_path, dtype={
+                            column: dtype for column, dtype in FACT_COLUMNS.items()
+                            if column != 'created_at'
+                        }, parse_dates=['created_at'])
+                    entry = _partitions[file_path] = (mtime, _typed(facts))
+            return entry[1]
+        return None
+
+    @staticmethod
+    def _paid_items(start_date: date, end_date: date) -> pd.DataFrame:
+        facts = OrderFactsService.load_facts(start_date, end_date)
+        return facts[(facts['payment_status'] == 'paid') & facts['order_item_id'].notna()]
+
+    @staticmethod
+    def get_top_products(limit: int = 10, start_date: Optional[date] = None,
+                         end_date: Optional[date] = None) -> List[Dict]:
+        """Get top selling products; see AnalyticsService.get_top_products."""
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        items = OrderFactsService._paid_items(start_date, end_date)
+        products = items.groupby('product_id').agg(
+            product_name=('product_name', 'last'),
+            shop_id=('shop_id', 'last'),
+            shop_name=('shop_name', 'last'),
+            total_quantity=('quantity', 'sum'),
+            total_revenue=('total_price', 'sum'),
+            order_count=('order_item_id', 'count')
+        ).reset_index()
+        products = products[(products['total_quantity'] > 0) & products['product_name'].notna()].sort_values(
+            ['total_quantity', 'product_id'], ascending=[False, True]
+        ).head(limit)
+
+        return [{
+            'product_id': int(row.product_id),
+            'product_name': row.product_name,
+            'shop_id': int(row.shop_id),
+            'shop_name': row.shop_name,
+            'total_quantity': int(row.total_quantity),
+            'total_revenue': round(float(row.total_revenue), 2),
+            'order_count': int(row.order_count)
+        } for row in products.itertuples(index=False)]
+
+    @staticmethod
+    def get_top_shops(limit: int = 10, start_date: Optional[date] = None,
+                      end_date: Optional[date] = None) -> List[Dict]:
+        """Get top performing shops; see AnalyticsService.get_top_shops."""
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        facts = OrderFactsService.load_facts(start_date, end_date)
+        orders = facts[facts['payment_status'] == 'paid'].drop_duplicates('order_id')
+        shops = orders.groupby('shop_id').agg(
+            shop_name=('shop_name', 'last'),
+            total_revenue=('order_total', 'sum'),
+            total_orders=('order_id', 'count'),
+            unique_customers=('customer_id', 'nunique')
+        ).reset_index()
+        shops['total_revenue'] = shops['total_revenue'].round(2)
+        shops = shops[shops['shop_name'].notna()].sort_values(['total_revenue', 'shop_id'], ascending=[False, True]).head(limit)
+
+        return [{
+            'shop_id': int(row.shop_id),
+            'shop_name': row.shop_name,
+            'total_revenue': float(row.total_revenue),
+            'total_orders': int(row.total_orders),
+            'avg_order_value': float(row.total_revenue) / int(row.total_orders),
+            'unique_customers': int(row.unique_customers)
+        } for row in shops.itertuples(index=False)]
+
+    @staticmethod
+    def get_category_performance(start_date: Optional[date] = None,
+                                 end_date: Optional[date] = None) -> List[Dict]:
+        """Get performance metrics by category; see AnalyticsService.get_category_performance."""
+        start_date, end_date = resolve_date_range(start_date, end_date)
+        items = OrderFactsService._paid_items(start_date, end_date)
+        categories = items[items['category_id'].notna()].groupby('category_id').agg(
+            category_name=('category_name', 'last'),
+            total_revenue=('total_price', 'sum'),
+            total_quantity=('quantity', 'sum'),
+            order_count=('order_id', 'nunique'),
+            product_count=('product_id', 'nunique')
+        ).reset_index()
+        categories['total_revenue'] = categories['total_revenue'].round(2)
+        categories = categories[(categories['total_revenue'] > 0) & categories['category_name'].notna()].sort_values(
+            ['total_revenue', 'category_id'], ascending=[False, True]
+        )
+
+        return [{
+            'category_id': int(row.category_id),
+            'category_name': row.category_name,
+            'total_revenue': float(row.total_revenue),
+            'total_quantity': int(row.total_quantity),
+            'order_count': int(row.order_count),
+            'product_count': int(row.product_count)
+        } for row in categories.itertuples(index=False)]
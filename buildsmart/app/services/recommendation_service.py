@@ -0,0 +1,159 @@
+"""
+Recommendation service.
+
+Serves project recommendations without recomputing them for specs that
+were seen before. The expensive part of a recommendation (materials,
+cost estimate, services and shopping plan) depends only on the project
+type, the custom specs and where the customer is, so it is cached under
+a hash of those normalized values:
+
+- custom specs are reduced to the fields that change quantities, with
+  numbers rounded
+- the customer's location is rounded to a grid cell (~1 km) and the
+  shopping plan is computed from the cell, so nearby customers share it
+- entries are tagged ``prices``, so any price or stock change makes old
+  entries miss
+
+Serving a recommendation writes nothing. Responses carry the spec hash;
+``save_recommendation`` stores a ``Recommendation`` row when the user
+saves one, and later requests for the same spec are served from it.
+"""
+import hashlib
+import json
+from typing import Any, Dict, Optional, Tuple
+from app.extensions import db
+from app.models import Recommendation
+from app.ai.cost_estimator import PRICES_TAG
+from app.ai.recommender import MaterialRecommender, build_recommendation, resolve_project_type
+from app.services.cache_service import CacheService
+
+
+class RecommendationService:
+    """Service for cached project recommendations."""
+
+    CACHE_TIMEOUT = 3600  # 1 hour; entries also miss after price changes
+
+    # Decimal places kept of the customer's coordinates (0.01 deg ~ 1.1 km)
+    LOCATION_DECIMALS = 2
+
+    @staticmethod
+    def location_cell(user_lat: Optional[float], user_lon: Optional[float]) -> Tuple[Optional[float], Optional[float]]:
+        """Round a location to its grid cell, or (None, None) without one."""
+        if not user_lat or not user_lon:
+            return None, None
+        return (round(float(user_lat), RecommendationService.LOCATION_DECIMALS),
+                round(float(user_lon), RecommendationService.LOCATION_DECIMALS))
+
+    @staticmethod
+    def normalize_specs(custom_specs: Optional[Dict]) -> Dict[str, Any]:
+        """Keep the spec fields that affect quantities, with numbers rounded."""
+        normalized = {}
+        for field in MaterialRecommender.SPEC_FIELDS:
+            value = (custom_specs or {}).get(field)
+            if value is None or value == '':
+                continue
+            try:
+                value = round(float(value), 2)
+                if value.is_integer():
+                    value = int(value)
+            except (TypeError, ValueError):
+                pass
+            normalized[field] = value
+        return normalized
+
+    @staticmethod
+    def spec_hash(project_type: str, custom_specs: Dict, location: Tuple[Optional[float], Optional[float]]) -> str:
+        """Hash a normalized project spec and location cell."""
+        spec = {'project_type': project_type, 'custom_specs': custom_specs, 'location': list(location)}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_recommendation(user_id: int, project_description: str, project_type: Optional[str] = None,
+                           custom_specs: Optional[Dict] = None, user_lat: Optional[float] = None,
+                           user_lon: Optional[float] = None) -> Dict:
+        """
+        Get a recommendation, from the user's saved ones or the cache when possible.
+
+        Args:
+            user_id: User requesting the recommendation
+            project_description: Description of the project
+            project_type: Type of project (None = inferred from the description)
+            custom_specs: Custom specifications
+            user_lat: User latitude
+            user_lon: User longitude
+
+        Returns:
+            Recommendation dictionary (see generate_full_recommendation)
+            with 'recommendation_id', 'is_saved' and 'source' ('saved',
+            'cache' or 'computed')
+        """
+        description_match = MaterialRecommender().match_description(project_description)
+        project_type = resolve_project_type(project_type, description_match)
+        specs = RecommendationService.normalize_specs(custom_specs)
+        cell = RecommendationService.location_cell(user_lat, user_lon)
+        spec_hash = RecommendationService.spec_hash(project_type, specs, cell)
+
+        record = Recommendation.query.filter_by(user_id=user_id, spec_hash=spec_hash, is_saved=True)\
+                                     .order_by(Recommendation.updated_at.desc())\
+                                     .first()
+        if record is not None:
+            return dict(record.recommendation_data, recommendation_id=record.id, is_saved=True, source='saved')
+
+        cache_key = CacheService.tagged_key(
+            CacheService.get_cache_key(CacheService.PREFIX_RECOMMENDATION, spec_hash), [PRICES_TAG]
+        )
+        result = CacheService.get(cache_key)
+        source = 'cache'
+        if result is None:
+            result = build_recommendation(project_type, specs or None, *cell)
+            CacheService.set(cache_key, result, timeout=RecommendationService.CACHE_TIMEOUT)
+            source = 'computed'
+
+        recommendation = dict(result, matched_products=description_match['products'] if description_match else [])
+        recommendation['spec_hash'] = spec_hash
+        recommendation['recommendation_id'] = None
+        recommendation['is_saved'] = False
+        recommendation['source'] = source
+        return recommendation
+
+    @staticmethod
+    def save_recommendation(user_id: int, project_description: str, recommendation_data: Dict,
+                            project_type: Optional[str] = None,
+                            total_estimated_cost: Optional[float] = None) -> Recommendation:
+        """
+        Save a recommendation for a user.
+
+        A recommendation already stored for the same spec (``spec_hash`` in
+        the data, as returned by get_recommendation) is updated and marked
+        saved instead of adding another row.
+
+        Args:
+            user_id: User saving the recommendation
+            project_description: Description of the project
+            recommendation_data: Recommendation dictionary
+            project_type: Type of project (default: from the data)
+            total_estimated_cost: Total cost (default: from the data's cost estimate)
+
+        Returns:
+            The saved Recommendation (committed)
+        """
+        data = {key: value for key, value in recommendation_data.items()
+                if key not in ('recommendation_id', 'is_saved', 'source')}
+        spec_hash = data.get('spec_hash')
+        record = None
+        if spec_hash:
+            record = Recommendation.query.filter_by(user_id=user_id, spec_hash=spec_hash)\
+                                         .order_by(Recommendation.updated_at.desc())\
+                                         .first()
+        if record is None:
+            record = Recommendation(user_id=user_id, spec_hash=spec_hash)
+            db.session.add(record)
+        if total_estimated_cost is None:
+            total_estimated_cost = (data.get('cost_estimate') or {}).get('total')
+        record.project_type = project_type or data.get('project_type') or 'general'
+        record.project_description = project_description
+        record.total_estimated_cost = total_estimated_cost
+        record.recommendation_data = data
+        record.is_saved = True
+        db.session.commit()
+        return record
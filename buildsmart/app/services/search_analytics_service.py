@@ -0,0 +1,311 @@
+"""
+Search analytics service.
+
+Search events (search history and trending query counts) are recorded
+into a bounded in-process buffer and written in bulk by a background
+worker, so search requests never wait on analytics writes or contend on
+the ``trending_searches`` rows. Each flush performs one multi-row INSERT
+into ``search_history`` and one UPSERT into ``trending_searches`` that
+adds the number of searches seen per query.
+
+When the buffer is full new events are dropped and counted rather than
+blocking the request.
+"""
+import atexit
+import queue
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional
+from flask import current_app
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from app.extensions import db
+from app.models import SearchHistory, TrendingSearch
+from app.services.suggestion_service import SuggestionService
+
+_EXTENSION_KEY = 'search_analytics'
+
+
+class SearchEventBuffer:
+    """Bounded buffer of search events with a background flush worker."""
+
+    def __init__(self, app, max_size: int, batch_size: int, flush_interval: float,
+                 run_worker: bool = True):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.run_worker = run_worker
+        self.counters = {'recorded': 0, 'dropped': 0, 'flushed': 0, 'failed': 0, 'batches': 0}
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._counter_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def record(self, event: Dict) -> bool:
+        """
+        Add an event to the buffer without blocking.
+
+        Args:
+            event: Search event dictionary
+
+        Returns:
+            True if the event was buffered, False if it was dropped
+        """
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._counter_lock:
+                self.counters['dropped'] += 1
+                dropped = self.counters['dropped']
+            # Log the first overflow and then every thousandth
+            if dropped % 1000 == 1:
+                self.app.logger.warning(f'Search analytics buffer full; {dropped} events dropped so far')
+            return False
+
+        with self._counter_lock:
+            self.counters['recorded'] += 1
+        if self.run_worker:
+            self._ensure_worker()
+            if self._queue.qsize() >= self.batch_size:
+                self._wakeup.set()
+        return True
+
+    def pending(self) -> int:
+        """Get the number of buffered events."""
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        """Get buffer counters and current size."""
+        with self._counter_lock:
+            stats = dict(self.counters)
+        stats['pending'] = self.pending()
+        stats['capacity'] = self._queue.maxsize
+        return stats
+
+    def flush(self) -> int:
+        """
+        Write all buffered events to the database.
+
+        Must be called within an application context.
+
+        Returns:
+            Number of events written
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                events = self._drain(self.batch_size)
+                if not events:
+                    break
+                try:
+                    trending = _write_events(events)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    with self._counter_lock:
+                        self.counters['failed'] += len(events)
+                    current_app.logger.error(f'Error writing {len(events)} search events: {e}')
+                    continue
+
+                with self._counter_lock:
+                    self.counters['flushed'] += len(events)
+                    self.counters['batches'] += 1
+                written += len(events)
+                _publish_trending(trending)
+        return written
+
+    def _drain(self, limit: int) -> List[Dict]:
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='search-analytics-flusher', daemon=True
+                )
+                self._worker.start()
+                atexit.register(self._flush_on_exit)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush_in_context()
+
+    def _flush_in_context(self) -> None:
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception as e:
+                self.app.logger.error(f'Search analytics flush failed: {e}')
+            finally:
+                db.session.remove()
+
+    def _flush_on_exit(self) -> None:
+        if self.pending():
+            self._flush_in_context()
+
+
+class SearchAnalyticsService:
+    """Service for recording search analytics."""
+
+    @staticmethod
+    def record_search(query: str, search_type: str = 'products', user_id: Optional[int] = None,
+                      results_count: int = 0) -> bool:
+        """
+        Record a search without writing to the database.
+
+        Args:
+            query: Search query as entered
+            search_type: Type of search (products, shops, services)
+            user_id: Searching user ID (history is only kept for signed-in users)
+            results_count: Number of results found
+
+        Returns:
+            True if the event was buffered, False if it was dropped
+        """
+        query = (query or '').strip()
+        if not query:
+            return False
+        return SearchAnalyticsService.get_buffer().record({
+            'query': query,
+            'search_type': search_type,
+            'user_id': user_id,
+            'results_count': results_count,
+            'searched_at': datetime.utcnow(),
+        })
+
+    @staticmethod
+    def flush() -> int:
+        """
+        Write buffered search events now.
+
+        Returns:
+            Number of events written
+        """
+        return SearchAnalyticsService.get_buffer().flush()
+
+    @staticmethod
+    def get_stats() -> Dict[str, int]:
+        """
+        Get search analytics buffer counters.
+
+        Returns:
+            Dictionary with recorded, dropped, flushed, failed, batches,
+            pending and capacity counts
+        """
+        return SearchAnalyticsService.get_buffer().stats()
+
+    @staticmethod
+    def get_buffer() -> SearchEventBuffer:
+        """Get the search event buffer for the current application."""
+        app = current_app._get_current_object()
+        buffer = app.extensions.get(_EXTENSION_KEY)
+        if buffer is None:
+            buffer = app.extensions.setdefault(_EXTENSION_KEY, SearchEventBuffer(
+                app,
+                max_size=app.config.get('SEARCH_ANALYTICS_BUFFER_SIZE', 10000),
+                batch_size=app.config.get('SEARCH_ANALYTICS_BATCH_SIZE', 500),
+                flush_interval=app.config.get('SEARCH_ANALYTICS_FLUSH_INTERVAL', 2.0),
+                run_worker=app.config.get('SEARCH_ANALYTICS_ASYNC', True),
+            ))
+        return buffer
+
+
+def _write_events(events: List[Dict]) -> List[tuple]:
+    """
+    Write a batch of events in the current transaction.
+
+    Returns:
+        List of (query, search_type, count) for the updated trending rows
+    """
+    history = [{
+        'user_id': event['user_id'],
+        'query': event['query'],
+        'search_type': event['search_type'],
+        'results_count': event['results_count'],
+        'created_at': event['searched_at'],
+    } for event in events if event['user_id'] is not None]
+    if history:
+        db.session.execute(insert(SearchHistory.__table__).values(history))
+
+    # One row per query: repeated queries in a batch become a single increment
+    searches = OrderedDict()
+    for event in events:
+        key = event['query'].lower()
+        row = searches.get(key)
+        if row is None:
+            searches[key] = {
+                'query': key,
+                'search_type': event['search_type'],
+                'count': 1,
+                'last_searched': event['searched_at'],
+                'created_at': event['searched_at'],
+            }
+        else:
+            row['count'] += 1
+            row['last_searched'] = max(row['last_searched'], event['searched_at'])
+
+    # Sorted so concurrent writers lock rows in the same order
+    rows = [searches[key] for key in sorted(searches)]
+    _upsert_trending(rows)
+
+    table = TrendingSearch.__table__
+    return [tuple(row) for row in db.session.execute(
+        select(table.c.query, table.c.search_type, table.c['count']).where(table.c.query.in_(sorted(searches)))
+    )]
+
+
+def _upsert_trending(rows: List[Dict]) -> None:
+    table = TrendingSearch.__table__
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        statement = dialect_insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.query],
+            set_={
+                'count': table.c['count'] + statement.excluded['count'],
+                'last_searched': statement.excluded.last_searched,
+            }
+        )
+        db.session.execute(statement)
+    elif dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table).values(rows)
+        statement = statement.on_duplicate_key_update(
+            count=table.c['count'] + statement.inserted['count'],
+            last_searched=statement.inserted.last_searched,
+        )
+        db.session.execute(statement)
+    else:
+        for row in rows:
+            updated = db.session.execute(
+                table.update().where(table.c.query == row['query']).values(
+                    count=table.c['count'] + row['count'], last_searched=row['last_searched']
+                )
+            ).rowcount
+            if not updated:
+                db.session.execute(table.insert().values(row))
+
+
+def _publish_trending(trending: List[tuple]) -> None:
+    # Bulk statements bypass the ORM events that feed the suggestion index
+    operations = [['trending', search_type or 'products', query, count or 0]
+                  for query, search_type, count in trending]
+    try:
+        SuggestionService.apply_changes(operations)
+    except Exception as e:
+        current_app.logger.error(f'Error updating suggestion index: {e}')
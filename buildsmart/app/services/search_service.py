@@ -0,0 +1,287 @@
+"""
+Full-text search service.
+
+This service provides indexed text search over products, shops and
+services with relevance ranking. The backend is chosen from the
+database dialect:
+
+- PostgreSQL: ``to_tsvector`` expressions backed by GIN indexes, ranked
+  with ``ts_rank``. PostgreSQL keeps the expression index up to date.
+- SQLite: FTS5 virtual tables ranked with ``bm25``, kept in sync from
+  the ORM by mapper events in the same transaction as the row change.
+- Anything else: ``ILIKE`` substring matching without ranking.
+"""
+import re
+import sqlite3
+from typing import Dict, List, Tuple
+from sqlalchemy import DDL, Float, Integer, event, func, inspect, literal, literal_column, or_, text
+from app.extensions import db
+from app.models import Product, Shop, Service
+
+
+class SearchService:
+    """Service for full-text search operations."""
+
+    # Indexed models: FTS5 table name and (title, body) columns
+    DOCUMENTS = {
+        Product: ('products_fts', ('name', 'description')),
+        Shop: ('shops_fts', ('name', 'description')),
+        Service: ('services_fts', ('title', 'description')),
+    }
+
+    # Relevance weights for the title and body columns
+    TITLE_WEIGHT = 10.0
+    BODY_WEIGHT = 1.0
+
+    TS_CONFIG = "'english'::regconfig"
+
+    _TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+    # FTS tables known to exist, keyed by (engine url, table name)
+    _fts_tables: Dict[Tuple[str, str], bool] = {}
+
+    @staticmethod
+    def tokenize(query: str) -> List[str]:
+        """
+        Split a user query into search terms.
+
+        Args:
+            query: Raw search query
+
+        Returns:
+            List of lowercase terms (punctuation and operators removed)
+        """
+        return [token.lower() for token in SearchService._TOKEN_RE.findall(query or '')]
+
+    @staticmethod
+    def backend_name() -> str:
+        """
+        Get the search backend for the current database.
+
+        Returns:
+            'postgresql', 'sqlite' or 'like'
+        """
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            return 'postgresql'
+        if dialect == 'sqlite' and SearchService._fts_table_exists(db.session.connection(), Product):
+            return 'sqlite'
+        return 'like'
+
+    @staticmethod
+    def apply_text_search(query, model, search_text: str):
+        """
+        Restrict a query to rows matching a text search and rank them.
+
+        Args:
+            query: SQLAlchemy query selecting ``model``
+            model: Indexed model class (Product, Shop or Service)
+            search_text: Raw user search text
+
+        Returns:
+            Tuple of (filtered query, relevance expression); higher
+            relevance is a better match
+        """
+        terms = SearchService.tokenize(search_text)
+        backend = SearchService.backend_name()
+
+        if not terms or backend == 'like':
+            return SearchService._like_search(query, model, search_text)
+        if backend == 'postgresql':
+            return SearchService._postgres_search(query, model, terms)
+        return SearchService._sqlite_search(query, model, terms)
+
+    @staticmethod
+    def _columns(model):
+        table_name, (title, body) = SearchService.DOCUMENTS[model]
+        return table_name, getattr(model, title), getattr(model, body)
+
+    @staticmethod
+    def _like_search(query, model, search_text: str):
+        _, title_column, body_column = SearchService._columns(model)
+        query = query.filter(
+            or_(title_column.ilike(f'%{search_text}%'), body_column.ilike(f'%{search_text}%'))
+        )
+        return query, literal(0.0, Float)
+
+    @staticmethod
+    def _postgres_document(model):
+        _, title_column, body_column = SearchService._columns(model)
+        return func.to_tsvector(
+            literal_column(SearchService.TS_CONFIG),
+            func.coalesce(title_column, '').op('||')(' ').op('||')(func.coalesce(body_column, ''))
+        )
+
+    @staticmethod
+    def _postgres_search(query, model, terms: List[str]):
+        _, title_column, body_column = SearchService._columns(model)
+        ts_query = func.to_tsquery(
+            literal_column(SearchService.TS_CONFIG),
+            ' & '.join(f'{term}:*' for term in terms)
+        )
+        # Matches on the same expression as the GIN index so it can be used
+        query = query.filter(SearchService._postgres_document(model).op('@@')(ts_query))
+
+        weighted = func.setweight(
+            func.to_tsvector(literal_column(SearchService.TS_CONFIG), func.coalesce(title_column, '')), 'A'
+        ).op('||')(func.setweight(
+            func.to_tsvector(literal_column(SearchService.TS_CONFIG), func.coalesce(body_column, '')), 'B'
+        ))
+        return query, func.ts_rank(weighted, ts_query)
+
+    @staticmethod
+    def _sqlite_search(query, model, terms: List[str]):
+        table_name, _, _ = SearchService._columns(model)
+        match = ' '.join(f'"{term}"*' for term in terms)
+        matches = text(
+            f'SELECT rowid AS doc_id, -bm25({table_name}, :title_weight, :body_weight) AS score '
+            f'FROM {table_name} WHERE {table_name} MATCH :match'
+        ).bindparams(
+            title_weight=SearchService.TITLE_WEIGHT,
+            body_weight=SearchService.BODY_WEIGHT,
+            match=match
+        ).columns(doc_id=Integer, score=Float).subquery(f'{table_name}_matches')
+
+        query = query.join(matches, matches.c.doc_id == model.id)
+        return query, matches.c.score
+
+    # ------------------------------------------------------------------
+    # Index maintenance
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _fts_table_exists(connection, model) -> bool:
+        table_name = SearchService.DOCUMENTS[model][0]
+        key = (str(connection.engine.url), table_name)
+        if key not in SearchService._fts_tables:
+            SearchService._fts_tables[key] = connection.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': table_name}
+            ).first() is not None
+        return SearchService._fts_tables[key]
+
+    @staticmethod
+    def _index_document(connection, model, target) -> None:
+        table_name, (title, body) = SearchService.DOCUMENTS[model]
+        connection.execute(text(f'DELETE FROM {table_name} WHERE rowid = :id'), {'id': target.id})
+        connection.execute(
+            text(f'INSERT INTO {table_name} (rowid, {title}, {body}) VALUES (:id, :title, :body)'),
+            {'id': target.id, 'title': getattr(target, title) or '', 'body': getattr(target, body) or ''}
+        )
+
+    @staticmethod
+    def rebuild_index() -> Dict[str, int]:
+        """
+        Rebuild the full-text index from the current table contents.
+
+        On SQLite the FTS5 tables are created if missing and repopulated;
+        on PostgreSQL the GIN indexes are created if missing.
+
+        Returns:
+            Dictionary mapping index name to number of indexed rows
+        """
+        connection = db.session.connection()
+        dialect = connection.dialect.name
+        counts = {}
+
+        for model, (table_name, (title, body)) in SearchService.DOCUMENTS.items():
+            if dialect == 'postgresql':
+                connection.execute(text(_postgres_index_sql(model)))
+                counts[f'ix_{model.__tablename__}_fts'] = model.query.count()
+            elif dialect == 'sqlite':
+                connection.execute(text(_sqlite_fts_sql(model)))
+                SearchService._fts_tables[(str(connection.engine.url), table_name)] = True
+                connection.execute(text(f'DELETE FROM {table_name}'))
+                connection.execute(text(
+                    f'INSERT INTO {table_name} (rowid, {title}, {body}) '
+                    f"SELECT id, coalesce({title}, ''), coalesce({body}, '') FROM {model.__tablename__}"
+                ))
+                counts[table_name] = connection.execute(
+                    text(f'SELECT count(*) FROM {table_name}')
+                ).scalar()
+
+        db.session.commit()
+        return counts
+
+
+def _sqlite_fts_sql(model) -> str:
+    table_name, (title, body) = SearchService.DOCUMENTS[model]
+    return (f'CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} '
+            f"USING fts5({title}, {body}, tokenize = 'porter unicode61')")
+
+
+def _postgres_index_sql(model) -> str:
+    _, (title, body) = SearchService.DOCUMENTS[model]
+    table = model.__tablename__
+    return (f'CREATE INDEX IF NOT EXISTS ix_{table}_fts ON {table} USING GIN '
+            f"(to_tsvector({SearchService.TS_CONFIG}, coalesce({title}, '') || ' ' || coalesce({body}, '')))")
+
+
+def _sqlite_fts5_available() -> bool:
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE fts5_probe USING fts5(content)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _make_sync_listener(model, only_if_changed=False):
+    _, (title, body) = SearchService.DOCUMENTS[model]
+
+    def sync(mapper, connection, target):
+        if connection.dialect.name != 'sqlite' or not SearchService._fts_table_exists(connection, model):
+            return
+        if only_if_changed:
+            state = inspect(target)
+            if not (state.attrs[title].history.has_changes() or state.attrs[body].history.has_changes()):
+                return
+        SearchService._index_document(connection, model, target)
+    return sync
+
+
+def _make_delete_listener(model):
+    def remove(mapper, connection, target):
+        if connection.dialect.name != 'sqlite' or not SearchService._fts_table_exists(connection, model):
+            return
+        table_name = SearchService.DOCUMENTS[model][0]
+        connection.execute(text(f'DELETE FROM {table_name} WHERE rowid = :id'), {'id': target.id})
+    return remove
+
+
+def _forget_fts_table(model):
+    def forget(target, connection, **kw):
+        table_name = SearchService.DOCUMENTS[model][0]
+        SearchService._fts_tables.pop((str(connection.engine.url), table_name), None)
+    return forget
+
+
+_registered = False
+
+
+def register_search_index() -> None:
+    """
+    Register DDL and ORM hooks that keep the full-text index in sync.
+
+    Index structures are created alongside their tables by
+    ``db.create_all()`` (FTS5 tables on SQLite, GIN indexes on PostgreSQL),
+    and SQLite FTS rows are written whenever an indexed model is flushed.
+    """
+    global _registered
+    if _registered:
+        return
+    _registered = True
+
+    fts5_available = _sqlite_fts5_available()
+
+    for model, (table_name, _) in SearchService.DOCUMENTS.items():
+        table = model.__table__
+        if fts5_available:
+            event.listen(table, 'after_create', DDL(_sqlite_fts_sql(model)).execute_if(dialect='sqlite'))
+            event.listen(table, 'before_drop', DDL(f'DROP TABLE IF EXISTS {table_name}').execute_if(dialect='sqlite'))
+        event.listen(table, 'after_create', DDL(_postgres_index_sql(model)).execute_if(dialect='postgresql'))
+        event.listen(table, 'after_create', _forget_fts_table(model))
+        event.listen(table, 'after_drop', _forget_fts_table(model))
+
+        event.listen(model, 'after_insert', _make_sync_listener(model))
+        event.listen(model, 'after_update', _make_sync_listener(model, only_if_changed=True))
+        event.listen(model, 'after_delete', _make_delete_listener(model))
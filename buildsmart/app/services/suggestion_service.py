@@ -0,0 +1,599 @@
+"""
+Search suggestion service.
+
+This service answers autocomplete requests from an in-memory completion
+index over product, shop and service names and trending search queries,
+so suggestions never hit the database.
+
+Every worker keeps its own copy of the index. Workers share it through a
+snapshot file (written by ``flask rebuild-suggestions`` or by the first
+worker that starts without one) and an append-only journal next to it:
+committed changes to indexed models are appended to the journal and
+replayed by the other workers on their next request.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, or_
+from sqlalchemy.orm import Session, object_session
+from app.extensions import db
+from app.models import Product, Shop, Service, TrendingSearch
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Indexed models: search type, text attribute and visibility flag
+CATALOG = {
+    Product: ('products', 'name', 'is_available'),
+    Shop: ('shops', 'name', 'is_active'),
+    Service: ('services', 'title', 'is_available'),
+}
+
+SNAPSHOT_VERSION = 1
+
+_EXTENSION_KEY = 'suggestion_index'
+_PENDING_KEY = 'suggestion_ops'
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens."""
+    return [token.lower() for token in _TOKEN_RE.findall(text or '')]
+
+
+def normalize(text: str) -> str:
+    """Normalize text for exact comparisons (case and punctuation insensitive)."""
+    return ' '.join(tokenize(text))
+
+
+def trending_group(search_type: str) -> str:
+    """Get the index group holding trending queries for a search type."""
+    return f'trending:{search_type}'
+
+
+class _Node:
+    __slots__ = ('children', 'keys', 'top', 'size')
+
+    def __init__(self):
+        self.children = {}
+        self.keys = set()
+        self.top = None
+        self.size = 0  # number of entry words in this subtree
+
+
+class SuggestionIndex:
+    """
+    Word-prefix index returning the highest weighted entries for a query.
+
+    Entries live in named groups and are indexed under every word of their
+    text, so "cem" completes "Portland Cement". Each trie node caches its
+    best ``CACHE_SIZE`` entries; changes only invalidate the caches along
+    the changed words' paths.
+    """
+
+    CACHE_SIZE = 32
+
+    # Largest subtree scanned when a multi-term query is not satisfied by
+    # the cached results; broader queries settle for the cached candidates.
+    SCAN_LIMIT = 200
+
+    def __init__(self):
+        self.entries: Dict[Tuple[str, object], Tuple[str, float]] = {}
+        self._roots: Dict[str, _Node] = {}
+        self._by_text: Dict[Tuple[str, str], set] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, group: str, key) -> Optional[Tuple[str, float]]:
+        """Get the (text, weight) of an entry, or None."""
+        return self.entries.get((group, key))
+
+    def keys_for_text(self, group: str, text: str) -> List:
+        """Get keys of entries in a group whose normalized text equals ``text``."""
+        return list(self._by_text.get((group, normalize(text)), ()))
+
+    def put(self, group: str, key, text: str, weight: float) -> None:
+        """Add or replace an entry."""
+        self.remove(group, key)
+        self.entries[(group, key)] = (text, float(weight))
+
+        root = self._roots.setdefault(group, _Node())
+        for token in set(tokenize(text)):
+            path = self._path(root, token, create=True)
+            path[-1].keys.add(key)
+            for node in path:
+                node.top = None
+                node.size += 1
+        self._by_text.setdefault((group, normalize(text)), set()).add(key)
+
+    def remove(self, group: str, key) -> None:
+        """Remove an entry if present."""
+        entry = self.entries.pop((group, key), None)
+        if entry is None:
+            return
+
+        root = self._roots[group]
+        for token in set(tokenize(entry[0])):
+            path = self._path(root, token)
+            path[-1].keys.discard(key)
+            for node in path:
+                node.top = None
+                node.size -= 1
+            # Prune branches that no longer lead to any entry
+            for depth in range(len(token), 0, -1):
+                node = path[depth]
+                if node.keys or node.children:
+                    break
+                del path[depth - 1].children[token[depth - 1]]
+
+        text_key = (group, normalize(entry[0]))
+        self._by_text[text_key].discard(key)
+        if not self._by_text[text_key]:
+            del self._by_text[text_key]
+
+    def top(self, group: str, query: str, limit: int) -> List[Tuple[object, str, float]]:
+        """
+        Get the best entries whose words start with every query term.
+
+        Args:
+            group: Index group to search
+            query: Query text; each term is matched as a word prefix
+            limit: Maximum number of results
+
+        Returns:
+            List of (key, text, weight), best first
+        """
+        terms = tokenize(query)
+        root = self._roots.get(group)
+        if not terms or root is None or limit <= 0:
+            return []
+
+        # Walk the most selective term; the others filter its candidates
+        node = None
+        for term in terms:
+            path = self._path(root, term)
+            if path is None:
+                return []
+            if node is None or path[-1].size < node.size:
+                node = path[-1]
+
+        candidates = None
+        if limit <= self.CACHE_SIZE or node.size > self.SCAN_LIMIT:
+            candidates = self._cached_top(group, node)
+            if len(terms) > 1:
+                complete = len(candidates) < self.CACHE_SIZE
+                candidates = [key for key in candidates if self._matches(group, key, terms)]
+                if len(candidates) < limit and not complete and node.size <= self.SCAN_LIMIT:
+                    candidates = None
+        if candidates is None:
+            keys = [key for key in self._subtree_keys(node) if self._matches(group, key, terms)]
+            candidates = self._rank(group, keys)
+
+        return [(key,) + self.entries[(group, key)] for key in candidates[:limit]]
+
+    def _path(self, root: _Node, token: str, create: bool = False) -> Optional[List[_Node]]:
+        path = [root]
+        node = root
+        for char in token:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = _Node()
+            node = child
+            path.append(node)
+        return path
+
+    def _rank(self, group: str, keys: Iterable) -> List:
+        entries = self.entries
+
+        def sort_key(key):
+            text, weight = entries[(group, key)]
+            return -weight, len(text), text, str(key)
+
+        return sorted(keys, key=sort_key)
+
+    def _cached_top(self, group: str, node: _Node) -> List:
+        if node.top is None:
+            # A node's best entries are among its own and its children's best
+            keys = set(node.keys)
+            for child in node.children.values():
+                keys.update(self._cached_top(group, child))
+            node.top = self._rank(group, keys)[:self.CACHE_SIZE]
+        return node.top
+
+    def _subtree_keys(self, node: _Node) -> set:
+        keys = set()
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            keys.update(current.keys)
+            stack.extend(current.children.values())
+        return keys
+
+    def _matches(self, group: str, key, terms: Sequence[str]) -> bool:
+        tokens = tokenize(self.entries[(group, key)][0])
+        return all(any(token.startswith(term) for token in tokens) for term in terms)
+
+
+def apply_operation(index: SuggestionIndex, operation: Sequence) -> None:
+    """
+    Apply a change operation to an index.
+
+    Operations are JSON-serializable lists so they can be journaled:
+
+    - ``['catalog', search_type, id, text]``: add or update a name
+    - ``['uncatalog', search_type, id]``: remove a name
+    - ``['trending', search_type, query, count]``: add or update a trending query
+    - ``['untrending', search_type, query]``: remove a trending query
+
+    Names are weighted by the count of the trending query equal to the
+    name, so popular items rank first.
+    """
+    kind, search_type, key = operation[0], operation[1], operation[2]
+
+    if kind == 'catalog':
+        text = operation[3]
+        index.put(search_type, key, text, 1 + _popularity(index, search_type, text))
+    elif kind == 'uncatalog':
+        index.remove(search_type, key)
+    elif kind in ('trending', 'untrending'):
+        key = normalize(key)
+        if kind == 'trending':
+            index.put(trending_group(search_type), key, operation[2], operation[3])
+        else:
+            index.remove(trending_group(search_type), key)
+        for name_key in index.keys_for_text(search_type, key):
+            text, _ = index.get(search_type, name_key)
+            index.put(search_type, name_key, text, 1 + _popularity(index, search_type, text))
+
+
+def _popularity(index: SuggestionIndex, search_type: str, text: str) -> float:
+    entry = index.get(trending_group(search_type), normalize(text))
+    return entry[1] if entry else 0.0
+
+
+class _IndexState:
+    """A worker's index plus its position in the shared snapshot and journal."""
+
+    def __init__(self, index: SuggestionIndex, path: Optional[str],
+                 generation: Optional[str] = None, offset: int = 0):
+        self.index = index
+        self.path = path
+        self.generation = generation
+        self.offset = offset
+        self.checked_at = time.monotonic()
+        self.lock = threading.RLock()
+
+
+class SuggestionService:
+    """Service for search suggestions."""
+
+    SINGULAR = {'products': 'product', 'shops': 'shop', 'services': 'service'}
+
+    @staticmethod
+    def suggest(query: str, search_type: str = 'products', limit: int = 10,
+                trending_limit: int = 5) -> Dict[str, list]:
+        """
+        Get completions for a partial query.
+
+        Args:
+            query: Partial search text
+            search_type: 'products', 'shops' or 'services'
+            limit: Maximum number of name suggestions
+            trending_limit: Maximum number of trending queries
+
+        Returns:
+            Dictionary with 'suggestions' and 'trending' lists
+        """
+        state = SuggestionService._state()
+        with state.lock:
+            SuggestionService._refresh(state)
+            names = state.index.top(search_type, query, limit)
+            trending = state.index.top(trending_group(search_type), query, trending_limit)
+
+        item_type = SuggestionService.SINGULAR.get(search_type, search_type)
+        return {
+            'suggestions': [{'text': text, 'type': item_type, 'id': key} for key, text, _ in names],
+            'trending': [{'text': text, 'count': int(weight)} for _, text, weight in trending],
+        }
+
+    @staticmethod
+    def load() -> int:
+        """
+        Load this worker's index (from the snapshot or the database) if needed.
+
+        Returns:
+            Number of indexed entries
+        """
+        state = SuggestionService._state()
+        with state.lock:
+            SuggestionService._refresh(state)
+            return len(state.index)
+
+    @staticmethod
+    def rebuild() -> int:
+        """
+        Rebuild the index from the database and publish a new snapshot.
+
+        Returns:
+            Number of indexed entries
+        """
+        app = current_app._get_current_object()
+        state = SuggestionService._build(app)
+        app.extensions[_EXTENSION_KEY] = state
+        return len(state.index)
+
+    @staticmethod
+    def apply_changes(operations: List[Sequence]) -> None:
+        """
+        Publish index changes to this worker and, through the journal, to others.
+
+        Args:
+            operations: Operations as accepted by ``apply_operation``
+        """
+        if not operations:
+            return
+
+        state = current_app.extensions.get(_EXTENSION_KEY)
+        path = state.path if state else _snapshot_path(current_app)
+        generation = state.generation if state else None
+        if path and generation is None:
+            generation = _read_generation(path)
+
+        if path and generation:
+            try:
+                with open(_journal_path(path, generation), 'a', encoding='utf-8') as journal:
+                    journal.write(''.join(json.dumps(op) + '\n' for op in operations))
+            except OSError as e:
+                current_app.logger.warning(f'Could not journal suggestion changes: {e}')
+
+        if state:
+            with state.lock:
+                for operation in operations:
+                    apply_operation(state.index, operation)
+
+    @staticmethod
+    def _state() -> _IndexState:
+        app = current_app._get_current_object()
+        state = app.extensions.get(_EXTENSION_KEY)
+        if state is None:
+            state = SuggestionService._load(app)
+            app.extensions[_EXTENSION_KEY] = state
+        return state
+
+    @staticmethod
+    def _load(app) -> _IndexState:
+        path = _snapshot_path(app)
+        if path and os.path.exists(path):
+            try:
+                return _read_snapshot(path)
+            except (OSError, ValueError, KeyError) as e:
+                app.logger.warning(f'Ignoring unreadable suggestion snapshot {path}: {e}')
+        return SuggestionService._build(app)
+
+    @staticmethod
+    def _build(app) -> _IndexState:
+        operations = _database_operations()
+        index = SuggestionIndex()
+        for operation in operations:
+            apply_operation(index, operation)
+
+        path = _snapshot_path(app)
+        generation = None
+        if path:
+            try:
+                generation = _write_snapshot(path, operations)
+            except OSError as e:
+                app.logger.warning(f'Could not write suggestion snapshot {path}: {e}')
+        return _IndexState(index, path, generation)
+
+    @staticmethod
+    def _refresh(state: _IndexState) -> None:
+        """Pick up snapshots and journaled changes written by other workers."""
+        if not state.path:
+            return
+        now = time.monotonic()
+        if now - state.checked_at < current_app.config.get('SUGGESTION_SYNC_INTERVAL', 2.0):
+            return
+        state.checked_at = now
+
+        try:
+            if _read_generation(state.path) != state.generation:
+                fresh = _read_snapshot(state.path)
+                state.index, state.generation, state.offset = fresh.index, fresh.generation, 0
+            _replay_journal(state)
+        except (OSError, ValueError, KeyError) as e:
+            current_app.logger.warning(f'Could not refresh suggestion index: {e}')
+
+
+def _snapshot_path(app) -> Optional[str]:
+    return app.config.get('SUGGESTION_SNAPSHOT_PATH')
+
+
+def _journal_path(path: str, generation: str) -> str:
+    return f'{path}.{generation}.journal'
+
+
+def _database_operations() -> List[list]:
+    # Trending queries first so names are weighted as they are added
+    operations = [
+        ['trending', search_type or 'products', query, count or 0]
+        for query, search_type, count in db.session.query(
+            TrendingSearch.query, TrendingSearch.search_type, TrendingSearch.count
+        )
+    ]
+    for model, (search_type, text_attr, flag_attr) in CATALOG.items():
+        flag = getattr(model, flag_attr)
+        rows = db.session.query(model.id, getattr(model, text_attr)).filter(
+            or_(flag.is_(None), flag == True)
+        )
+        operations.extend(['catalog', search_type, item_id, text] for item_id, text in rows)
+    return operations
+
+
+def _write_snapshot(path: str, operations: List[list]) -> str:
+    """Atomically replace the snapshot; returns its new generation."""
+    generation = uuid.uuid4().hex
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.suggestions-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as snapshot:
+            snapshot.write(json.dumps({'version': SNAPSHOT_VERSION, 'generation': generation}) + '\n')
+            for operation in operations:
+                snapshot.write(json.dumps(operation) + '\n')
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    # Journals of older generations are folded into the new snapshot
+    prefix = os.path.basename(path) + '.'
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith('.journal') and generation not in name:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+    return generation
+
+
+def _read_generation(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding='utf-8') as snapshot:
+            header = json.loads(snapshot.readline())
+    except FileNotFoundError:
+        return None
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {header.get('version')}")
+    return header['generation']
+
+
+def _read_snapshot(path: str) -> _IndexState:
+    index = SuggestionIndex()
+    with open(path, encoding='utf-8') as snapshot:
+        header = json.loads(snapshot.readline())
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {header.get('version')}")
+        for line in snapshot:
+            apply_operation(index, json.loads(line))
+
+    state = _IndexState(index, path, header['generation'])
+    _replay_journal(state)
+    return state
+
+
+def _replay_journal(state: _IndexState) -> None:
+    try:
+        with open(_journal_path(state.path, state.generation), 'rb') as journal:
+            journal.seek(state.offset)
+            data = journal.read()
+    except FileNotFoundError:
+        return
+
+    # Only consume complete lines; a concurrent append may still be in progress
+    end = data.rfind(b'\n') + 1
+    for line in data[:end].splitlines():
+        if line:
+            apply_operation(state.index, json.loads(line))
+    state.offset += end
+
+
+def _catalog_operation(model, target) -> list:
+    search_type, text_attr, flag_attr = CATALOG[model]
+    if getattr(target, flag_attr) is False:
+        return ['uncatalog', search_type, target.id]
+    return ['catalog', search_type, target.id, getattr(target, text_attr)]
+
+
+def _queue(target, operation: list) -> None:
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(_PENDING_KEY, []).append(operation)
+
+
+def _make_catalog_listener(model, only_if_changed=False):
+    _, text_attr, flag_attr = CATALOG[model]
+
+    def on_change(mapper, connection, target):
+        if only_if_changed:
+            attrs = inspect(target).attrs
+            if not (attrs[text_attr].history.has_changes() or attrs[flag_attr].history.has_changes()):
+                return
+        _queue(target, _catalog_operation(model, target))
+    return on_change
+
+
+def _make_catalog_delete_listener(model):
+    search_type = CATALOG[model][0]
+
+    def on_delete(mapper, connection, target):
+        _queue(target, ['uncatalog', search_type, target.id])
+    return on_delete
+
+
+def _trending_changed(mapper, connection, target):
+    _queue(target, ['trending', target.search_type or 'products', target.query, target.count or 0])
+
+
+def _trending_deleted(mapper, connection, target):
+    _queue(target, ['untrending', target.search_type or 'products', target.query])
+
+
+def _publish_pending(session):
+    operations = session.info.pop(_PENDING_KEY, None)
+    if operations and has_app_context():
+        try:
+            SuggestionService.apply_changes(operations)
+        except Exception as e:
+            current_app.logger.error(f'Error updating suggestion index: {e}')
+
+
+def _discard_pending(session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _forget_index(target, connection, **kw):
+    # Recreating the tables (e.g. between tests) invalidates the in-memory index
+    if has_app_context():
+        current_app.extensions.pop(_EXTENSION_KEY, None)
+
+
+_registered = False
+
+
+def register_suggestion_index() -> None:
+    """
+    Register ORM hooks that keep the suggestion index in sync.
+
+    Changes are collected while a session flushes and published once the
+    transaction commits, so rolled-back changes never reach the index.
+    """
+    global _registered
+    if _registered:
+        return
+    _registered = True
+
+    for model in CATALOG:
+        event.listen(model, 'after_insert', _make_catalog_listener(model))
+        event.listen(model, 'after_update', _make_catalog_listener(model, only_if_changed=True))
+        event.listen(model, 'after_delete', _make_catalog_delete_listener(model))
+
+    event.listen(TrendingSearch, 'after_insert', _trending_changed)
+    event.listen(TrendingSearch, 'after_update', _trending_changed)
+    event.listen(TrendingSearch, 'after_delete', _trending_deleted)
+
+    event.listen(Session, 'after_commit', _publish_pending)
+    event.listen(Session, 'after_rollback', _discard_pending)
+
+    for table in (Product.__table__, TrendingSearch.__table__):
+        event.listen(table, 'after_create', _forget_index)
+        event.listen(table, 'after_drop', _forget_index)
@@ -0,0 +1,211 @@
+"""
+Cache metrics.
+
+Counts what the cache does so its effect can be seen in production:
+
+- operations by kind, key prefix and outcome (hit, miss, error, ...)
+- latency histograms per operation and key prefix
+- size histograms of the values written, per key prefix
+
+The key prefix is the first ``:``-separated part of the key (``product``,
+``paginate``, ``recommendation``, ...); for cached responses it is the
+endpoint. Metrics are kept per worker process and rendered in the
+Prometheus text exposition format, without needing the Prometheus
+client library.
+"""
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# Distinct prefixes tracked before the rest are counted as 'other'
+MAX_PREFIXES = 200
+
+METRIC_PREFIX = 'buildsmart_cache'
+
+
+def key_prefix(key: str) -> str:
+    """Get the metrics label of a cache key."""
+    return key.split(':', 1)[0] if key else ''
+
+
+class _Histogram:
+    """Cumulative histogram with fixed buckets."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total = 0
+        rows = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            rows.append((_format_number(bound), total))
+        rows.append(('+Inf', self.count))
+        return rows
+
+
+class CacheMetrics:
+    """Thread-safe cache counters and histograms for one worker."""
+
+    def __init__(self, max_prefixes: int = MAX_PREFIXES):
+        self.max_prefixes = max_prefixes
+        self._operations: Dict[Tuple[str, str, str], int] = {}
+        self._latency: Dict[Tuple[str, str], _Histogram] = {}
+        self._sizes: Dict[str, _Histogram] = {}
+        self._prefixes = set()
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, prefix: str, outcome: str, count: int = 1,
+               seconds: Optional[float] = None) -> None:
+        """
+        Count operations and optionally observe their latency.
+
+        Args:
+            operation: Operation name (get, set, delete, get_or_set, response, ...)
+            prefix: Key prefix (see key_prefix)
+            outcome: Outcome (hit, miss, ok, error, ...)
+            count: Number of operations
+            seconds: Latency of the operation, if measured
+        """
+        with self._lock:
+            prefix = self._label(prefix)
+            key = (operation, prefix, outcome)
+            self._operations[key] = self._operations.get(key, 0) + count
+            if seconds is not None:
+                histogram = self._latency.get((operation, prefix))
+                if histogram is None:
+                    histogram = self._latency[(operation, prefix)] = _Histogram(LATENCY_BUCKETS)
+                histogram.observe(seconds)
+
+    def observe_size(self, prefix: str, size: int) -> None:
+        """Observe the serialized size of a value written under a prefix."""
+        with self._lock:
+            prefix = self._label(prefix)
+            histogram = self._sizes.get(prefix)
+            if histogram is None:
+                histogram = self._sizes[prefix] = _Histogram(SIZE_BUCKETS)
+            histogram.observe(size)
+
+    def snapshot(self) -> Dict:
+        """
+        Get the current values.
+
+        Returns:
+            Dictionary with 'operations' ({(operation, prefix, outcome): count}),
+            'latency' and 'sizes' ({labels: {'count', 'sum'}})
+        """
+        with self._lock:
+            return {
+                'operations': dict(self._operations),
+                'latency': {k: {'count': h.count, 'sum': h.sum} for k, h in self._latency.items()},
+                'sizes': {k: {'count': h.count, 'sum': h.sum} for k, h in self._sizes.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._operations.clear()
+            self._latency.clear()
+            self._sizes.clear()
+            self._prefixes.clear()
+
+    def render(self, tier_stats: Optional[Dict[str, Dict]] = None) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Args:
+            tier_stats: CacheService.get_stats() output to include as
+                L1/L2 counters and gauges
+
+        Returns:
+            Metrics text
+        """
+        lines = []
+        with self._lock:
+            lines += _header('operations_total', 'counter', 'Cache operations by key prefix and outcome.')
+            for (operation, prefix, outcome), count in sorted(self._operations.items()):
+                lines.append(_sample('operations_total',
+                                     {'operation': operation, 'prefix': prefix, 'outcome': outcome}, count))
+
+            lines += _header('operation_duration_seconds', 'histogram', 'Cache operation latency.')
+            for (operation, prefix), histogram in sorted(self._latency.items()):
+                lines += _histogram('operation_duration_seconds',
+                                    {'operation': operation, 'prefix': prefix}, histogram)
+
+            lines += _header('value_size_bytes', 'histogram', 'Serialized size of values written to the cache.')
+            for prefix, histogram in sorted(self._sizes.items()):
+                lines += _histogram('value_size_bytes', {'prefix': prefix}, histogram)
+
+        if tier_stats:
+            lines += _tier_lines(tier_stats)
+        return '\n'.join(lines) + '\n'
+
+    def _label(self, prefix: str) -> str:
+        # Called with the lock held
+        if prefix in self._prefixes:
+            return prefix
+        if len(self._prefixes) >= self.max_prefixes:
+            return 'other'
+        self._prefixes.add(prefix)
+        return prefix
+
+
+def _tier_lines(tier_stats: Dict[str, Dict]) -> List[str]:
+    lines = []
+    lines += _header('tier_events_total', 'counter', 'Hits, misses and evictions per cache tier.')
+    gauges = []
+    for tier, stats in sorted(tier_stats.items()):
+        for name, value in sorted(stats.items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if name in ('items', 'bytes', 'max_bytes'):
+                gauges.append((tier, name, value))
+            else:
+                lines.append(_sample('tier_events_total', {'tier': tier, 'event': name}, value))
+    for name in ('items', 'bytes', 'max_bytes'):
+        rows = [(tier, value) for tier, gauge, value in gauges if gauge == name]
+        if rows:
+            lines += _header(f'tier_{name}', 'gauge', f'Current {name.replace("_", " ")} per cache tier.')
+            lines += [_sample(f'tier_{name}', {'tier': tier}, value) for tier, value in rows]
+    return lines
+
+
+def _header(name: str, kind: str, help_text: str) -> List[str]:
+    return [f'# HELP {METRIC_PREFIX}_{name} {help_text}', f'# TYPE {METRIC_PREFIX}_{name} {kind}']
+
+
+def _histogram(name: str, labels: Dict[str, str], histogram: _Histogram) -> List[str]:
+    lines = [_sample(f'{name}_bucket', dict(labels, le=bound), count) for bound, count in histogram.cumulative()]
+    lines.append(_sample(f'{name}_sum', labels, histogram.sum))
+    lines.append(_sample(f'{name}_count', labels, histogram.count))
+    return lines
+
+
+def _sample(name: str, labels: Dict[str, str], value: float) -> str:
+    rendered = ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+    return f'{METRIC_PREFIX}_{name}{{{rendered}}} {_format_number(value)}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
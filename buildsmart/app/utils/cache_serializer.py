@@ -0,0 +1,349 @@
+"""
+Serialization of cached values.
+
+``CacheService`` stores values as self-describing byte strings instead of
+letting the backend pickle them: a short header (magic, format version,
+codec, flags) followed by the encoded value, compressed when it is large.
+
+Codecs:
+
+- ``json``: orjson when installed, the standard library otherwise. The
+  default; compact, fast and independent of the code that wrote it
+- ``msgpack``: when the msgpack package is installed
+- ``pickle``: any picklable value; used for values that are not plain data
+
+Plain data is dicts, lists, strings, numbers, booleans and None. Bytes,
+Decimal, dates and times, sets and dicts with non-string keys are tagged
+so they come back with their type; tuples come back as lists. Values are
+converted before orjson sees them, so the types orjson would encode on
+its own (UUIDs, enums, dataclasses, subclasses of str and int) fall back
+to pickle and keep their type whether or not orjson is installed.
+
+ORM instances are rejected with ``UncacheableValueError``: they pickle
+their whole session state, break when the model changes and come back
+detached. Cache ids or dicts instead, or pass ``allow_orm=True``, which
+stores the value with pickle. Other values that are not plain data also
+fall back to pickle.
+
+Payloads written by a different format version are treated as misses.
+"""
+import base64
+import json
+import pickle
+import zlib
+from datetime import date, datetime, time
+from decimal import Decimal
+from io import BytesIO
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+MAGIC = b'\xbc\x5c'
+FORMAT_VERSION = 1
+HEADER_SIZE = 5
+
+# Codec ids in the header
+CODEC_JSON = 1
+CODEC_MSGPACK = 2
+CODEC_PICKLE = 3
+
+# Header flags
+FLAG_ZLIB = 1
+FLAG_ZSTD = 2
+FLAG_TAGGED = 4  # the payload contains tagged values and must be revived
+
+# Key marking a tagged value: {TAG_KEY: type, 'v': encoded value}
+TAG_KEY = '__cache_type__'
+
+
+class UncacheableValueError(TypeError):
+    """Raised for values that must not be cached (ORM instances unless allowed)."""
+
+
+def is_orm_instance(value: Any) -> bool:
+    """Check whether a value is a mapped SQLAlchemy instance."""
+    return hasattr(value, '_sa_instance_state')
+
+
+def _reject_orm(value: Any) -> None:
+    raise UncacheableValueError(
+        f'Refusing to cache ORM instance {type(value).__name__}; cache ids or dicts, '
+        f'or pass allow_orm=True'
+    )
+
+
+# --- tagged values -----------------------------------------------------------
+
+def _tag(value: Any) -> Any:
+    """Encode a value plain JSON cannot represent, or raise TypeError."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {TAG_KEY: 'bytes', 'v': base64.b64encode(bytes(value)).decode('ascii')}
+    if isinstance(value, Decimal):
+        return {TAG_KEY: 'decimal', 'v': str(value)}
+    if isinstance(value, datetime):
+        return {TAG_KEY: 'datetime', 'v': value.isoformat()}
+    if isinstance(value, date):
+        return {TAG_KEY: 'date', 'v': value.isoformat()}
+    if isinstance(value, time):
+        return {TAG_KEY: 'time', 'v': value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return {TAG_KEY: 'set', 'v': [_plain(item) for item in value]}
+    if is_orm_instance(value):
+        _reject_orm(value)
+    raise TypeError(f'{type(value).__name__} is not plain data')
+
+
+_UNTAG: Dict[str, Callable[[Any], Any]] = {
+    'bytes': lambda v: base64.b64decode(v),
+    'decimal': Decimal,
+    'datetime': datetime.fromisoformat,
+    'date': date.fromisoformat,
+    'time': time.fromisoformat,
+    'set': set,
+    'dict': lambda items: {key: value for key, value in items},
+}
+
+
+_SCALARS = (str, bool, int, float)
+
+
+def _plain(value: Any, tagged: Optional[list] = None) -> Any:
+    """
+    Convert a value to JSON-representable data, tagging what JSON lacks.
+
+    Args:
+        value: Value to convert
+        tagged: List that gets an entry when anything is tagged
+
+    Raises:
+        TypeError: If the value is not plain data
+    """
+    # Exact types: subclasses (e.g. IntEnum) would come back as their base
+    if value is None or type(value) in _SCALARS:
+        return value
+    if isinstance(value, dict):
+        if all(type(key) is str for key in value):
+            if TAG_KEY in value:
+                raise TypeError(f'dict key {TAG_KEY!r} is reserved')
+            return {key: _plain(item, tagged) for key, item in value.items()}
+        if tagged is not None:
+            tagged.append(True)
+        return {TAG_KEY: 'dict', 'v': [[_plain(key, tagged), _plain(item, tagged)]
+                                       for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item, tagged) for item in value]
+    encoded = _tag(value)
+    if tagged is not None:
+        tagged.append(True)
+    return encoded
+
+
+def _revive(value: Any) -> Any:
+    """Undo _plain()."""
+    if isinstance(value, list):
+        return [_revive(item) for item in value]
+    if isinstance(value, dict):
+        kind = value.get(TAG_KEY)
+        if kind is not None:
+            inner = value['v']
+            if kind == 'dict':
+                return {_hashable(_revive(k)): _revive(v) for k, v in inner}
+            if kind == 'set':
+                return {_hashable(_revive(item)) for item in inner}
+            return _UNTAG[kind](inner)
+        return {key: _revive(item) for key, item in value.items()}
+    return value
+
+
+def _hashable(value: Any) -> Any:
+    # Tuple keys come back as lists
+    return tuple(_hashable(item) for item in value) if isinstance(value, list) else value
+
+
+# --- codecs ------------------------------------------------------------------
+
+class Serializer:
+    """Encodes values of plain data to bytes; ``tagged`` tells whether _revive() is needed."""
+
+    codec_id = 0
+    name = ''
+
+    def dumps(self, value: Any) -> Tuple[bytes, bool]:
+        raise NotImplementedError
+
+    def loads(self, data: bytes, tagged: bool) -> Any:
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    """JSON via orjson when installed, otherwise the standard library."""
+
+    codec_id = CODEC_JSON
+    name = 'json'
+
+    def dumps(self, value: Any) -> Tuple[bytes, bool]:
+        # Convert first so orjson and the standard library accept the same values
+        tagged = []
+        plain = _plain(value, tagged)
+        if orjson is not None:
+            return orjson.dumps(plain), bool(tagged)
+        return json.dumps(plain, separators=(',', ':')).encode('utf-8'), bool(tagged)
+
+    def loads(self, data: bytes, tagged: bool) -> Any:
+        value = orjson.loads(data) if orjson is not None else json.loads(data)
+        return _revive(value) if tagged else value
+
+
+class MsgpackSerializer(Serializer):
+    """MessagePack; bytes and non-string keys are native, the rest is tagged."""
+
+    codec_id = CODEC_MSGPACK
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('The msgpack serializer needs the msgpack package')
+
+    def dumps(self, value: Any) -> Tuple[bytes, bool]:
+        tagged = []
+
+        def default(item):
+            tagged.append(True)
+            if isinstance(item, (set, frozenset)):
+                return {TAG_KEY: 'set', 'v': list(item)}
+            return _tag(item)
+
+        return msgpack.packb(value, default=default, use_bin_type=True), bool(tagged)
+
+    def loads(self, data: bytes, tagged: bool) -> Any:
+        value = msgpack.unpackb(data, raw=False, strict_map_key=False, use_list=True)
+        return _revive(value) if tagged else value
+
+
+class _GuardedPickler(pickle.Pickler):
+    """Pickler that refuses ORM instances anywhere in the value."""
+
+    def reducer_override(self, obj):
+        if is_orm_instance(obj):
+            _reject_orm(obj)
+        return NotImplemented
+
+
+class PickleSerializer(Serializer):
+    """Pickle; for values that are not plain data."""
+
+    codec_id = CODEC_PICKLE
+    name = 'pickle'
+
+    def __init__(self, allow_orm: bool = False):
+        self.allow_orm = allow_orm
+
+    def dumps(self, value: Any) -> Tuple[bytes, bool]:
+        if self.allow_orm:
+            return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), False
+        buffer = BytesIO()
+        _GuardedPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+        return buffer.getvalue(), False
+
+    def loads(self, data: bytes, tagged: bool) -> Any:
+        return pickle.loads(data)
+
+
+SERIALIZERS: Dict[str, Callable[[], Serializer]] = {
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer,
+    'pickle': PickleSerializer,
+}
+
+
+# --- payloads ----------------------------------------------------------------
+
+class CacheCodec:
+    """Turns values into cache payloads and back."""
+
+    def __init__(self, serializer: str = 'json', compression: Optional[str] = 'zlib',
+                 compress_threshold: int = 1024):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f'Unknown cache serializer: {serializer}')
+        if compression not in (None, 'zlib', 'zstd'):
+            raise ValueError(f'Unknown cache compression: {compression}')
+        if compression == 'zstd' and zstandard is None:
+            compression = 'zlib'
+        self.serializer = SERIALIZERS[serializer]()
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self._decoders = {CODEC_JSON: JSONSerializer(), CODEC_PICKLE: PickleSerializer(allow_orm=True)}
+        if msgpack is not None:
+            self._decoders[CODEC_MSGPACK] = MsgpackSerializer()
+        self._fallback = PickleSerializer()
+        self._orm = PickleSerializer(allow_orm=True)
+
+    def encode(self, value: Any, allow_orm: bool = False) -> Tuple[bytes, str]:
+        """
+        Encode a value.
+
+        Args:
+            value: Value to cache
+            allow_orm: Allow ORM instances (stored with pickle)
+
+        Returns:
+            (payload, name of the serializer used)
+
+        Raises:
+            UncacheableValueError: If the value holds ORM instances and
+                allow_orm is False
+        """
+        serializer = self._orm if allow_orm else self.serializer
+        try:
+            data, tagged = serializer.dumps(value)
+        except UncacheableValueError:
+            raise
+        except (TypeError, ValueError, OverflowError):
+            # Not plain data
+            serializer = self._fallback
+            data, tagged = serializer.dumps(value)
+
+        flags = FLAG_TAGGED if tagged else 0
+        if self.compression and len(data) >= self.compress_threshold:
+            if self.compression == 'zstd':
+                data, flags = zstandard.ZstdCompressor().compress(data), flags | FLAG_ZSTD
+            else:
+                data, flags = zlib.compress(data, 6), flags | FLAG_ZLIB
+        header = MAGIC + bytes((FORMAT_VERSION, serializer.codec_id, flags))
+        return header + data, serializer.name
+
+    def decode(self, payload: Any) -> Any:
+        """
+        Decode a payload.
+
+        Values that are not payloads (e.g. counters written directly to the
+        backend) are returned unchanged; payloads of another format version
+        or an unavailable codec decode to None.
+        """
+        if not isinstance(payload, bytes) or payload[:len(MAGIC)] != MAGIC:
+            return payload
+        version, codec_id, flags = payload[2], payload[3], payload[4]
+        decoder = self._decoders.get(codec_id)
+        if version != FORMAT_VERSION or decoder is None:
+            return None
+        data = payload[HEADER_SIZE:]
+        if flags & FLAG_ZSTD:
+            if zstandard is None:
+                return None
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        return decoder.loads(data, bool(flags & FLAG_TAGGED))
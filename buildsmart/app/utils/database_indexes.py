@@ -22,6 +22,7 @@ RECOMMENDED_INDEXES = {
         ('is_active',),
         ('created_at',),
         ('latitude', 'longitude'),  # Composite index for location queries
+        ('geohash',),  # Spatial prefilter for nearby/distance queries
     ],
     'products': [
         ('shop_id',),
@@ -0,0 +1,143 @@
+"""
+Date range utilities for reporting queries.
+
+Analytics filters by calendar day, but ``created_at`` columns hold
+timestamps. Comparing ``DATE(created_at)`` with a day wraps the indexed
+column in a function, so the database cannot use the ``created_at`` index
+and scans the table. ``in_date_range`` compares the raw column with a
+half-open timestamp window instead::
+
+    created_at >= start 00:00 AND created_at < (end + 1 day) 00:00
+
+which selects the same rows and stays an index range scan.
+
+``date_bucket`` groups timestamps by day, week (starting Monday) or month
+on PostgreSQL, SQLite and MySQL; ``date_trunc`` only exists on PostgreSQL.
+Bucket values come back as dates, strings or timestamps depending on the
+backend, so ``bucket_date`` normalizes them. ``period_start`` buckets days
+that were already aggregated (e.g. daily rollups) in Python.
+"""
+from datetime import date, datetime, time, timedelta
+from typing import Any, Optional, Tuple
+from sqlalchemy import Date, Integer, and_, cast, func
+
+# Days covered when a report does not specify a range
+DEFAULT_RANGE_DAYS = 30
+
+
+def resolve_date_range(start_date: Optional[date] = None,
+                       end_date: Optional[date] = None) -> Tuple[date, date]:
+    """
+    Fill in the default reporting range.
+
+    Args:
+        start_date: First day (default: DEFAULT_RANGE_DAYS days before today)
+        end_date: Last day, inclusive (default: today)
+
+    Returns:
+        (start_date, end_date)
+    """
+    today = date.today()
+    return start_date or today - timedelta(days=DEFAULT_RANGE_DAYS), end_date or today
+
+
+def date_window(start_date: date, end_date: date) -> Tuple[datetime, datetime]:
+    """
+    Convert an inclusive range of days to a half-open timestamp window.
+
+    Args:
+        start_date: First day
+        end_date: Last day, inclusive
+
+    Returns:
+        (start, end): midnight of start_date and midnight after end_date
+    """
+    return (datetime.combine(start_date, time.min),
+            datetime.combine(end_date + timedelta(days=1), time.min))
+
+
+def in_date_range(column, start_date: date, end_date: date):
+    """
+    Build an index-friendly filter for timestamps within a range of days.
+
+    Args:
+        column: Timestamp column (e.g. Order.created_at)
+        start_date: First day
+        end_date: Last day, inclusive
+
+    Returns:
+        SQLAlchemy boolean expression
+    """
+    start, end = date_window(start_date, end_date)
+    return and_(column >= start, column < end)
+
+
+def date_bucket(column, group_by: str, dialect_name: str):
+    """
+    Build a SQL expression truncating timestamps to a day, week or month.
+
+    Weeks start on Monday, as with PostgreSQL's ``date_trunc('week', ...)``.
+    Unknown groupings fall back to days.
+
+    Args:
+        column: Timestamp column
+        group_by: 'day', 'week' or 'month'
+        dialect_name: Database dialect name (e.g. 'sqlite', 'postgresql')
+
+    Returns:
+        SQLAlchemy expression for the first day of the bucket
+    """
+    if group_by not in ('week', 'month'):
+        return func.date(column)
+
+    if dialect_name == 'sqlite':
+        if group_by == 'month':
+            return func.date(column, 'start of month')
+        # strftime('%w') is 0 for Sunday; step back to Monday
+        days_since_monday = (cast(func.strftime('%w', column), Integer) + 6) % 7
+        return func.date(column, func.printf('-%d days', days_since_monday))
+
+    if dialect_name in ('mysql', 'mariadb'):
+        if group_by == 'month':
+            return func.date_format(column, '%Y-%m-01')
+        return func.subdate(func.date(column), func.weekday(column))
+
+    return cast(func.date_trunc(group_by, column), Date)
+
+
+def bucket_date(value: Any) -> Optional[date]:
+    """
+    Normalize a bucket value returned by the database to a date.
+
+    Args:
+        value: date, datetime or ISO string (SQLite returns strings)
+
+    Returns:
+        The date, or None
+    """
+    if value is None or (isinstance(value, date) and not isinstance(value, datetime)):
+        return value
+    if isinstance(value, datetime):
+        return value.date()
+    return date.fromisoformat(str(value)[:10])
+
+
+def period_start(day: date, group_by: str) -> date:
+    """
+    Get the first day of the day, week (starting Monday) or month of a date.
+
+    The Python counterpart of ``date_bucket``, for data already
+    aggregated by day.
+
+    Args:
+        day: Date
+        group_by: 'day', 'week' or 'month' (unknown groupings mean days)
+
+    Returns:
+        First day of the period
+    """
+    if group_by == 'week':
+        return day - timedelta(days=day.weekday())
+    if group_by == 'month':
+        return day.replace(day=1)
+    return day
@@ -0,0 +1,355 @@
+"""
+Geospatial utilities.
+
+This module provides the distance and spatial-index helpers used by
+location-aware queries (nearby shops, distance-filtered product search,
+shopping plan optimization). Shops store a geohash of their coordinates
+so candidate rows can be prefiltered with index-friendly range predicates
+before the exact Haversine distance is applied.
+
+Batch distance computations are vectorized with NumPy: callers pass
+arrays of coordinates (missing coordinates as NaN) and get arrays back.
+"""
+import math
+import sqlite3
+from typing import Iterable, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+EARTH_RADIUS_KM = 6371.0
+
+# Precision of the geohash stored on each shop (~4.8m x 4.8m cells)
+GEOHASH_PRECISION = 9
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Name of the Haversine SQL function registered on SQLite connections
+SQLITE_HAVERSINE_FUNCTION = 'haversine_km'
+
+# Character that sorts after every geohash base32 character; used to turn
+# a prefix match into a plain range predicate that can use a B-tree index.
+GEOHASH_PREFIX_UPPER = '{'
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Calculate the great-circle distance between two points.
+
+    Args:
+        lat1: Latitude of point 1 in decimal degrees
+        lon1: Longitude of point 1 in decimal degrees
+        lat2: Latitude of point 2 in decimal degrees
+        lon2: Longitude of point 2 in decimal degrees
+
+    Returns:
+        Distance in kilometers
+    """
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lon = math.radians(lon2 - lon1)
+
+    a = (math.sin(delta_lat / 2) ** 2 +
+         math.cos(lat1_rad) * math.cos(lat2_rad) *
+         math.sin(delta_lon / 2) ** 2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+    return EARTH_RADIUS_KM * c
+
+
+def haversine_distances(lat, lon, lats, lons) -> np.ndarray:
+    """
+    Calculate great-circle distances for arrays of coordinates.
+
+    Inputs are broadcast against each other, so a single origin can be
+    compared with many points, or an ``(n, 1)`` array of origins with a
+    ``(m,)`` array of points to build an ``(n, m)`` distance matrix.
+
+    Args:
+        lat: Origin latitude(s) in decimal degrees
+        lon: Origin longitude(s) in decimal degrees
+        lats: Target latitudes in decimal degrees
+        lons: Target longitudes in decimal degrees
+
+    Returns:
+        Array of distances in kilometers (NaN where a coordinate is missing)
+    """
+    lat1 = np.radians(np.asarray(lat, dtype=float))
+    lon1 = np.radians(np.asarray(lon, dtype=float))
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    lon2 = np.radians(np.asarray(lons, dtype=float))
+
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def coordinate_arrays(points: Iterable[Tuple[Optional[float], Optional[float]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert (lat, lon) pairs to float arrays, mapping missing values to NaN.
+
+    Args:
+        points: Iterable of (latitude, longitude) pairs
+
+    Returns:
+        Tuple of (latitudes, longitudes) arrays
+    """
+    pairs = [
+        (float(lat) if lat is not None else np.nan,
+         float(lon) if lon is not None else np.nan)
+        for lat, lon in points
+    ]
+    if not pairs:
+        return np.empty(0), np.empty(0)
+    coords = np.array(pairs, dtype=float)
+    return coords[:, 0], coords[:, 1]
+
+
+def radius_mask(lat: float, lon: float, lats, lons, radius_km: float) -> np.ndarray:
+    """
+    Get a boolean mask of points lying within a radius.
+
+    Args:
+        lat: Center latitude in decimal degrees
+        lon: Center longitude in decimal degrees
+        lats: Point latitudes
+        lons: Point longitudes
+        radius_km: Radius in kilometers
+
+    Returns:
+        Boolean array (False where a coordinate is missing)
+    """
+    distances = haversine_distances(lat, lon, lats, lons)
+    with np.errstate(invalid='ignore'):
+        return distances <= radius_km
+
+
+def nearest_k(lat: float, lon: float, lats, lons, k: Optional[int] = None,
+              radius_km: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the k nearest points to a location.
+
+    Uses ``argpartition`` so only the selected k points are sorted.
+
+    Args:
+        lat: Center latitude in decimal degrees
+        lon: Center longitude in decimal degrees
+        lats: Point latitudes
+        lons: Point longitudes
+        k: Number of points to return (None = all matching points)
+        radius_km: Optional radius to restrict results to
+
+    Returns:
+        Tuple of (indices, distances), nearest first; ties keep input order
+    """
+    distances = haversine_distances(lat, lon, lats, lons)
+    valid = ~np.isnan(distances)
+    if radius_km is not None:
+        valid &= np.where(valid, distances, np.inf) <= radius_km
+
+    indices = np.flatnonzero(valid)
+    candidates = distances[indices]
+
+    if k is not None and 0 < k < len(indices):
+        selected = np.argpartition(candidates, k - 1)[:k]
+        # Keep every point tied with the k-th distance so ties resolve by input order
+        boundary = candidates[selected].max()
+        selected = np.flatnonzero(candidates <= boundary)
+        indices = indices[selected]
+        candidates = candidates[selected]
+
+    order = np.lexsort((indices, candidates))
+    if k is not None and k > 0:
+        order = order[:k]
+    return indices[order], candidates[order]
+
+
+def bounding_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """
+    Get a lat/lon bounding box that contains every point within a radius.
+
+    The box is conservative: near the poles, or when it would cross the
+    antimeridian, the longitude range is widened to the whole globe so no
+    point inside the radius is ever excluded.
+
+    Args:
+        lat: Center latitude in decimal degrees
+        lon: Center longitude in decimal degrees
+        radius_km: Radius in kilometers
+
+    Returns:
+        Tuple of (min_lat, max_lat, min_lon, max_lon)
+    """
+    delta_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat = lat - delta_lat
+    max_lat = lat + delta_lat
+
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0
+
+    # Widest longitude span is reached at the latitude furthest from the equator
+    widest_lat = max(abs(min_lat), abs(max_lat))
+    delta_lon = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(widest_lat))))
+    min_lon = lon - delta_lon
+    max_lon = lon + delta_lon
+
+    if min_lon < -180 or max_lon > 180:
+        return min_lat, max_lat, -180.0, 180.0
+
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def encode_geohash(lat: float, lon: float, precision: int = GEOHASH_PRECISION) -> str:
+    """
+    Encode coordinates as a geohash string.
+
+    Args:
+        lat: Latitude in decimal degrees
+        lon: Longitude in decimal degrees
+        precision: Number of geohash characters
+
+    Returns:
+        Geohash string
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if lon >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits = bits << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(geohash)
+
+
+def geohash_cell_size(precision: int) -> Tuple[float, float]:
+    """
+    Get the size of a geohash cell in degrees.
+
+    Args:
+        precision: Number of geohash characters
+
+    Returns:
+        Tuple of (lat_degrees, lon_degrees)
+    """
+    total_bits = precision * 5
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits)
+
+
+def covering_geohashes(lat: float, lon: float, radius_km: float,
+                       max_cells: int = 32) -> Set[str]:
+    """
+    Get the geohash cells that together cover a search radius.
+
+    Picks the finest precision whose cells cover the radius' bounding box
+    with at most ``max_cells`` cells, so the resulting prefix predicates
+    stay small while still being selective.
+
+    Args:
+        lat: Center latitude in decimal degrees
+        lon: Center longitude in decimal degrees
+        radius_km: Radius in kilometers
+        max_cells: Maximum number of cells to return
+
+    Returns:
+        Set of geohash prefixes (empty if no precision fits the budget)
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_step, lon_step = geohash_cell_size(precision)
+        lat_samples = int(math.ceil((max_lat - min_lat) / lat_step)) + 1
+        lon_samples = int(math.ceil((max_lon - min_lon) / lon_step)) + 1
+        if lat_samples * lon_samples > max_cells * 4:
+            continue
+
+        # Samples spaced one cell apart (plus both edges) hit every cell
+        # that intersects the bounding box.
+        cells = set()
+        for i in range(lat_samples + 1):
+            sample_lat = min(min_lat + i * lat_step, max_lat)
+            for j in range(lon_samples + 1):
+                sample_lon = min(min_lon + j * lon_step, max_lon)
+                cells.add(encode_geohash(sample_lat, sample_lon, precision))
+
+        if len(cells) <= max_cells:
+            return cells
+
+    return set()
+
+
+def _sqlite_haversine(lat1, lon1, lat2, lon2):
+    """SQLite scalar function wrapper around haversine_km (NULL-safe)."""
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    return haversine_km(lat1, lon1, lat2, lon2)
+
+
+def _register_sqlite_haversine(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            SQLITE_HAVERSINE_FUNCTION, 4, _sqlite_haversine, deterministic=True
+        )
+
+
+def register_sqlite_functions():
+    """
+    Register the Haversine SQL function on every new SQLite connection.
+
+    PostgreSQL and MySQL have the trigonometric functions needed to compute
+    distances natively; SQLite does not always, so development and test
+    databases get a Python implementation instead.
+    """
+    if not event.contains(Engine, 'connect', _register_sqlite_haversine):
+        event.listen(Engine, 'connect', _register_sqlite_haversine)
+
+
+def distance_expression(lat: float, lon: float, lat_column, lon_column, dialect_name: str):
+    """
+    Build a SQL expression for the Haversine distance to a point.
+
+    Args:
+        lat: Origin latitude in decimal degrees
+        lon: Origin longitude in decimal degrees
+        lat_column: Latitude column expression
+        lon_column: Longitude column expression
+        dialect_name: Database dialect name (e.g. 'sqlite', 'postgresql')
+
+    Returns:
+        SQLAlchemy expression giving the distance in kilometers
+    """
+    if dialect_name == 'sqlite':
+        return getattr(func, SQLITE_HAVERSINE_FUNCTION)(lat, lon, lat_column, lon_column)
+
+    lat_rad = math.radians(lat)
+    a = (func.power(func.sin((func.radians(lat_column) - lat_rad) * 0.5), 2) +
+         math.cos(lat_rad) * func.cos(func.radians(lat_column)) *
+         func.power(func.sin((func.radians(lon_column) - math.radians(lon)) * 0.5), 2))
+    return 2 * EARTH_RADIUS_KM * func.asin(func.sqrt(func.least(a, 1.0)))
@@ -0,0 +1,199 @@
+"""
+Per-process (L1) cache.
+
+A small in-memory LRU that ``CacheService`` keeps in front of the shared
+Flask-Caching backend (L2), so hot values are served without a network
+round trip. Entries are stored as encoded payloads (see
+app.utils.cache_serializer), which makes their size known for the byte
+budget and keeps callers from mutating a shared copy.
+
+Each worker has its own L1, so writes are announced on an invalidation
+bus and every other worker drops its copy of the affected keys:
+
+- ``RedisInvalidationBus`` publishes on a Redis pub/sub channel and runs
+  a listener thread per worker
+- ``LocalInvalidationBus`` is the stand-in for backends without pub/sub;
+  it only reaches L1 caches in the same process
+
+Entries also carry a short TTL, which bounds staleness if a message is
+ever lost.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Message key meaning "drop everything"
+CLEAR_ALL = '*'
+
+
+class LRUCache:
+    """Thread-safe LRU of encoded values with a byte budget and per-entry TTL."""
+
+    def __init__(self, max_bytes: int, max_item_bytes: int, default_ttl: float):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.default_ttl = default_ttl
+        self._entries: 'OrderedDict[str, Tuple[bytes, float]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'expirations': 0,
+                         'invalidations': 0, 'oversized': 0}
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Get a payload, or None on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            payload, expires = entry
+            if now >= expires:
+                self._remove(key)
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return payload
+
+    def set(self, key: str, payload: bytes, ttl: Optional[float] = None) -> bool:
+        """Store a payload; payloads over the per-item limit are not kept."""
+        ttl = self.default_ttl if ttl is None else min(ttl, self.default_ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if len(payload) > self.max_item_bytes or ttl <= 0:
+                self.counters['oversized'] += len(payload) > self.max_item_bytes
+                return False
+            self._entries[key] = (payload, time.monotonic() + ttl)
+            self._bytes += len(payload)
+            self.counters['sets'] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.counters['evictions'] += 1
+            return True
+
+    def discard(self, keys: Iterable[str]) -> None:
+        """Drop keys (CLEAR_ALL drops everything)."""
+        with self._lock:
+            for key in keys:
+                if key == CLEAR_ALL:
+                    self.counters['invalidations'] += len(self._entries)
+                    self._entries.clear()
+                    self._bytes = 0
+                elif key in self._entries:
+                    self._remove(key)
+                    self.counters['invalidations'] += 1
+
+    def clear(self) -> None:
+        self.discard([CLEAR_ALL])
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats['items'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
+
+    def _remove(self, key: str) -> None:
+        payload, _ = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+
+class LocalInvalidationBus:
+    """In-process stand-in for pub/sub: delivers to the other subscribers of this process."""
+
+    def __init__(self):
+        self._subscribers: List[Tuple[str, Callable[[List[str]], None]]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, origin: str, callback: Callable[[List[str]], None]) -> None:
+        with self._lock:
+            self._subscribers.append((origin, callback))
+
+    def unsubscribe(self, origin: str) -> None:
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[0] != origin]
+
+    def publish(self, origin: str, keys: List[str]) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber_origin, callback in subscribers:
+            if subscriber_origin != origin:
+                callback(keys)
+
+
+class RedisInvalidationBus:
+    """Invalidation messages over a Redis pub/sub channel."""
+
+    def __init__(self, client, channel: str, logger=None):
+        self.client = client
+        self.channel = channel
+        self.logger = logger
+        self._subscribers: Dict[str, Callable[[List[str]], None]] = {}
+        self._listener: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, origin: str, callback: Callable[[List[str]], None]) -> None:
+        with self._lock:
+            self._subscribers[origin] = callback
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='cache-invalidation', daemon=True)
+                self._listener.start()
+
+    def unsubscribe(self, origin: str) -> None:
+        with self._lock:
+            self._subscribers.pop(origin, None)
+
+    def publish(self, origin: str, keys: List[str]) -> None:
+        try:
+            self.client.publish(self.channel, json.dumps({'origin': origin, 'keys': keys}))
+        except Exception as e:
+            if self.logger:
+                self.logger.error(f'Error publishing cache invalidation: {e}')
+
+    def _listen(self) -> None:
+        backoff = 0.5
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                backoff = 0.5
+                for message in pubsub.listen():
+                    self._deliver(message.get('data'))
+            except Exception as e:
+                if self.logger:
+                    self.logger.error(f'Cache invalidation listener failed: {e}')
+            # Messages may have been missed while disconnected
+            with self._lock:
+                subscribers = list(self._subscribers.values())
+            for callback in subscribers:
+                callback([CLEAR_ALL])
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def _deliver(self, data) -> None:
+        try:
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for origin, callback in subscribers:
+            if origin != message.get('origin'):
+                callback(list(message.get('keys') or []))
+
+
+# Shared by every L1 in this process that has no pub/sub backend
+local_bus = LocalInvalidationBus()
+
+
+def new_origin() -> str:
+    """Identify one L1 cache in invalidation messages."""
+    return uuid.uuid4().hex
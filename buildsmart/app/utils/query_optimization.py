@@ -4,10 +4,15 @@ Query optimization utilities.
 This module provides utilities for optimizing database queries
 including eager loading, query batching, and result caching.
 """
+import base64
+import hashlib
+import json
+from decimal import Decimal
 from functools import wraps
-from typing import List, Optional, Callable, Any
+from typing import List, Optional, Callable, Any, Sequence, Tuple
+from flask_sqlalchemy.pagination import Pagination
 from sqlalchemy.orm import joinedload, selectinload, subqueryload
-from sqlalchemy import func
+from sqlalchemy import func, and_, or_, inspect, tuple_
 from app.extensions import db
 from app.services.cache_service import CacheService
 
@@ -63,33 +68,191 @@ def batch_load(model_class, ids: List[int], relationship: str):
     return {obj.id: getattr(obj, relationship) for obj in results}
 
 
-def paginate_query(query, page: int = 1, per_page: int = 20):
+def query_cache_key(query, prefix: str = 'query') -> str:
+    """
+    Build a cache key for a query from its SQL and bound parameters.
+    
+    The SQL alone is not enough: ``Product.query.filter_by(shop_id=1)`` and
+    ``filter_by(shop_id=2)`` compile to the same statement with a different
+    parameter, so both go into the (hashed) key.
+    
+    Args:
+        query: SQLAlchemy query or select statement
+        prefix: Cache key prefix
+    
+    Returns:
+        Cache key
+    """
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=db.session.get_bind().dialect)
+    params = json.dumps(sorted(compiled.params.items()), default=str)
+    digest = hashlib.sha256(f"{compiled}\n{params}".encode('utf-8')).hexdigest()
+    return CacheService.get_cache_key(prefix, digest)
+
+
+class CachedPagination(Pagination):
+    """
+    Pagination whose page contents are cached as primary keys or dicts.
+    
+    Only the ids of the page (or the serialized rows) and the total are
+    cached. On a hit the ORM rows are loaded again with one ``IN`` query,
+    so the cache never holds detached instances.
+    """
+    
+    def _query_items(self) -> list:
+        args = self._query_args
+        query, serializer = args['query'], args['serializer']
+        key = f"{args['cache_key']}:page:{self.page}:per_page:{self.per_page}"
+        if serializer is not None:
+            key = f"{key}:{args['serializer_key']}"
+        
+        def load_page() -> dict:
+            rows = query.limit(self.per_page).offset(self._query_offset).all()
+            total = query.order_by(None).count()
+            if serializer is not None:
+                return {'items': [serializer(row) for row in rows], 'total': total}
+            return {'ids': [_primary_key(row) for row in rows], 'total': total}
+        
+        page = CacheService.get_or_set(key, load_page, timeout=args['timeout'], tags=args['tags'])
+        self._cached_total = page['total']
+        if serializer is not None:
+            return page['items']
+        return load_by_ids(query, page['ids'])
+    
+    def _query_count(self) -> int:
+        return self._cached_total
+
+
+def _serializer_key(serializer: Callable[[Any], Any]) -> str:
+    """Name a module-level serializer function; other callables need an explicit key."""
+    name = getattr(serializer, '__qualname__', '')
+    if not name or '<' in name:
+        # Lambdas, nested functions and partials do not have a unique name
+        raise ValueError(f'paginate_query needs a serializer_key for serializer {serializer!r}')
+    return f"{serializer.__module__}.{name}"
+
+
+def paginate_query(query, page: int = 1, per_page: int = 20, timeout: int = 300,
+                   tags: Optional[List[str]] = None, serializer: Optional[Callable[[Any], Any]] = None,
+                   serializer_key: Optional[str] = None):
     """
     Paginate a query with caching.
     
+    Pages are cached under a hash of the query's SQL and bound parameters
+    (see query_cache_key). A cached page holds the primary keys of its rows
+    and the total; the rows are loaded again with one ``IN`` query. With a
+    ``serializer`` the serialized rows are cached instead and returned
+    as-is, which skips the database entirely on a hit.
+    
     Args:
-        query: SQLAlchemy query
+        query: SQLAlchemy query selecting a single model
         page: Page number (1-indexed)
         per_page: Items per page
+        timeout: Cache timeout in seconds
+        tags: Invalidation tags for the cached pages
+        serializer: Optional function turning a row into cacheable data
+        serializer_key: Name for the serializer's cached pages; required
+            unless the serializer is a module-level function (or method),
+            whose qualified name is used
     
     Returns:
-        Paginated results
+        Pagination with the page's rows (or serialized rows)
+    
+    Raises:
+        ValueError: If a serializer without a unique name is given no
+            serializer_key
     """
-    # Generate cache key from query
-    cache_key = f"paginate:{query.statement.compile()}:page:{page}:per_page:{per_page}"
+    if serializer is not None and serializer_key is None:
+        serializer_key = _serializer_key(serializer)
+    return CachedPagination(
+        page=page, per_page=per_page, error_out=False,
+        query=query, cache_key=query_cache_key(query, 'paginate'),
+        timeout=timeout, tags=tags, serializer=serializer, serializer_key=serializer_key,
+    )
+
+
+def _primary_key(row) -> Any:
+    identity = inspect(row).identity
+    return identity[0] if len(identity) == 1 else identity
+
+
+def load_by_ids(query, ids: List[Any]) -> list:
+    """
+    Load the rows of a query with the given primary keys in one ``IN`` query.
     
-    # Try to get from cache
-    cached = CacheService.get(cache_key)
-    if cached is not None:
-        return cached
+    Args:
+        query: SQLAlchemy query selecting a single model
+        ids: Primary keys (lists for composite keys)
     
-    # Execute query
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    Returns:
+        Rows in the order of ``ids``; keys without a row are skipped
+    """
+    if not ids:
+        return []
+    primary_key = inspect(query.column_descriptions[0]['entity']).primary_key
+    if len(primary_key) == 1:
+        condition = primary_key[0].in_(ids)
+    else:
+        ids = [tuple(pk) for pk in ids]
+        condition = tuple_(*primary_key).in_(ids)
+    # The query's own filters and loader options still apply
+    rows = query.order_by(None).limit(None).offset(None).filter(condition).all()
+    by_id = {_primary_key(row): row for row in rows}
+    return [by_id[pk] for pk in ids if pk in by_id]
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    Encode the sort-key values of the last row of a page as a cursor.
+    
+    Args:
+        values: Sort-key values, in sort order
+    
+    Returns:
+        Opaque URL-safe cursor string
+    """
+    payload = [float(v) if isinstance(v, Decimal) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Optional[list]:
+    """
+    Decode a cursor produced by encode_cursor.
     
-    # Cache the result
-    CacheService.set(cache_key, pagination, timeout=300)
+    Args:
+        cursor: Cursor string
+    
+    Returns:
+        List of sort-key values, or None if the cursor is invalid
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def keyset_filter(sort_keys: Sequence[Tuple[Any, str]], values: Sequence[Any]):
+    """
+    Build a keyset (seek) predicate for rows after a cursor.
     
-    return pagination
+    Unlike OFFSET, the predicate lets the database seek straight to the
+    next page through the ordering index, so deep pages stay cheap. The
+    last sort key must be unique (e.g. the primary key).
+    
+    Args:
+        sort_keys: List of (column expression, 'asc' | 'desc') in sort order
+        values: Sort-key values of the last row already returned
+    
+    Returns:
+        SQLAlchemy boolean clause
+    """
+    conditions = []
+    for i, (column, direction) in enumerate(sort_keys):
+        equal_prefix = [sort_keys[j][0] == values[j] for j in range(i)]
+        after = column < values[i] if direction == 'desc' else column > values[i]
+        conditions.append(and_(*equal_prefix, after))
+    return or_(*conditions)
 
 
 def optimize_query(query):
@@ -114,25 +277,26 @@ class QueryOptimizer:
     """Helper class for query optimization."""
     
     @staticmethod
-    def get_with_cache(key: str, query_func: Callable, timeout: int = 300):
+    def get_with_cache(key: str, query_func: Callable, timeout: int = 300,
+                       stale_ttl: int = 0, cache_none: bool = False, allow_orm: bool = False):
         """
         Execute query with caching.
         
+        Concurrent misses run the query once (see CacheService.get_or_set).
+        
         Args:
             key: Cache key
             query_func: Function that returns a query
             timeout: Cache timeout in seconds
+            stale_ttl: Seconds to serve an expired result while refreshing it
+            cache_none: Cache None results
+            allow_orm: Allow ORM instances in the results (stored with pickle)
         
         Returns:
             Query results
         """
-        cached = CacheService.get(key)
-        if cached is not None:
-            return cached
-        
-        result = query_func()
-        CacheService.set(key, result, timeout=timeout)
-        return result
+        return CacheService.get_or_set(key, query_func, timeout=timeout, stale_ttl=stale_ttl,
+                                       cache_none=cache_none, allow_orm=allow_orm)
     
     @staticmethod
     def prefetch_related(query, *relationships):
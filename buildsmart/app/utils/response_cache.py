@@ -3,28 +3,63 @@ Response caching middleware.
 
 This module provides middleware for caching HTTP responses
 to improve performance for frequently accessed endpoints.
+
+Cached responses carry ETag/Last-Modified validators so clients can poll
+with conditional GETs and receive 304 Not Modified when nothing changed.
+Authenticated endpoints are cached per user (``cache_private``) and their
+entries are tagged with the user, so ``CacheService.invalidate_user``
+drops them.
 """
+import hashlib
+import time
 from functools import wraps
-from typing import Optional, Callable
+from typing import Optional, Callable, Union
+from urllib.parse import urlencode
 from flask import request, make_response, has_request_context
+from flask_login import current_user
 from app.services.cache_service import CacheService
 
+# Bodies larger than this are not worth keeping in the cache
+MAX_BODY_SIZE = 512 * 1024
+
+# Query parameters that never change the response (cache busters)
+IGNORED_QUERY_PARAMS = {'_', '_t', 'cb'}
+
 
 def cache_response(timeout: int = 300, key_prefix: str = 'response', 
                   vary_on: Optional[list] = None, 
-                  condition: Optional[Callable] = None):
+                  condition: Optional[Callable] = None,
+                  tags: Optional[Union[list, Callable]] = None,
+                  cache_control: Optional[str] = None,
+                  vary_on_user: bool = False,
+                  max_body_size: int = MAX_BODY_SIZE):
     """
     Decorator to cache HTTP responses.
     
+    Cached GET responses carry a strong ``ETag`` (a hash of the body) and
+    ``Last-Modified`` (when the body was cached). Requests whose
+    ``If-None-Match`` or ``If-Modified-Since`` still match get an empty
+    304 Not Modified instead of the body.
+    
+    Query parameters are canonicalized (sorted, repeated values kept,
+    cache busters such as ``_`` dropped) so equivalent URLs share an entry.
+    Bodies over ``max_body_size`` are not cached; text bodies are stored
+    as text, and the cache serializer compresses large entries.
+    
     Args:
         timeout: Cache timeout in seconds (default: 5 minutes)
         key_prefix: Cache key prefix
-        vary_on: List of headers/params to vary cache on (e.g., ['Authorization'])
+        vary_on: List of headers/params to vary cache on (e.g., ['Accept-Language'])
         condition: Optional function to determine if response should be cached
+        tags: Invalidation tags, or a function of the view arguments returning them
+        cache_control: Cache-Control header for the response (None = leave as is)
+        vary_on_user: Cache separately per signed-in user (Flask-Login) and
+            tag entries with the user, so invalidate_user drops them
+        max_body_size: Largest body in bytes worth caching
     
     Usage:
-        @cache_response(timeout=600, vary_on=['Authorization'])
-        def my_view():
+        @cache_response(timeout=600, tags=lambda shop_id: [CacheService.shop_tag(shop_id)])
+        def shop_products(shop_id):
             return jsonify({'data': 'value'})
     """
     def decorator(func: Callable) -> Callable:
@@ -33,13 +68,20 @@ def cache_response(timeout: int = 300, key_prefix: str = 'response',
             if not has_request_context():
                 return func(*args, **kwargs)
             
+            # Only safe requests are cached and revalidated
+            if request.method not in ('GET', 'HEAD'):
+                return func(*args, **kwargs)
+            
+            started = time.perf_counter()
+            endpoint = request.endpoint or key_prefix
+            
             # Generate cache key
-            cache_key_parts = [key_prefix, request.method, request.path]
+            cache_key_parts = [key_prefix, 'GET', request.path]
             
             # Add query parameters
-            if request.args:
-                sorted_args = sorted(request.args.items())
-                cache_key_parts.append('&'.join([f"{k}={v}" for k, v in sorted_args]))
+            query = canonical_query_string(request.args)
+            if query:
+                cache_key_parts.append(query)
             
             # Add vary_on headers/params
             if vary_on:
@@ -48,16 +90,28 @@ def cache_response(timeout: int = 300, key_prefix: str = 'response',
                     if value:
                         cache_key_parts.append(f"{item}:{value}")
             
+            entry_tags = list(tags(*args, **kwargs) if callable(tags) else tags or [])
+            if vary_on_user:
+                user_id = current_user.get_id() if current_user and current_user.is_authenticated else None
+                cache_key_parts.append(f"user:{user_id or 'anonymous'}")
+                if user_id:
+                    entry_tags.append(CacheService.user_tag(user_id))
+            
             cache_key = ':'.join(cache_key_parts)
+            if entry_tags:
+                cache_key = CacheService.tagged_key(cache_key, entry_tags)
             
             # Check cache
             cached_response = CacheService.get(cache_key)
             if cached_response is not None:
                 # Recreate response from cached data
-                response = make_response(cached_response['data'])
+                response = make_response(_decode_body(cached_response))
                 for header, value in cached_response.get('headers', {}).items():
                     response.headers[header] = value
                 response.status_code = cached_response.get('status_code', 200)
+                response = _conditional(response, cached_response, vary_on, cache_control, vary_on_user)
+                outcome = 'not_modified' if response.status_code == 304 else 'hit'
+                CacheService.record_event('response', endpoint, outcome, time.perf_counter() - started)
                 return response
             
             # Execute function
@@ -65,53 +119,141 @@ def cache_response(timeout: int = 300, key_prefix: str = 'response',
             
             # Check if we should cache this response
             if condition and not condition(result):
+                CacheService.record_event('response', endpoint, 'uncacheable')
                 return result
             
-            # Cache the response
+            response = make_response(result)
+            if response.status_code != 200 or response.direct_passthrough:
+                CacheService.record_event('response', endpoint, 'uncacheable')
+                return response
+            
+            body = response.get_data()
             response_data = {
-                'data': result.data if hasattr(result, 'data') else str(result),
-                'status_code': result.status_code if hasattr(result, 'status_code') else 200,
-                'headers': dict(result.headers) if hasattr(result, 'headers') else {}
+                'status_code': response.status_code,
+                'headers': {k: v for k, v in response.headers.items() if k not in _PER_RESPONSE_HEADERS},
+                'etag': hashlib.sha256(body).hexdigest()[:32],
+                'last_modified': int(time.time()),
             }
             
-            CacheService.set(cache_key, response_data, timeout=timeout)
+            # Cache the response
+            if len(body) <= max_body_size:
+                try:
+                    response_data['text'] = body.decode('utf-8')
+                except UnicodeDecodeError:
+                    response_data['data'] = body
+                CacheService.set(cache_key, response_data, timeout=timeout)
+                CacheService.record_event('response', endpoint, 'miss', time.perf_counter() - started)
+            else:
+                CacheService.record_event('response', endpoint, 'too_large')
             
-            return result
+            return _conditional(response, response_data, vary_on, cache_control, vary_on_user)
         
         return wrapper
     return decorator
 
 
-def cache_public(timeout: int = 3600):
+def canonical_query_string(args) -> str:
+    """
+    Canonicalize query parameters for cache keys.
+    
+    Parameters are sorted by name and value, repeated values are kept,
+    empty values and cache-busting parameters are dropped.
+    
+    Args:
+        args: Request args (MultiDict)
+    
+    Returns:
+        URL-encoded canonical query string
+    """
+    items = sorted(
+        (key, value) for key, value in args.items(multi=True)
+        if value != '' and key not in IGNORED_QUERY_PARAMS
+    )
+    return urlencode(items)
+
+
+def _decode_body(cached_response: dict) -> bytes:
+    if 'text' in cached_response:
+        return cached_response['text'].encode('utf-8')
+    return cached_response['data']
+
+
+# Headers describing one particular response rather than the cached body
+_PER_RESPONSE_HEADERS = {'Set-Cookie', 'Content-Length', 'Date', 'ETag', 'Last-Modified'}
+
+
+def _conditional(response, cached_response: dict, vary_on: Optional[list], cache_control: Optional[str],
+                 vary_on_user: bool = False):
+    """
+    Add validators and caching headers, answering 304 if the client's copy is current.
+    
+    ``If-None-Match`` is compared against the strong ETag and takes
+    precedence over ``If-Modified-Since``, as RFC 9110 requires.
+    """
+    response.set_etag(cached_response['etag'])
+    response.last_modified = cached_response['last_modified']
+    if cache_control:
+        response.headers['Cache-Control'] = cache_control
+    
+    # Headers (not query parameters) the cached body depends on
+    for item in vary_on or []:
+        if item not in request.args:
+            response.vary.add(item)
+    if vary_on_user or (cache_control and cache_control.startswith('private')):
+        # Browser sessions identify the user by cookie
+        response.vary.add('Cookie')
+    
+    return response.make_conditional(request)
+
+
+def cache_public(timeout: int = 3600, tags: Optional[Union[list, Callable]] = None,
+                 max_age: Optional[int] = None):
     """
     Cache decorator for public endpoints (no authentication required).
     
+    ``timeout`` only applies to the server-side entry. Clients and proxies
+    may reuse a response for ``max_age`` seconds without asking again;
+    tagged entries are invalidated on the server as soon as their data
+    changes, so by default clients revalidate them on every use
+    (``no-cache``) and get a 304 while they are still current.
+    
     Args:
         timeout: Cache timeout in seconds (default: 1 hour)
+        tags: Invalidation tags, or a function of the view arguments returning them
+        max_age: Client cache lifetime in seconds (default: 0 with tags,
+            otherwise timeout)
     
     Usage:
         @cache_public(timeout=7200)
         def public_api():
             return jsonify({'data': 'value'})
     """
-    return cache_response(timeout=timeout, key_prefix='public', vary_on=None)
+    if max_age is None:
+        max_age = 0 if tags else timeout
+    return cache_response(timeout=timeout, key_prefix='public', vary_on=None, tags=tags,
+                          cache_control=f'public, max-age={max_age}' if max_age else 'public, no-cache')
 
 
-def cache_private(timeout: int = 300):
+def cache_private(timeout: int = 300, tags: Optional[Union[list, Callable]] = None):
     """
     Cache decorator for private endpoints (requires authentication).
     
+    Entries are kept per signed-in user and tagged with the user, so
+    CacheService.invalidate_user(user_id) drops them.
+    
     Args:
         timeout: Cache timeout in seconds (default: 5 minutes)
+        tags: Additional invalidation tags
     
     Usage:
-        @cache_private(timeout=600)
         @login_required
+        @cache_private(timeout=600)
         def private_api():
             return jsonify({'data': 'value'})
     """
-    return cache_response(timeout=timeout, key_prefix='private', 
-                         vary_on=['Authorization'])
+    return cache_response(timeout=timeout, key_prefix='private', vary_on=['Authorization'],
+                          vary_on_user=True, tags=tags,
+                          cache_control='private, no-cache')
 
 
 def no_cache():
@@ -0,0 +1,49 @@
+"""Add geohash spatial index column to shops
+
+Revision ID: a3c91e5d7b20
+Revises: 642fdedcb640
+Create Date: 2026-10-17 09:12:44.318520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from app.utils.geo import encode_geohash
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c91e5d7b20'
+down_revision = '642fdedcb640'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('shops', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('geohash', sa.String(length=9), nullable=True))
+        batch_op.create_index(batch_op.f('ix_shops_geohash'), ['geohash'], unique=False)
+
+    # Backfill geohashes for existing shops
+    connection = op.get_bind()
+    shops = sa.table(
+        'shops',
+        sa.column('id', sa.Integer),
+        sa.column('latitude', sa.Float),
+        sa.column('longitude', sa.Float),
+        sa.column('geohash', sa.String),
+    )
+    rows = connection.execute(sa.select(shops.c.id, shops.c.latitude, shops.c.longitude)).fetchall()
+    for shop_id, latitude, longitude in rows:
+        if latitude is None or longitude is None:
+            continue
+        connection.execute(
+            shops.update().where(shops.c.id == shop_id).values(
+                geohash=encode_geohash(latitude, longitude)
+            )
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('shops', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_shops_geohash'))
+        batch_op.drop_column('geohash')
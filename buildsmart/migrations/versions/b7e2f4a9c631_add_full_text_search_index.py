@@ -0,0 +1,53 @@
+"""Add full-text search index for products, shops and services
+
+Revision ID: b7e2f4a9c631
+Revises: a3c91e5d7b20
+Create Date: 2026-10-17 11:03:27.905114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2f4a9c631'
+down_revision = 'a3c91e5d7b20'
+branch_labels = None
+depends_on = None
+
+# (table, FTS5 table, title column, body column)
+DOCUMENTS = [
+    ('products', 'products_fts', 'name', 'description'),
+    ('shops', 'shops_fts', 'name', 'description'),
+    ('services', 'services_fts', 'title', 'description'),
+]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    for table, fts_table, title, body in DOCUMENTS:
+        if dialect == 'postgresql':
+            op.execute(
+                f'CREATE INDEX IF NOT EXISTS ix_{table}_fts ON {table} USING GIN '
+                f"(to_tsvector('english'::regconfig, coalesce({title}, '') || ' ' || coalesce({body}, '')))"
+            )
+        elif dialect == 'sqlite':
+            op.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} '
+                f"USING fts5({title}, {body}, tokenize = 'porter unicode61')"
+            )
+            op.execute(
+                f'INSERT INTO {fts_table} (rowid, {title}, {body}) '
+                f"SELECT id, coalesce({title}, ''), coalesce({body}, '') FROM {table}"
+            )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    for table, fts_table, title, body in DOCUMENTS:
+        if dialect == 'postgresql':
+            op.execute(f'DROP INDEX IF EXISTS ix_{table}_fts')
+        elif dialect == 'sqlite':
+            op.execute(f'DROP TABLE IF EXISTS {fts_table}')
@@ -0,0 +1,28 @@
+"""Add normalized spec hash to recommendations
+
+Revision ID: c4d8a1f3e9b2
+Revises: b7e2f4a9c631
+Create Date: 2026-10-17 14:02:31.774105
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8a1f3e9b2'
+down_revision = 'b7e2f4a9c631'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('recommendations', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('spec_hash', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_recommendations_spec_hash'), ['spec_hash'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('recommendations', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_recommendations_spec_hash'))
+        batch_op.drop_column('spec_hash')
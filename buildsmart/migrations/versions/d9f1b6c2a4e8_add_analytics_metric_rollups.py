@@ -0,0 +1,36 @@
+"""Add rollup dimension and product to analytics metrics
+
+Revision ID: d9f1b6c2a4e8
+Revises: c4d8a1f3e9b2
+Create Date: 2026-10-17 16:41:08.225310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9f1b6c2a4e8'
+down_revision = 'c4d8a1f3e9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('analytics_metrics', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('product_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('dimension', sa.String(length=100), nullable=True))
+        batch_op.create_index(batch_op.f('ix_analytics_metrics_product_id'), ['product_id'], unique=False)
+        batch_op.create_foreign_key('fk_analytics_metrics_product_id', 'products', ['product_id'], ['id'])
+        batch_op.create_unique_constraint(
+            'unique_analytics_metric_rollup', ['metric_type', 'metric_date', 'metric_name', 'dimension']
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('analytics_metrics', schema=None) as batch_op:
+        batch_op.drop_constraint('unique_analytics_metric_rollup', type_='unique')
+        batch_op.drop_constraint('fk_analytics_metrics_product_id', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_analytics_metrics_product_id'))
+        batch_op.drop_column('dimension')
+        batch_op.drop_column('product_id')
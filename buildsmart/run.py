@@ -1,4 +1,5 @@
 import os
+import click
 from app import create_app
 from app.extensions import db, socketio
 from app.models import User, Shop, Product, Service, Order, OrderItem, Recommendation, Category, Cart, CartItem, Payment, Review, Message, Conversation, Comparison, Address
@@ -131,5 +132,80 @@ def init_db():
         print('Shop Owner - Username: shop_owner, Password: password123')
 
 
+@app.cli.command()
+def rebuild_search_index():
+    """Rebuild the full-text search index for products, shops and services"""
+    from app.services.search_service import SearchService
+    
+    counts = SearchService.rebuild_index()
+    for index_name, count in counts.items():
+        print(f'{index_name}: {count} rows indexed')
+
+
+@app.cli.command()
+def rebuild_suggestions():
+    """Rebuild the search suggestion index and publish a new snapshot"""
+    from app.services.suggestion_service import SuggestionService
+    
+    count = SuggestionService.rebuild()
+    print(f'Suggestion index rebuilt with {count} entries')
+
+
+@app.cli.command()
+def fit_text_model():
+    """Fit the project description matching model and save it"""
+    from app.ai.text_matcher import fit_text_model as fit
+    
+    stats = fit(app.config['TEXT_MODEL_PATH'])
+    print(f"Text model fitted on {stats['products']} products ({stats['terms']} terms)")
+
+
+@app.cli.command()
+@click.option('--only', multiple=True, help='Warm only these tasks (repeatable)')
+@click.option('--workers', type=int, default=None, help='Maximum number of tasks run at once')
+def cache_warm(only, workers):
+    """Precompute hot cache entries (home page, categories, trending, analytics)"""
+    from app.services.cache_warmer import CacheWarmer
+    
+    try:
+        results = CacheWarmer.warm(app, names=only or None, max_workers=workers)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--only')
+    for result in results:
+        status = 'ok' if result['ok'] else f"failed: {result['error']}"
+        print(f"{result['name']}: {result['seconds'] * 1000:.1f} ms ({status})")
+    print(f"Warmed {sum(r['ok'] for r in results)}/{len(results)} cache entries")
+
+
+@app.cli.command()
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Last day to roll up (default: yesterday)')
+@click.option('--rebuild-days', type=int, default=7, show_default=True,
+              help='Also roll up again this many already rolled-up days, for late order changes')
+def analytics_rollup(until, rebuild_days):
+    """Roll up orders of closed days into daily analytics metrics"""
+    from app.services.analytics_rollup_service import AnalyticsRollupService
+    
+    batches = AnalyticsRollupService.rollup(until=until.date() if until else None, rebuild_days=rebuild_days)
+    for start, end in batches:
+        print(f'Rolled up {start.isoformat()} to {end.isoformat()}')
+    print(f'Analytics rolled up to {AnalyticsRollupService.get_watermark().isoformat()}')
+
+
+@app.cli.command()
+@click.option('--full', is_flag=True, help='Export every month again, dropping deleted orders')
+def analytics_export(full):
+    """Export order facts by month for columnar analytics"""
+    from app.services.order_facts_service import OrderFactsService
+    
+    try:
+        result = OrderFactsService.export(full=full)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for month in result['months']:
+        print(f'Exported {month}')
+    print(f"Exported {result['rows']} facts as {result['format']} to {app.config['ANALYTICS_FACTS_PATH']}")
+
+
 if __name__ == '__main__':
     socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -6,20 +6,46 @@ This module tests:
 - Report generation (PDF, Excel)
 - Analytics service methods
 - Analytics API endpoints
+- Date range filtering and bucketing
+- Daily rollups
+- Incremental rollup maintenance
+- Columnar analytics over exported order facts
 """
 import pytest
+from contextlib import contextmanager
 from decimal import Decimal
 from datetime import datetime, timedelta, date
 from flask import current_app
+from sqlalchemy import event
 from app.models import (
     User, Order, OrderItem, Product, Shop, Category,
-    AnalyticsMetric, ReportSchedule
+    AnalyticsMetric, ReportSchedule, ReturnRequest
 )
 from app.services.analytics_service import AnalyticsService
 from app.services.report_service import ReportService
+from app.services.cache_service import CacheService
+from app.services.analytics_rollup_service import AnalyticsRollupService
+from app.services import order_facts_service
+from app.services.order_facts_service import OrderFactsService
+from app.utils.date_ranges import bucket_date, date_bucket, date_window, in_date_range
 from app.extensions import db
 
 
+@contextmanager
+def count_queries(db):
+    """Count SQL statements executed inside the block"""
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_execute)
+
+
 @pytest.fixture
 def test_shop(client, test_user):
     """Create a test shop"""
@@ -89,6 +115,48 @@ def test_order(client, test_user, test_shop, test_product):
     return order
 
 
+@pytest.fixture
+def dated_orders(client, test_user):
+    """Paid orders on either side of the 2024-03-04 .. 2024-03-10 range boundaries"""
+    shop = Shop(name='Range Shop', address='1 Range Rd', phone='1234567890', owner_id=test_user.id,
+                latitude=-1.28, longitude=36.82)
+    db.session.add(shop)
+    db.session.flush()
+    timestamps = [
+        datetime(2024, 3, 3, 23, 59, 59),   # before the range
+        datetime(2024, 3, 4, 0, 0, 0),      # first instant of the range
+        datetime(2024, 3, 6, 12, 0, 0),
+        datetime(2024, 3, 10, 23, 59, 59),  # last second of the range
+        datetime(2024, 3, 11, 0, 0, 0),     # after the range
+    ]
+    for i, created_at in enumerate(timestamps):
+        db.session.add(Order(
+            order_number=f'RNG{i:03d}', customer_id=test_user.id, shop_id=shop.id,
+            total_amount=Decimal('10.00'), subtotal_amount=Decimal('10.00'),
+            delivery_address='1 Range Rd', payment_status='paid', status='delivered',
+            created_at=created_at
+        ))
+    db.session.commit()
+    return shop
+
+
+@pytest.fixture
+def sold_items(dated_orders):
+    """Order items of a categorized product on every dated order"""
+    category = Category(name='Rollup Category')
+    db.session.add(category)
+    db.session.flush()
+    product = Product(name='Rollup Cement', price=Decimal('5.00'), unit='bag',
+                      shop_id=dated_orders.id, category_id=category.id)
+    db.session.add(product)
+    db.session.flush()
+    for order in Order.query.filter_by(shop_id=dated_orders.id):
+        db.session.add(OrderItem(order_id=order.id, product_id=product.id, quantity=2,
+                                 unit_price=Decimal('5.00'), total_price=Decimal('10.00')))
+    db.session.commit()
+    return product
+
+
 class TestAnalyticsService:
     """Tests for analytics service"""
     
@@ -213,6 +281,468 @@ class TestAnalyticsService:
         assert metric.shop_id == test_shop.id
 
 
+class TestDateRanges:
+    """Tests for half-open date range filters and portable bucketing"""
+    
+    def test_window_is_half_open(self):
+        """Test an inclusive range of days becomes [start, end + 1 day)"""
+        assert date_window(date(2024, 3, 4), date(2024, 3, 10)) == (
+            datetime(2024, 3, 4), datetime(2024, 3, 11)
+        )
+    
+    def test_filter_does_not_wrap_column(self):
+        """Test the predicate compares the raw column so its index is usable"""
+        sql = str(in_date_range(Order.created_at, date(2024, 3, 4), date(2024, 3, 10)))
+        assert 'date(' not in sql.lower()
+        assert 'orders.created_at >=' in sql
+        assert 'orders.created_at <' in sql
+    
+    def test_boundaries(self, client, dated_orders):
+        """Test orders on the first and last day are included, neighbours excluded"""
+        overview = AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))
+        assert overview['total_orders'] == 3
+        assert overview['total_sales'] == 30.0
+        
+        analytics = AnalyticsService.get_shop_analytics(dated_orders.id, date(2024, 3, 4), date(2024, 3, 10))
+        assert analytics['total_orders'] == 3
+        assert [row['date'] for row in analytics['sales_trends']] == ['2024-03-04', '2024-03-06', '2024-03-10']
+    
+    def test_trends_by_week_and_month(self, client, dated_orders):
+        """Test week and month buckets work on SQLite"""
+        weeks = AnalyticsService.get_sales_trends(date(2024, 3, 1), date(2024, 3, 31), 'week')
+        # 2024-03-03 is a Sunday, so it belongs to the week starting Monday 2024-02-26
+        assert [(row['period'], row['orders']) for row in weeks] == [
+            ('2024-02-26', 1), ('2024-03-04', 3), ('2024-03-11', 1)
+        ]
+        
+        months = AnalyticsService.get_sales_trends(date(2024, 3, 1), date(2024, 3, 31), 'month')
+        assert [(row['period'], row['orders']) for row in months] == [('2024-03-01', 5)]
+    
+    def test_bucket_date_normalizes_backend_values(self):
+        """Test strings, datetimes and dates all come back as dates"""
+        assert bucket_date('2024-03-04') == date(2024, 3, 4)
+        assert bucket_date('2024-03-04 00:00:00') == date(2024, 3, 4)
+        assert bucket_date(datetime(2024, 3, 4, 5)) == date(2024, 3, 4)
+        assert bucket_date(date(2024, 3, 4)) == date(2024, 3, 4)
+        assert bucket_date(None) is None
+    
+    def test_postgresql_bucket(self):
+        """Test PostgreSQL buckets use date_trunc"""
+        from sqlalchemy.dialects import postgresql
+        sql = str(date_bucket(Order.created_at, 'week', 'postgresql').compile(dialect=postgresql.dialect()))
+        assert 'date_trunc' in sql
+
+
+class TestSalesOverview:
+    """Tests for the single-pass sales overview"""
+    
+    def test_one_query(self, client, dated_orders):
+        """Test every overview metric comes from one scan of the orders"""
+        with count_queries(db) as statements:
+            AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))
+        assert len([statement for statement in statements if 'FROM orders' in statement]) == 1
+    
+    def test_conditional_aggregates(self, client, test_user, dated_orders):
+        """Test paid, delivered, discount and tax figures are aggregated separately"""
+        db.session.add(Order(
+            order_number='RNG100', customer_id=test_user.id, shop_id=dated_orders.id,
+            total_amount=Decimal('50.00'), discount_amount=Decimal('5.00'), tax_amount=Decimal('2.50'),
+            payment_status='pending', status='pending', created_at=datetime(2024, 3, 5, 9, 0)
+        ))
+        db.session.commit()
+        
+        overview = AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))
+        assert overview['total_orders'] == 4
+        assert overview['completed_orders'] == 3
+        assert overview['pending_orders'] == 1
+        # The unpaid order is counted but not in sales
+        assert overview['total_sales'] == 30.0
+        assert overview['avg_order_value'] == 7.5
+        assert overview['total_discounts'] == 5.0
+        assert overview['total_taxes'] == 2.5
+    
+    def test_shop_filter_and_reuse(self, client, test_user, dated_orders):
+        """Test the overview per shop backs get_shop_analytics"""
+        other = Shop(name='Other Shop', address='2 Range Rd', phone='1234567890', owner_id=test_user.id,
+                     latitude=-1.29, longitude=36.83)
+        db.session.add(other)
+        db.session.flush()
+        db.session.add(Order(
+            order_number='RNG200', customer_id=test_user.id, shop_id=other.id,
+            total_amount=Decimal('99.00'), payment_status='paid', status='delivered',
+            created_at=datetime(2024, 3, 5, 9, 0)
+        ))
+        db.session.commit()
+        
+        overview = AnalyticsService.get_sales_overview(date(2024, 3, 4), date(2024, 3, 10), shop_id=other.id)
+        assert overview['total_orders'] == 1
+        assert overview['total_sales'] == 99.0
+        assert AnalyticsService.get_sales_overview(date(2024, 3, 4), date(2024, 3, 10))['total_orders'] == 4
+        
+        analytics = AnalyticsService.get_shop_analytics(dated_orders.id, date(2024, 3, 4), date(2024, 3, 10))
+        assert analytics['total_orders'] == 3
+        assert analytics['total_revenue'] == 30.0
+        assert analytics['avg_order_value'] == 10.0
+
+
+class TestAnalyticsRollups:
+    """Tests for daily rollups in AnalyticsMetric"""
+    
+    RANGE = (date(2024, 3, 1), date(2024, 3, 31))
+    
+    def _report(self, shop_id):
+        start, end = self.RANGE
+        return {
+            'overview': AnalyticsService._compute_sales_overview(start, end),
+            'trends': AnalyticsService.get_sales_trends(start, end, 'week'),
+            'products': AnalyticsService.get_top_products(10, start, end),
+            'shops': AnalyticsService.get_top_shops(10, start, end),
+            'categories': AnalyticsService.get_category_performance(start, end),
+            'active_users': AnalyticsService.get_user_analytics(start, end)['active_users'],
+            'shop': AnalyticsService.get_shop_analytics(shop_id, start, end),
+        }
+    
+    def test_rollups_match_live_results(self, client, dated_orders, sold_items):
+        """Test reports read from rollups equal the ones computed from orders"""
+        CacheService.clear()
+        live = self._report(dated_orders.id)
+        assert live['overview']['total_orders'] == 5
+        assert live['products'][0]['total_quantity'] == 10
+        
+        AnalyticsRollupService.rollup()
+        assert AnalyticsRollupService.get_watermark() == date.today() - timedelta(days=1)
+        CacheService.clear()
+        with count_queries(db) as statements:
+            rolled = self._report(dated_orders.id)
+        assert rolled == live
+        # Closed days are answered without touching the orders
+        assert not [statement for statement in statements if 'FROM orders' in statement]
+    
+    def test_rollup_rows(self, client, dated_orders, sold_items):
+        """Test one row per measure, day and dimension, without zero measures"""
+        AnalyticsRollupService.rollup()
+        
+        day = AnalyticsMetric.query.filter_by(metric_type='day', metric_date=date(2024, 3, 6)).all()
+        assert {row.metric_name: float(row.metric_value) for row in day} == {
+            'orders': 1, 'paid_orders': 1, 'delivered_orders': 1, 'sales': 10.0
+        }
+        assert {row.dimension for row in day} == {'all'}
+        product = AnalyticsMetric.query.filter_by(metric_type='product', metric_name='quantity',
+                                                  metric_date=date(2024, 3, 6)).one()
+        assert product.dimension == f'product:{sold_items.id}'
+        assert product.category_id == sold_items.category_id
+        
+        # Rolling up again replaces rather than duplicates
+        AnalyticsRollupService.rollup(rebuild_days=10000)
+        assert AnalyticsMetric.query.filter_by(metric_type='day', metric_date=date(2024, 3, 6)).count() == 4
+    
+    def test_distinct_customers_read_per_month(self, client, test_user, dated_orders):
+        """Test distinct customers over whole months are counted from the monthly rows"""
+        db.session.add(Order(
+            order_number='RNG400', customer_id=test_user.id, shop_id=dated_orders.id,
+            total_amount=Decimal('10.00'), payment_status='paid', status='delivered',
+            created_at=datetime(2024, 1, 20, 9, 0)
+        ))
+        db.session.commit()
+        start, end = date(2024, 1, 15), date(2024, 12, 31)
+        live = AnalyticsService.get_top_shops(10, start, end)
+        assert live[0]['unique_customers'] == 1
+        
+        AnalyticsRollupService.rollup()
+        month = AnalyticsMetric.query.filter_by(metric_type='customer_month', metric_name='paid_orders',
+                                                metric_date=date(2024, 3, 1)).one()
+        assert month.dimension == f'shop:{dated_orders.id}:user:{test_user.id}'
+        assert float(month.metric_value) == 5
+        
+        # Only the days before the first whole month are read per day
+        AnalyticsMetric.query.filter(
+            AnalyticsMetric.metric_type == 'customer', AnalyticsMetric.metric_date >= date(2024, 2, 1)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        assert AnalyticsService.get_top_shops(10, start, end) == live
+        assert AnalyticsService.get_user_analytics(date(2024, 3, 1), end)['active_users'] == 1
+    
+    def test_today_is_live(self, client, test_user, dated_orders):
+        """Test today's orders are counted before they are rolled up"""
+        AnalyticsRollupService.rollup()
+        db.session.add(Order(
+            order_number='RNG300', customer_id=test_user.id, shop_id=dated_orders.id,
+            total_amount=Decimal('7.00'), payment_status='paid', status='pending'
+        ))
+        db.session.commit()
+        
+        overview = AnalyticsService._compute_sales_overview(date(2024, 3, 1), date.today())
+        assert overview['total_orders'] == 6
+        assert overview['total_sales'] == 57.0
+        # Today is never rolled up
+        AnalyticsRollupService.rollup(until=date.today())
+        assert AnalyticsRollupService.get_watermark() == date.today() - timedelta(days=1)
+    
+    def test_rebuild_picks_up_late_changes(self, client, dated_orders):
+        """Test rolling recent days up again corrects changed orders"""
+        AnalyticsRollupService.rollup()
+        order = Order.query.filter_by(order_number='RNG002').one()
+        order.payment_status = 'refunded'
+        db.session.commit()
+        
+        start, end = date(2024, 3, 4), date(2024, 3, 10)
+        assert AnalyticsService._compute_sales_overview(start, end)['total_sales'] == 30.0
+        AnalyticsRollupService.rollup(rebuild_days=(date.today() - start).days)
+        assert AnalyticsService._compute_sales_overview(start, end)['total_sales'] == 20.0
+    
+    def test_empty_database(self, client, db):
+        """Test the first run without orders only sets the watermark"""
+        assert AnalyticsRollupService.rollup() == []
+        assert AnalyticsRollupService.get_watermark() == date.today() - timedelta(days=1)
+
+
+
+@pytest.fixture
+def incremental(app, monkeypatch, dated_orders, sold_items):
+    """Rollups maintained incrementally, rolled up to today"""
+    monkeypatch.setitem(app.config, 'ANALYTICS_INCREMENTAL_ROLLUPS', True)
+    AnalyticsRollupService.rollup()
+    return dated_orders
+
+
+class TestIncrementalRollups:
+    """Tests for rollups kept current by the order hooks"""
+    
+    def _assert_current(self):
+        """Stored rows equal a fresh aggregation of every order"""
+        stored = {
+            (row.metric_type, row.metric_date, row.metric_name, row.dimension): row.metric_value
+            for row in AnalyticsMetric.query.filter(AnalyticsMetric.metric_type != 'rollup')
+            if row.metric_value != 0
+        }
+        fresh = {
+            (row['metric_type'], row['metric_date'], row['metric_name'], row['dimension']): row['metric_value']
+            for row in AnalyticsRollupService.aggregate(date(2000, 1, 1), date.today())
+        }
+        assert stored == fresh
+    
+    def _today(self, measure, shop_id=None):
+        row = AnalyticsMetric.query.filter_by(
+            metric_type='shop' if shop_id else 'day', metric_name=measure, metric_date=date.today(),
+            dimension=f'shop:{shop_id}' if shop_id else 'all'
+        ).first()
+        return float(row.metric_value) if row else 0.0
+    
+    def test_watermark_is_incremental(self, incremental):
+        """Test rolling up with the setting marks every day as rolled up"""
+        assert AnalyticsRollupService.is_incremental()
+        assert AnalyticsRollupService.split_range(date(2024, 3, 1), date.today()) == \
+            ((date(2024, 3, 1), date.today()), None)
+        
+        CacheService.clear()
+        with count_queries(db) as statements:
+            AnalyticsService.get_sales_overview(date(2024, 3, 1), date.today())
+        assert not [statement for statement in statements if 'FROM orders' in statement]
+    
+    def test_order_lifecycle(self, incremental, test_user, sold_items):
+        """Test placing, paying and cancelling an order update today's rows"""
+        order = Order(order_number='INC001', customer_id=test_user.id, shop_id=incremental.id,
+                      total_amount=Decimal('25.00'), payment_status='pending', status='pending')
+        order.items.append(OrderItem(product_id=sold_items.id, quantity=5,
+                                     unit_price=Decimal('5.00'), total_price=Decimal('25.00')))
+        db.session.add(order)
+        db.session.commit()
+        assert self._today('orders') == 1
+        assert self._today('sales') == 0
+        self._assert_current()
+        
+        order.payment_status = 'paid'
+        db.session.commit()
+        assert self._today('sales') == 25.0
+        assert self._today('sales', incremental.id) == 25.0
+        self._assert_current()
+        
+        order.status = 'cancelled'
+        order.payment_status = 'refunded'
+        db.session.commit()
+        assert self._today('orders') == 1
+        assert self._today('sales') == 0
+        self._assert_current()
+        
+        overview = AnalyticsService._compute_sales_overview(date(2024, 3, 1), date.today())
+        assert overview['total_orders'] == 6
+        assert overview['total_sales'] == 50.0
+    
+    def test_changes_to_rolled_up_days(self, incremental):
+        """Test changes to orders of past days and deletions update their day"""
+        order = Order.query.filter_by(order_number='RNG002').one()
+        order.payment_status = 'refunded'
+        db.session.commit()
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))['total_sales'] == 20.0
+        
+        db.session.delete(Order.query.filter_by(order_number='RNG003').one())
+        db.session.commit()
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))['total_orders'] == 2
+        self._assert_current()
+    
+    def test_orders_locked_before_reading_their_contribution(self, monkeypatch, incremental):
+        """Test changed orders are locked before their old contribution is read"""
+        from app.services import analytics_rollup_service
+        calls = []
+        lock, contributions = analytics_rollup_service._lock_orders, analytics_rollup_service._contributions
+        monkeypatch.setattr(analytics_rollup_service, '_lock_orders',
+                            lambda ids: calls.append(('lock', set(ids))) or lock(ids))
+        monkeypatch.setattr(analytics_rollup_service, '_contributions',
+                            lambda ids: calls.append(('read', set(ids))) or contributions(ids))
+        
+        order = Order.query.filter_by(order_number='RNG002').one()
+        order.payment_status = 'refunded'
+        db.session.commit()
+        assert calls[:2] == [('lock', {order.id}), ('read', {order.id})]
+        self._assert_current()
+    
+    def test_completed_refund(self, incremental, test_user):
+        """Test completing a refund return records the refund on the order's day"""
+        order = Order.query.filter_by(order_number='RNG002').one()
+        request = ReturnRequest(return_number='RET-INC-1', order_id=order.id, order_item_id=order.items[0].id,
+                                reason='damaged', return_type='refund', refund_amount=Decimal('4.00'),
+                                requested_by=test_user.id)
+        db.session.add(request)
+        db.session.commit()
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 1), date(2024, 3, 31))['total_refunds'] == 0
+        
+        request.complete()
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 1), date(2024, 3, 31))['total_refunds'] == 4.0
+        assert AnalyticsMetric.query.filter_by(
+            metric_type='shop', metric_name='refunds', metric_date=date(2024, 3, 6)
+        ).one().dimension == f'shop:{incremental.id}'
+        self._assert_current()
+    
+    def test_rollback(self, incremental):
+        """Test deltas of rolled-back changes are rolled back with them"""
+        order = Order.query.filter_by(order_number='RNG002').one()
+        order.payment_status = 'refunded'
+        db.session.flush()
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))['total_sales'] == 20.0
+        db.session.rollback()
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))['total_sales'] == 30.0
+        self._assert_current()
+    
+    def test_disabled(self, app, incremental):
+        """Test turning the setting off goes back to reading open days live"""
+        app.config['ANALYTICS_INCREMENTAL_ROLLUPS'] = False
+        assert not AnalyticsRollupService.is_incremental()
+        order = Order.query.filter_by(order_number='RNG002').one()
+        order.payment_status = 'refunded'
+        db.session.commit()
+        # Not applied to the rolled-up day until it is rebuilt
+        assert AnalyticsService._compute_sales_overview(date(2024, 3, 4), date(2024, 3, 10))['total_sales'] == 30.0
+
+
+
+@pytest.fixture
+def facts(app, monkeypatch, tmp_path, dated_orders, sold_items):
+    """Order facts exported to a temporary directory and used for reports"""
+    monkeypatch.setitem(app.config, 'ANALYTICS_FACTS_PATH', str(tmp_path))
+    monkeypatch.setitem(app.config, 'ANALYTICS_ENGINE', 'facts')
+    return tmp_path
+
+
+class TestOrderFacts:
+    """Tests for the columnar analytics engine"""
+    
+    RANGE = (date(2024, 3, 1), date(2024, 3, 31))
+    
+    def _rankings(self):
+        start, end = self.RANGE
+        return {
+            'products': AnalyticsService.get_top_products(10, start, end),
+            'shops': AnalyticsService.get_top_shops(10, start, end),
+            'categories': AnalyticsService.get_category_performance(start, end),
+        }
+    
+    def test_export_partitions_by_month(self, facts):
+        """Test one partition per month, with a row per order item"""
+        result = OrderFactsService.export()
+        assert result['months'] == ['2024-03']
+        assert result['rows'] == 5
+        extension = 'parquet' if result['format'] == 'parquet' else 'csv'
+        assert (facts / 'month=2024-03' / f'facts.{extension}').exists()
+        
+        loaded = OrderFactsService.load_facts(date(2024, 3, 4), date(2024, 3, 10))
+        expected = Order.query.filter(Order.order_number.in_(['RNG001', 'RNG002', 'RNG003']))
+        assert set(loaded['order_id']) == {order.id for order in expected}
+        assert loaded['product_name'].unique().tolist() == ['Rollup Cement']
+    
+    def test_rankings_match_database(self, app, facts):
+        """Test rankings grouped from the facts equal the database ones"""
+        app.config['ANALYTICS_ENGINE'] = 'rollups'
+        expected = self._rankings()
+        assert expected['products'] and expected['shops'] and expected['categories']
+        
+        app.config['ANALYTICS_ENGINE'] = 'facts'
+        OrderFactsService.export()
+        with count_queries(db) as statements:
+            assert self._rankings() == expected
+        assert not [statement for statement in statements if 'FROM orders' in statement]
+    
+    def test_not_exported(self, facts):
+        """Test reports use the database until facts are exported"""
+        assert not OrderFactsService.is_enabled()
+        assert AnalyticsService.get_top_shops(10, *self.RANGE)[0]['total_orders'] == 5
+    
+    def test_state_cached_until_exported_again(self, app, monkeypatch, facts):
+        """Test the export state is read once per change and not at all with the default engine"""
+        OrderFactsService.export()
+        state = OrderFactsService.get_state()
+        
+        def no_reads(*args, **kwargs):
+            raise AssertionError('export state read again')
+        
+        with monkeypatch.context() as m:
+            m.setattr(order_facts_service, 'open', no_reads, raising=False)
+            assert OrderFactsService.is_enabled()
+            assert OrderFactsService.get_state() == state
+            
+            m.setattr(OrderFactsService, 'get_state', staticmethod(no_reads))
+            m.setitem(app.config, 'ANALYTICS_ENGINE', 'rollups')
+            assert not OrderFactsService.is_enabled()
+        
+        OrderFactsService.export()
+        assert OrderFactsService.get_state()['exported_at'] > state['exported_at']
+    
+    def test_incremental_export(self, monkeypatch, facts, test_user, dated_orders):
+        """Test later exports rewrite only months with changed orders"""
+        monkeypatch.setattr(order_facts_service, 'EXPORT_OVERLAP', timedelta(0))
+        OrderFactsService.export()
+        assert OrderFactsService.export()['months'] == []
+        
+        db.session.add(Order(
+            order_number='FCT001', customer_id=test_user.id, shop_id=dated_orders.id,
+            total_amount=Decimal('40.00'), payment_status='paid', status='delivered',
+            created_at=datetime(2024, 2, 10, 12, 0)
+        ))
+        db.session.commit()
+        assert OrderFactsService.export()['months'] == ['2024-02']
+        assert AnalyticsService.get_top_shops(10, date(2024, 2, 1), date(2024, 3, 31))[0]['total_orders'] == 6
+        
+        order = Order.query.filter_by(order_number='RNG002').one()
+        order.payment_status = 'refunded'
+        db.session.commit()
+        assert OrderFactsService.export()['months'] == ['2024-03']
+        assert AnalyticsService.get_top_shops(10, *self.RANGE)[0]['total_orders'] == 4
+    
+    def test_full_export_drops_deleted_months(self, facts):
+        """Test a full export removes partitions of months without orders"""
+        (facts / 'month=2023-01').mkdir()
+        (facts / 'month=2023-01' / 'facts.csv').write_text('order_id\n')
+        assert OrderFactsService.export(full=True)['months'] == ['2024-03']
+        assert not (facts / 'month=2023-01').exists()
+    
+    def test_csv_without_parquet_engine(self, monkeypatch, facts):
+        """Test facts fall back to CSV when no Parquet engine is installed"""
+        monkeypatch.setattr(order_facts_service, 'pyarrow', None)
+        monkeypatch.setattr(order_facts_service, 'fastparquet', None)
+        assert OrderFactsService.export()['format'] == 'csv'
+        assert (facts / 'month=2024-03' / 'facts.csv').exists()
+        assert AnalyticsService.get_category_performance(*self.RANGE)[0]['order_count'] == 5
+
+
 class TestReportService:
     """Tests for report generation"""
     
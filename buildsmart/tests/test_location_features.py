@@ -0,0 +1,237 @@
+"""
+Tests for location features.
+
+This module tests:
+- Geohash, bounding-box and vectorized distance helpers
+- Spatial prefiltering of shops
+- Nearby shops API
+- Distance-aware product search and keyset pagination
+"""
+import pytest
+import numpy as np
+from decimal import Decimal
+from app.models import Shop, Product
+from app.utils.geo import (
+    haversine_km, haversine_distances, coordinate_arrays, radius_mask,
+    nearest_k, bounding_box, encode_geohash, covering_geohashes
+)
+
+
+KAMPALA = (0.3476, 32.5825)
+
+
+@pytest.fixture
+def located_shops(db, test_user):
+    """Create verified shops at increasing distances from Kampala"""
+    coordinates = [
+        ('Central Hardware', 0.3480, 32.5830),   # ~0.1km
+        ('Ntinda Supplies', 0.3537, 32.6136),    # ~3.5km
+        ('Mukono Depot', 0.3533, 32.7553),       # ~19km
+        ('Jinja Builders', 0.4244, 33.2042),     # ~69km
+    ]
+    shops = []
+    for name, lat, lon in coordinates:
+        shop = Shop(
+            name=name,
+            address=f'{name} Road',
+            latitude=lat,
+            longitude=lon,
+            owner_id=test_user.id,
+            is_verified=True
+        )
+        db.session.add(shop)
+        shops.append(shop)
+    db.session.commit()
+    return shops
+
+
+@pytest.fixture
+def located_products(db, located_shops):
+    """Create two cement products in every located shop"""
+    products = []
+    for index, shop in enumerate(located_shops):
+        for variant in range(2):
+            product = Product(
+                name=f'Cement {shop.name} {variant}',
+                category='cement',
+                price=Decimal('30000.00') + index * 1000 + variant * 100,
+                unit='bags',
+                quantity_available=10,
+                shop_id=shop.id
+            )
+            db.session.add(product)
+            products.append(product)
+    db.session.commit()
+    return products
+
+
+class TestGeoUtils:
+    """Tests for geospatial helpers"""
+
+    def test_haversine_known_distance(self):
+        """Test Haversine against a known distance"""
+        # Kampala to Jinja is roughly 69km as the crow flies
+        distance = haversine_km(KAMPALA[0], KAMPALA[1], 0.4244, 33.2042)
+        assert 65 < distance < 73
+        assert haversine_km(*KAMPALA, *KAMPALA) == 0
+
+    def test_encode_geohash(self):
+        """Test geohash encoding against a reference value"""
+        assert encode_geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+        assert len(encode_geohash(*KAMPALA)) == 9
+
+    def test_haversine_distances_matches_scalar(self):
+        """Test vectorized distances match the scalar formula"""
+        lats = np.array([0.3480, 0.3537, 0.4244])
+        lons = np.array([32.5830, 32.6136, 33.2042])
+        distances = haversine_distances(KAMPALA[0], KAMPALA[1], lats, lons)
+        expected = [haversine_km(*KAMPALA, lat, lon) for lat, lon in zip(lats, lons)]
+        assert np.allclose(distances, expected)
+
+    def test_haversine_distance_matrix(self):
+        """Test broadcasting builds an origin x point distance matrix"""
+        origins = np.array([[0.0], [1.0]])
+        matrix = haversine_distances(origins, np.zeros((2, 1)), np.array([0.0, 1.0, 2.0]), np.zeros(3))
+        assert matrix.shape == (2, 3)
+        assert matrix[0, 0] == 0 and matrix[1, 1] == 0
+
+    def test_coordinate_arrays_missing_values(self):
+        """Test missing coordinates become NaN and never match a radius"""
+        lats, lons = coordinate_arrays([(0.0, 0.0), (None, 32.0)])
+        assert np.isnan(lats[1])
+        assert radius_mask(0.0, 0.0, lats, lons, 10).tolist() == [True, False]
+
+    def test_nearest_k(self):
+        """Test nearest-k selection with radius and ties"""
+        lats = np.array([0.0, 1.0, 0.5, np.nan, 0.5, 2.0])
+        lons = np.zeros(6)
+        indices, distances = nearest_k(0.0, 0.0, lats, lons, k=3)
+        assert indices.tolist() == [0, 2, 4]
+        assert list(distances) == sorted(distances)
+
+        indices, _ = nearest_k(0.0, 0.0, lats, lons, radius_km=120)
+        assert indices.tolist() == [0, 2, 4, 1]
+
+    def test_bounding_box_contains_radius(self):
+        """Test bounding box contains points at the radius edge"""
+        min_lat, max_lat, min_lon, max_lon = bounding_box(*KAMPALA, 10)
+        assert min_lat < KAMPALA[0] < max_lat
+        assert min_lon < KAMPALA[1] < max_lon
+        # A point 10km north lies inside the box
+        assert max_lat - KAMPALA[0] >= 10 / 111.3
+
+    def test_bounding_box_antimeridian(self):
+        """Test bounding box widens to the full globe across the antimeridian"""
+        _, _, min_lon, max_lon = bounding_box(0, 179.99, 50)
+        assert (min_lon, max_lon) == (-180.0, 180.0)
+
+    def test_covering_geohashes_contain_nearby_points(self):
+        """Test covering cells include geohashes of points inside the radius"""
+        cells = covering_geohashes(*KAMPALA, 5)
+        assert 0 < len(cells) <= 32
+        point_hash = encode_geohash(0.3537, 32.6136)
+        assert any(point_hash.startswith(cell) for cell in cells)
+
+
+class TestSpatialIndex:
+    """Tests for the shop geohash index"""
+
+    def test_geohash_set_on_insert_and_update(self, db, located_shops):
+        """Test geohash is kept in sync with coordinates"""
+        shop = located_shops[0]
+        assert shop.geohash == encode_geohash(shop.latitude, shop.longitude)
+
+        shop.latitude = 0.4244
+        shop.longitude = 33.2042
+        db.session.commit()
+        assert shop.geohash == encode_geohash(0.4244, 33.2042)
+
+    def test_within_radius_filter(self, db, located_shops):
+        """Test SQL prefilter keeps every shop inside the radius"""
+        candidates = Shop.query.filter(Shop.within_radius_filter(*KAMPALA, 10)).all()
+        names = {shop.name for shop in candidates}
+        assert {'Central Hardware', 'Ntinda Supplies'} <= names
+        assert 'Jinja Builders' not in names
+
+
+class TestNearbyShopsAPI:
+    """Tests for the nearby shops endpoint"""
+
+    def test_nearby_shops_sorted_by_distance(self, client, located_shops):
+        """Test nearby shops are filtered by radius and sorted"""
+        response = client.get(f'/api/shops/nearby?lat={KAMPALA[0]}&lon={KAMPALA[1]}&radius=25')
+        assert response.status_code == 200
+        data = response.get_json()
+        names = [shop['name'] for shop in data['shops']]
+        assert names == ['Central Hardware', 'Ntinda Supplies', 'Mukono Depot']
+        assert data['count'] == 3
+
+    def test_nearby_shops_limit(self, client, located_shops):
+        """Test limit returns only the k nearest shops"""
+        response = client.get(f'/api/shops/nearby?lat={KAMPALA[0]}&lon={KAMPALA[1]}&radius=100&limit=2')
+        data = response.get_json()
+        assert [shop['name'] for shop in data['shops']] == ['Central Hardware', 'Ntinda Supplies']
+
+    def test_nearby_shops_requires_coordinates(self, client):
+        """Test missing coordinates are rejected"""
+        response = client.get('/api/shops/nearby?lat=0.3476')
+        assert response.status_code == 400
+
+
+class TestProductSearchDistance:
+    """Tests for distance-aware product search"""
+
+    def test_max_distance_applied_before_pagination(self, client, located_products):
+        """Test totals count only products within max_distance"""
+        response = client.get(
+            f'/api/products/search?lat={KAMPALA[0]}&lon={KAMPALA[1]}&max_distance=25&per_page=2'
+        )
+        data = response.get_json()
+        assert data['total'] == 6
+        assert data['pages'] == 3
+        assert len(data['products']) == 2
+        assert all(p['distance_km'] <= 25 for p in data['products'])
+
+    def test_sort_by_distance_is_global(self, client, located_products):
+        """Test distance ordering spans pages"""
+        distances = []
+        for page in (1, 2, 3, 4):
+            response = client.get(
+                f'/api/products/search?lat={KAMPALA[0]}&lon={KAMPALA[1]}'
+                f'&sort_by=distance&per_page=2&page={page}'
+            )
+            distances.extend(p['distance_km'] for p in response.get_json()['products'])
+        assert len(distances) == 8
+        assert distances == sorted(distances)
+
+    def test_keyset_pagination_matches_offset(self, client, located_products):
+        """Test walking cursors returns the same rows as offset paging"""
+        base = f'/api/products/search?lat={KAMPALA[0]}&lon={KAMPALA[1]}&sort_by=distance&per_page=3'
+        offset_ids = []
+        for page in (1, 2, 3):
+            offset_ids.extend(p['id'] for p in client.get(f'{base}&page={page}').get_json()['products'])
+
+        data = client.get(base).get_json()
+        keyset_ids = [p['id'] for p in data['products']]
+        while data['next_cursor']:
+            data = client.get(f"{base}&cursor={data['next_cursor']}").get_json()
+            keyset_ids.extend(p['id'] for p in data['products'])
+
+        assert keyset_ids == offset_ids
+        assert len(keyset_ids) == 8
+
+    def test_keyset_pagination_price_desc(self, client, located_products):
+        """Test cursors follow descending sort keys"""
+        base = '/api/products/search?sort_by=price_desc&per_page=5'
+        data = client.get(base).get_json()
+        prices = [p['price'] for p in data['products']]
+        data = client.get(f"{base}&cursor={data['next_cursor']}").get_json()
+        prices.extend(p['price'] for p in data['products'])
+        assert prices == sorted(prices, reverse=True)
+        assert len(prices) == 8
+        assert data['next_cursor'] is None
+
+    def test_invalid_cursor(self, client, located_products):
+        """Test malformed cursors are rejected"""
+        response = client.get('/api/products/search?cursor=not-a-cursor')
+        assert response.status_code == 400
@@ -6,14 +6,31 @@ This module tests:
 - Query optimization
 - Response caching
 - Cache invalidation
+- Tag-based invalidation
+- Stampede protection
+- Two-tier (L1/L2) caching
+- Conditional GET (ETag / Last-Modified)
+- Per-user response caching
+- Paged query caching
+- Automatic invalidation on commit
+- Cache warm-up
+- Cache metrics
+- Cached value serialization
 """
+import enum
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime
+from decimal import Decimal
 import pytest
 from flask import current_app
 from app.services.cache_service import CacheService
 from app.utils.query_optimization import QueryOptimizer, paginate_query
 from app.utils.response_cache import cache_response, cache_public, cache_private
+from app.utils.cache_serializer import CacheCodec, UncacheableValueError, FLAG_TAGGED, FLAG_ZLIB, MAGIC
 from app.models import Product, Shop, Category
-from app.extensions import db
+from app.extensions import db, cache
 
 
 class TestCacheService:
@@ -192,6 +209,460 @@ class TestResponseCache:
         assert 'no-cache' in result.headers.get('Cache-Control', '')
 
 
+@pytest.fixture
+def paged_products(db, test_user):
+    """Two shops with a few products each"""
+    from decimal import Decimal
+    shops = []
+    for name in ('Alpha Hardware', 'Beta Builders'):
+        shop = Shop(name=name, address=f'{name} Road', latitude=-1.29, longitude=36.82, owner_id=test_user.id)
+        db.session.add(shop)
+        shops.append(shop)
+    db.session.flush()
+    for shop, count in zip(shops, (5, 3)):
+        for i in range(count):
+            db.session.add(Product(name=f'{shop.name} item {i}', category='cement', price=Decimal(1000 + i),
+                                   unit='bags', quantity_available=10, shop_id=shop.id))
+    db.session.commit()
+    yield shops
+    cache.clear()
+
+
+class TestPagedQueryCache:
+    """Tests for paginate_query caching ids and totals"""
+    
+    def test_key_includes_bound_parameters(self, client, paged_products):
+        """Test queries differing only in parameters do not share pages"""
+        from app.utils.query_optimization import query_cache_key
+        alpha, beta = paged_products
+        
+        assert query_cache_key(Product.query.filter_by(shop_id=alpha.id)) != \
+            query_cache_key(Product.query.filter_by(shop_id=beta.id))
+        assert query_cache_key(Product.query.filter_by(shop_id=alpha.id)) == \
+            query_cache_key(Product.query.filter_by(shop_id=alpha.id))
+        
+        first = paginate_query(Product.query.filter_by(shop_id=alpha.id).order_by(Product.id), per_page=2)
+        second = paginate_query(Product.query.filter_by(shop_id=beta.id).order_by(Product.id), per_page=2)
+        assert {p.shop_id for p in first.items} == {alpha.id}
+        assert {p.shop_id for p in second.items} == {beta.id}
+        assert (first.total, first.pages, second.total, second.pages) == (5, 3, 3, 2)
+    
+    def test_caches_ids_and_rehydrates(self, client, paged_products):
+        """Test only ids are cached and pages come back as live rows in order"""
+        alpha, _ = paged_products
+        query = Product.query.filter_by(shop_id=alpha.id).order_by(Product.price.desc())
+        first = paginate_query(query, page=2, per_page=2)
+        
+        from app.utils.query_optimization import query_cache_key
+        cached = CacheService.get(f"{query_cache_key(query, 'paginate')}:page:2:per_page:2")
+        assert cached['value'] == {'ids': [p.id for p in first.items], 'total': 5}
+        
+        db.session.expunge_all()
+        second = paginate_query(query, page=2, per_page=2)
+        assert [p.id for p in second.items] == [p.id for p in first.items]
+        assert [p.price for p in second.items] == sorted((p.price for p in second.items), reverse=True)
+        assert all(p in db.session for p in second.items)
+        assert second.has_next and second.has_prev and second.next_num == 3
+    
+    def test_serialized_pages(self, client, paged_products):
+        """Test a serializer caches dicts that are served without querying"""
+        alpha, _ = paged_products
+        query = Product.query.filter_by(shop_id=alpha.id).order_by(Product.id)
+        serialize = lambda p: {'id': p.id, 'name': p.name}
+        
+        first = paginate_query(query, per_page=10, serializer=serialize, serializer_key='names')
+        assert [item['name'] for item in first.items] == [f'Alpha Hardware item {i}' for i in range(5)]
+        # Another serializer of the same query has its own pages
+        ids = paginate_query(query, per_page=10, serializer=lambda p: p.id, serializer_key='ids')
+        assert ids.items == [item['id'] for item in first.items]
+        
+        Product.query.filter_by(shop_id=alpha.id).delete()
+        db.session.commit()
+        assert paginate_query(query, per_page=10, serializer=serialize, serializer_key='names').items == first.items
+        assert paginate_query(query, per_page=10).items == []
+    
+    def test_serializer_key_required_for_lambdas(self, client, paged_products):
+        """Test serializers without a unique name must be given a key"""
+        query = Product.query.order_by(Product.id)
+        with pytest.raises(ValueError):
+            paginate_query(query, serializer=lambda p: p.id)
+        assert paginate_query(query, serializer=_product_name).items
+
+
+def _product_name(product):
+    return product.name
+
+
+class TestAutomaticInvalidation:
+    """Tests for tag invalidation on commit"""
+    
+    def test_product_change_invalidates_on_commit(self, client, paged_products):
+        """Test changing a product drops entries tagged with it, its shop and category"""
+        alpha, beta = paged_products
+        product = Product.query.filter_by(shop_id=alpha.id).first()
+        tags = {
+            'product': CacheService.product_tag(product.id),
+            'shop': CacheService.shop_tag(alpha.id),
+            'category': CacheService.category_tag('cement'),
+            'other_shop': CacheService.shop_tag(beta.id),
+        }
+        for name, tag in tags.items():
+            CacheService.set(f'test:auto:{name}', name, timeout=60, tags=[tag])
+        
+        product.quantity_available -= 1
+        db.session.flush()
+        assert CacheService.get('test:auto:shop', tags=[tags['shop']]) == 'shop'
+        db.session.commit()
+        
+        for name in ('product', 'shop', 'category'):
+            assert CacheService.get(f'test:auto:{name}', tags=[tags[name]]) is None
+        assert CacheService.get('test:auto:other_shop', tags=[tags['other_shop']]) == 'other_shop'
+    
+    def test_moved_product_invalidates_both_shops(self, client, paged_products):
+        """Test the shop a product leaves is invalidated too"""
+        alpha, beta = paged_products
+        for shop in paged_products:
+            CacheService.set(f'test:auto:{shop.id}', shop.id, timeout=60, tags=[CacheService.shop_tag(shop.id)])
+        
+        product = Product.query.filter_by(shop_id=alpha.id).first()
+        product.shop_id = beta.id
+        db.session.commit()
+        
+        for shop in paged_products:
+            assert CacheService.get(f'test:auto:{shop.id}', tags=[CacheService.shop_tag(shop.id)]) is None
+    
+    def test_rollback_and_batching(self, client, paged_products, monkeypatch):
+        """Test rolled-back changes invalidate nothing and commits invalidate once"""
+        alpha, _ = paged_products
+        calls = []
+        original = CacheService.invalidate_tags
+        monkeypatch.setattr(CacheService, 'invalidate_tags',
+                            staticmethod(lambda *tags: (calls.append(set(tags)), original(*tags))))
+        
+        for product in Product.query.filter_by(shop_id=alpha.id):
+            product.price += 1
+        db.session.flush()
+        db.session.rollback()
+        assert calls == []
+        
+        for product in Product.query.filter_by(shop_id=alpha.id):
+            product.price += 1
+        db.session.commit()
+        # Price snapshots bump their own 'prices' tag separately
+        calls = [tags for tags in calls if tags != {'prices'}]
+        assert len(calls) == 1
+        assert {CacheService.shop_tag(alpha.id), CacheService.category_tag('cement')} <= calls[0]
+    
+    def test_order_invalidates_customer_pages(self, client, paged_products, test_user):
+        """Test a new order drops the customer's cached pages"""
+        from decimal import Decimal
+        from app.models import Order
+        alpha, _ = paged_products
+        user_tag = CacheService.user_tag(test_user.id)
+        CacheService.set('test:auto:dashboard', 'dashboard', timeout=60, tags=[user_tag])
+        
+        db.session.add(Order(order_number='ORD-AUTO-1', total_amount=Decimal('10.00'),
+                             customer_id=test_user.id, shop_id=alpha.id))
+        db.session.commit()
+        assert CacheService.get('test:auto:dashboard', tags=[user_tag]) is None
+
+
+class TestCacheWarmer:
+    """Tests for cache warm-up"""
+    
+    def test_warm_all(self, app, client, paged_products):
+        """Test every task runs, reports a timing and leaves its entries cached"""
+        from app.services.cache_warmer import CacheWarmer
+        from app.services.catalog_service import CatalogService
+        
+        results = CacheWarmer.warm(app)
+        assert [r['name'] for r in results] == list(CacheWarmer.TASKS)
+        assert all(r['ok'] and r['seconds'] >= 0 for r in results), results
+        assert CacheService.get(CatalogService.FEATURED_KEY, tags=[CacheService.PREFIX_SEARCH]) is not None
+        
+        response = client.get('/api/categories')
+        assert response.status_code == 200
+        assert client.get('/api/categories', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    
+    def test_failures_and_concurrency_limit(self, app, client, monkeypatch):
+        """Test failing tasks are reported and no more than max_workers run at once"""
+        from app.services.cache_warmer import CacheWarmer
+        lock = threading.Lock()
+        running, peak = [0], [0]
+        
+        def task():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        
+        def broken():
+            raise RuntimeError('backend down')
+        
+        tasks = {f'task{i}': task for i in range(6)}
+        tasks['broken'] = broken
+        monkeypatch.setattr(CacheWarmer, 'TASKS', tasks)
+        
+        results = {r['name']: r for r in CacheWarmer.warm(app, max_workers=2)}
+        assert peak[0] == 2
+        assert results['broken']['ok'] is False
+        assert results['broken']['error'] == 'backend down'
+        assert all(results[f'task{i}']['ok'] for i in range(6))
+        
+        with pytest.raises(ValueError):
+            CacheWarmer.warm(app, names=['missing'])
+    
+    def test_warm_on_first_request(self, monkeypatch):
+        """Test each serving process warms once and building the app alone does not"""
+        from flask import Flask
+        from app.services import cache_warmer
+        from app.services.cache_warmer import CacheWarmer
+        started = []
+        monkeypatch.setattr(CacheWarmer, 'warm_in_background', started.append)
+        
+        bare = Flask(__name__)
+        bare.add_url_rule('/ping', 'ping', lambda: 'pong')
+        CacheWarmer.warm_on_first_request(bare)
+        assert started == []
+        
+        client = bare.test_client()
+        client.get('/ping')
+        client.get('/ping')
+        assert len(started) == 1
+        
+        # A forked worker has a new process ID and warms itself
+        monkeypatch.setattr(cache_warmer.os, 'getpid', lambda: -1)
+        client.get('/ping')
+        assert started == [bare, bare]
+    
+    def test_featured_ids_cached(self, client, paged_products):
+        """Test the home page reads featured content through the cache"""
+        from app.services.catalog_service import CatalogService
+        
+        featured = CatalogService.get_featured()
+        assert [p.id for p in featured['products']] == CatalogService.get_featured_ids()['products']
+        assert len(featured['products']) == CatalogService.FEATURED_LIMITS['products']
+        
+        # Catalog changes bump the search tag the ids are cached under
+        db.session.delete(featured['products'][0])
+        db.session.commit()
+        assert featured['products'][0].id not in CatalogService.get_featured_ids()['products']
+    
+    def test_trending_endpoint(self, client, db):
+        """Test the trending searches endpoint responds"""
+        response = client.get('/api/search/trending')
+        assert response.status_code == 200
+        assert response.get_json() == {'trending': []}
+
+
+@pytest.fixture
+def cache_metrics(app, client):
+    """Fresh cache metrics for one test"""
+    metrics = CacheService.get_metrics()
+    metrics.reset()
+    yield metrics
+    metrics.reset()
+
+
+class TestCacheMetrics:
+    """Tests for cache metrics and the Prometheus endpoint"""
+    
+    def test_counts_per_prefix(self, client, cache_metrics):
+        """Test hits, misses, writes and sizes are counted per key prefix"""
+        CacheService.set('product:1', {'name': 'Cement'}, timeout=60)
+        CacheService.get('product:1')
+        CacheService.get('product:2')
+        CacheService.get_many(['shop:1', 'product:1'])
+        CacheService.delete('product:1')
+        
+        snapshot = cache_metrics.snapshot()
+        operations = snapshot['operations']
+        assert operations[('get', 'product', 'hit')] == 1
+        assert operations[('get', 'product', 'miss')] == 1
+        assert operations[('set', 'product', 'ok')] == 1
+        assert operations[('delete', 'product', 'ok')] == 1
+        assert operations[('get_many', 'shop', 'miss')] == 1
+        assert operations[('get_many', 'product', 'hit')] == 1
+        assert snapshot['latency'][('get', 'product')]['count'] == 2
+        assert snapshot['sizes']['product']['count'] == 1
+        assert snapshot['sizes']['product']['sum'] > 0
+    
+    def test_errors_counted(self, client, cache_metrics, monkeypatch):
+        """Test swallowed backend errors are counted"""
+        def broken(*args, **kwargs):
+            raise ConnectionError('cache down')
+        
+        monkeypatch.setattr(cache, 'get_many', broken)
+        assert CacheService.get('product:9') is None
+        assert cache_metrics.snapshot()['operations'][('get', 'product', 'error')] == 1
+    
+    def test_get_or_set_and_responses(self, app, client, cache_metrics):
+        """Test get_or_set outcomes and cached responses are counted"""
+        CacheService.get_or_set('report:1', lambda: 'value', timeout=60)
+        CacheService.get_or_set('report:1', lambda: 'value', timeout=60)
+        
+        @cache_public(timeout=60)
+        def listing():
+            return {'ok': True}
+        
+        for _ in range(2):
+            with app.test_request_context('/api/test/metrics'):
+                listing()
+        
+        operations = cache_metrics.snapshot()['operations']
+        assert operations[('get_or_set', 'report', 'miss')] == 1
+        assert operations[('get_or_set', 'report', 'hit')] == 1
+        assert operations[('compute', 'report', 'ok')] == 1
+        assert operations[('response', 'public', 'miss')] == 1
+        assert operations[('response', 'public', 'hit')] == 1
+    
+    def test_prometheus_text(self, client, cache_metrics):
+        """Test rendering in the Prometheus exposition format"""
+        CacheService.set('product:1', 'x', timeout=60)
+        CacheService.get('product:1')
+        text = cache_metrics.render(CacheService.get_stats())
+        
+        assert '# TYPE buildsmart_cache_operations_total counter' in text
+        assert 'buildsmart_cache_operations_total{operation="get",prefix="product",outcome="hit"} 1' in text
+        assert 'buildsmart_cache_operation_duration_seconds_bucket{operation="get",prefix="product",le="+Inf"} 1' in text
+        assert 'buildsmart_cache_value_size_bytes_count{prefix="product"} 1' in text
+        assert 'buildsmart_cache_tier_events_total{tier="l2",event="hits"}' in text
+    
+    def test_prefix_cardinality_capped(self):
+        """Test prefixes beyond the limit are counted as other"""
+        from app.utils.cache_metrics import CacheMetrics
+        metrics = CacheMetrics(max_prefixes=2)
+        for prefix in ('a', 'b', 'c', 'd'):
+            metrics.record('get', prefix, 'hit')
+        assert set(p for _, p, _ in metrics.snapshot()['operations']) == {'a', 'b', 'other'}
+    
+    def test_endpoint_access(self, app, client, db, cache_metrics):
+        """Test the metrics endpoint needs an admin or the scrape token"""
+        assert client.get('/admin/metrics').status_code == 403
+        
+        app.config['METRICS_TOKEN'] = 'scrape-secret'
+        try:
+            assert client.get('/admin/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+            response = client.get('/admin/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert b'buildsmart_cache_operations_total' in response.data
+
+
+# Cached by the serializer tests; defined at module level so they pickle
+@dataclass
+class _Point:
+    x: int
+    y: int
+
+
+class _Color(enum.Enum):
+    RED = 'red'
+
+
+class _Level(enum.IntEnum):
+    HIGH = 3
+
+
+class TestCacheSerializer:
+    """Tests for encoding cached values"""
+    
+    def test_round_trip_types(self):
+        """Test values JSON lacks come back with their type"""
+        codec = CacheCodec()
+        value = {
+            'price': Decimal('12.50'),
+            'at': datetime(2024, 5, 1, 12, 30),
+            'day': date(2024, 5, 1),
+            'raw': b'\x00\xff',
+            'ids': {1, 2},
+            'by_shop': {1: {'min': 3.5}, 2: None},
+            'names': ['a', 'b'],
+        }
+        payload, serializer = codec.encode(value)
+        assert serializer == 'json'
+        assert payload.startswith(MAGIC)
+        assert codec.decode(payload) == value
+        
+        payload, _ = codec.encode({'name': 'Cement', 'stock': 3})
+        assert codec.decode(payload) == {'name': 'Cement', 'stock': 3}
+    
+    def test_non_plain_values_fall_back_to_pickle(self):
+        """Test values that are not plain data are still cacheable"""
+        codec = CacheCodec()
+        payload, serializer = codec.encode(complex(1, 2))
+        assert serializer == 'pickle'
+        assert codec.decode(payload) == complex(1, 2)
+    
+    @pytest.mark.parametrize('use_orjson', [True, False])
+    def test_types_orjson_encodes_natively_keep_their_type(self, monkeypatch, use_orjson):
+        """Test UUIDs, enums and dataclasses round-trip the same with and without orjson"""
+        import uuid
+        from app.utils import cache_serializer
+        if not use_orjson:
+            monkeypatch.setattr(cache_serializer, 'orjson', None)
+        
+        codec = CacheCodec()
+        for value in (uuid.uuid4(), _Color.RED, _Level.HIGH, _Point(1, 2), {'point': _Point(3, 4)}):
+            payload, serializer = codec.encode(value)
+            assert serializer == 'pickle', value
+            decoded = codec.decode(payload)
+            assert decoded == value
+            assert type(decoded) is type(value)
+        
+        payload, serializer = codec.encode({'by_id': {1: 'a'}, 'n': 2})
+        assert serializer == 'json'
+        assert codec.decode(payload) == {'by_id': {1: 'a'}, 'n': 2}
+        assert not codec.encode({'n': 2})[0][4] & FLAG_TAGGED
+    
+    def test_large_values_compressed(self):
+        """Test payloads above the threshold are compressed"""
+        codec = CacheCodec(compress_threshold=100)
+        small, _ = codec.encode('x' * 10)
+        large, _ = codec.encode('x' * 1000)
+        assert not small[4] & FLAG_ZLIB
+        assert large[4] & FLAG_ZLIB
+        assert len(large) < 100
+        assert codec.decode(large) == 'x' * 1000
+    
+    def test_other_format_versions_are_misses(self):
+        """Test payloads written by another format version decode to None"""
+        codec = CacheCodec()
+        payload, _ = codec.encode([1, 2])
+        assert codec.decode(payload[:2] + bytes([99]) + payload[3:]) is None
+        # Values written to the backend directly pass through
+        assert codec.decode(7) == 7
+    
+    def test_orm_instances_rejected(self, client, test_user):
+        """Test ORM instances are only cached when explicitly allowed"""
+        with pytest.raises(UncacheableValueError):
+            CacheService.set('user:orm', test_user, timeout=60)
+        with pytest.raises(UncacheableValueError):
+            CacheService.set('user:orm', {'users': [test_user]}, timeout=60)
+        with pytest.raises(UncacheableValueError):
+            CacheService.get_or_set('user:orm', lambda: [test_user], timeout=60)
+        assert CacheService.get('user:orm') is None
+        
+        assert CacheService.set('user:orm', test_user, timeout=60, allow_orm=True)
+        cached = CacheService.get('user:orm')
+        assert isinstance(cached, type(test_user))
+        assert db.inspect(cached).detached
+    
+    def test_backend_stores_payloads(self, client):
+        """Test the backend holds encoded payloads, not the values themselves"""
+        CacheService.set('test:payload', {'price': Decimal('4.20')}, timeout=60)
+        assert cache.get('test:payload').startswith(MAGIC)
+        assert CacheService.get('test:payload') == {'price': Decimal('4.20')}
+    
+    def test_key_prefix_carries_cache_version(self, app):
+        """Test the cache version is part of every backend key"""
+        assert f"v{app.config['CACHE_VERSION']}:" in app.config['CACHE_KEY_PREFIX']
+
+
 class TestCacheIntegration:
     """Integration tests for caching features"""
     
@@ -236,3 +707,581 @@ class TestCacheIntegration:
         # Verify cache cleared (implementation may vary)
         assert True
 
+
+
+@pytest.fixture(params=['simple', 'filesystem'])
+def cache_backend(app, request, tmp_path):
+    """Run a test against each local cache backend"""
+    from flask_caching.backends import SimpleCache, FileSystemCache
+    original = app.extensions['cache'][cache]
+    if request.param == 'simple':
+        backend = SimpleCache(default_timeout=300)
+    else:
+        backend = FileSystemCache(str(tmp_path), default_timeout=300)
+    app.extensions['cache'][cache] = backend
+    yield backend
+    app.extensions['cache'][cache] = original
+
+
+class TestTagInvalidation:
+    """Tests for tag/generation based invalidation"""
+    
+    def test_invalidate_tag(self, client, cache_backend):
+        """Test invalidating a tag hides only the entries stored with it"""
+        CacheService.set('shop:1:products', ['a'], tags=['shop:1', 'category:4'])
+        CacheService.set('shop:2:products', ['b'], tags=['shop:2'])
+        assert CacheService.get('shop:1:products', tags=['category:4', 'shop:1']) == ['a']
+        
+        CacheService.invalidate_tags('category:4')
+        assert CacheService.get('shop:1:products', tags=['shop:1', 'category:4']) is None
+        assert CacheService.get('shop:2:products', tags=['shop:2']) == ['b']
+        
+        CacheService.invalidate_shop(2)
+        assert CacheService.get('shop:2:products', tags=['shop:2']) is None
+    
+    def test_generation_counter(self, client, cache_backend):
+        """Test each invalidation is a single counter increment"""
+        before = CacheService.get_tag_versions(['product:7'])[0]
+        CacheService.invalidate_product(7)
+        CacheService.invalidate_product(7)
+        assert CacheService.get_tag_versions(['product:7'])[0] == before + 2
+        
+        # Counters are stored without expiry
+        cache_backend.set('unrelated', 1)
+        assert CacheService.get_tag_versions(['product:7'])[0] == before + 2
+    
+    def test_evicted_counter_does_not_repeat(self, client, cache_backend):
+        """Test a re-created counter never reuses an old generation"""
+        CacheService.set('user:3:orders', [1], tags=['user:3'])
+        CacheService.delete(CacheService.tag_key('user:3'))
+        assert CacheService.get('user:3:orders', tags=['user:3']) is None
+    
+    def test_get_or_set_and_decorators(self, client, cache_backend):
+        """Test get_or_set and cached_query honour tags"""
+        from app.services.cache_service import cached_query
+        calls = []
+        
+        @cached_query(timeout=60, tags=lambda shop_id: [CacheService.shop_tag(shop_id)])
+        def shop_products(shop_id):
+            calls.append(shop_id)
+            return [shop_id]
+        
+        assert shop_products(5) == [5]
+        assert shop_products(5) == [5]
+        assert calls == [5]
+        CacheService.invalidate_shop(5)
+        assert shop_products(5) == [5]
+        assert calls == [5, 5]
+        
+        assert CacheService.get_or_set('search:q', lambda: 1, tags=['search']) == 1
+        CacheService.invalidate_search()
+        assert CacheService.get_or_set('search:q', lambda: 2, tags=['search']) == 2
+    
+    def test_untagged_entity_key_deleted(self, client, cache_backend):
+        """Test invalidate_product also drops the plain entity key"""
+        CacheService.set('product:9', {'name': 'Product'})
+        CacheService.invalidate_product(9)
+        assert CacheService.get('product:9') is None
+
+
+class TestStampedeProtection:
+    """Tests for single-flight, early expiration and stale serving in get_or_set"""
+    
+    def test_concurrent_misses_compute_once(self, app, client):
+        """Test concurrent misses for one key run the function once"""
+        calls = []
+        results = []
+        
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'value'
+        
+        def worker():
+            with app.app_context():
+                results.append(CacheService.get_or_set('test:stampede', slow, timeout=60))
+        
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert results == ['value'] * 8
+    
+    def test_waits_for_other_worker(self, app, client):
+        """Test a miss waits for the worker holding the refresh lock"""
+        key = 'test:other_worker'
+        cache.add(f'lock:{key}', 'other-worker', timeout=30)
+        calls = []
+        
+        def other_worker():
+            time.sleep(0.1)
+            with app.app_context():
+                CacheService.set(key, 'theirs', timeout=60)
+                cache.delete(f'lock:{key}')
+        
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        assert CacheService.get_or_set(key, lambda: calls.append(1) or 'ours', timeout=60) == 'theirs'
+        thread.join()
+        assert calls == []
+    
+    def test_other_keys_not_blocked(self, app, client):
+        """Test a slow computation holds only its own key's lock"""
+        from app.services.cache_service import _KEY_LOCKS
+        started, release = threading.Event(), threading.Event()
+        
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+        
+        def worker():
+            with app.app_context():
+                CacheService.get_or_set('test:slow_key', slow, timeout=60)
+        
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert started.wait(5)
+        try:
+            # Any other key, whatever it hashes to, is computed right away
+            for i in range(100):
+                assert CacheService.get_or_set(f'test:fast_key:{i}', lambda: 'fast', timeout=60) == 'fast'
+        finally:
+            release.set()
+            thread.join()
+        assert len(_KEY_LOCKS) == 0
+    
+    def test_polling_does_not_hold_local_lock(self, app, client, monkeypatch):
+        """Test threads waiting for another worker do not queue behind each other"""
+        from app.services import cache_service
+        monkeypatch.setattr(cache_service, 'REFRESH_WAIT', 0.3)
+        key = 'test:polled'
+        cache.add(f'lock:{key}', 'other-worker', timeout=30)
+        finished = []
+        
+        def worker():
+            with app.app_context():
+                CacheService.get_or_set(key, lambda: 'ours', timeout=60)
+                finished.append(time.time())
+        
+        started = time.time()
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # All gave up waiting together instead of one REFRESH_WAIT after another
+        assert max(finished) - started < 1.0
+    
+    def test_cache_none(self, client):
+        """Test None results are cached only when asked"""
+        calls = []
+        
+        def nothing():
+            calls.append(1)
+            return None
+        
+        CacheService.get_or_set('test:none', nothing, timeout=60)
+        CacheService.get_or_set('test:none', nothing, timeout=60)
+        assert len(calls) == 2
+        
+        assert CacheService.get_or_set('test:none_cached', nothing, timeout=60, cache_none=True) is None
+        assert CacheService.get_or_set('test:none_cached', nothing, timeout=60, cache_none=True) is None
+        assert len(calls) == 3
+    
+    def test_serves_stale_while_refreshing(self, client, monkeypatch):
+        """Test an expired entry is served while it is refreshed"""
+        CacheService.get_or_set('test:stale', lambda: 'old', timeout=1, stale_ttl=60)
+        
+        real_time = time.time
+        monkeypatch.setattr(time, 'time', lambda: real_time() + 5)
+        assert CacheService.get_or_set('test:stale', lambda: 'new', timeout=1, stale_ttl=60) == 'old'
+        assert CacheService.get_or_set('test:stale', lambda: 'newer', timeout=1, stale_ttl=60) == 'new'
+    
+    def test_expired_without_stale_window_recomputes(self, client, monkeypatch):
+        """Test an expired entry is recomputed when stale serving is off"""
+        CacheService.get_or_set('test:expired', lambda: 'old', timeout=1)
+        real_time = time.time
+        monkeypatch.setattr(time, 'time', lambda: real_time() + 5)
+        assert CacheService.get_or_set('test:expired', lambda: 'new', timeout=100) == 'new'
+    
+    def test_probabilistic_early_expiration(self, client):
+        """Test slow-to-compute entries are refreshed before they expire"""
+        entry = {'__cache_entry__': True, 'value': 'old', 'expires': time.time() + 10, 'delta': 1e6}
+        CacheService.set('test:early', entry, timeout=60)
+        assert CacheService.get_or_set('test:early', lambda: 'new', timeout=60, beta=0) == 'old'
+        assert CacheService.get_or_set('test:early', lambda: 'new', timeout=60) == 'new'
+    
+    def test_decorators_single_flight_and_none(self, client):
+        """Test cached_query and get_with_cache go through get_or_set"""
+        from app.services.cache_service import cached_query
+        calls = []
+        
+        @cached_query(timeout=60, cache_none=True)
+        def find_nothing(name):
+            calls.append(name)
+            return None
+        
+        assert find_nothing('x') is None
+        assert find_nothing('x') is None
+        assert calls == ['x']
+        
+        assert QueryOptimizer.get_with_cache('test:optimizer', lambda: [1], timeout=60) == [1]
+        assert QueryOptimizer.get_with_cache('test:optimizer', lambda: [2], timeout=60) == [1]
+
+
+@pytest.fixture
+def l1_cache(app, client):
+    """Enable the per-worker L1 cache for one test"""
+    from app.services import cache_service
+    from app.utils.local_cache import local_bus
+    
+    def reset():
+        tiers = app.extensions.pop(cache_service._TIERS_KEY, None)
+        if tiers is not None:
+            local_bus.unsubscribe(tiers.origin)
+    
+    reset()
+    app.config['CACHE_L1_ENABLED'] = True
+    cache.clear()
+    yield cache_service._tiers()
+    app.config['CACHE_L1_ENABLED'] = False
+    reset()
+    cache.clear()
+
+
+class TestTwoTierCache:
+    """Tests for the in-process L1 cache in front of the backend"""
+    
+    def test_l1_serves_hot_values(self, l1_cache):
+        """Test repeated reads are served from L1 with per-tier counters"""
+        CacheService.set('test:hot', {'v': 1}, timeout=60)
+        # Gone from the backend, still in this worker's L1
+        cache.delete('test:hot')
+        assert CacheService.get('test:hot') == {'v': 1}
+        
+        assert CacheService.get('test:cold') is None
+        cache.set('test:l2_only', 'x')
+        assert CacheService.get('test:l2_only') == 'x'
+        assert CacheService.get('test:l2_only') == 'x'
+        
+        stats = CacheService.get_stats()
+        assert stats['l1']['enabled'] is True
+        assert stats['l1']['hits'] == 2
+        assert stats['l1']['misses'] == 2
+        assert stats['l2'] == {'hits': 1, 'misses': 1}
+    
+    def test_returned_values_are_copies(self, l1_cache):
+        """Test mutating a returned value does not change the cached one"""
+        CacheService.set('test:list', [1, 2], timeout=60)
+        CacheService.get('test:list').append(3)
+        assert CacheService.get('test:list') == [1, 2]
+    
+    def test_writes_invalidate_other_workers(self, app, l1_cache):
+        """Test a write in one worker drops the key from other workers' L1"""
+        from app.services.cache_service import _CacheTiers
+        from app.utils.local_cache import local_bus
+        other = _CacheTiers(app)
+        try:
+            CacheService.set('test:shared', 'old', timeout=60)
+            assert other.get('test:shared') == 'old'
+            
+            CacheService.set('test:shared', 'new', timeout=60)
+            assert other.get('test:shared') == 'new'
+            
+            other.delete_many(['test:shared'])
+            assert CacheService.get('test:shared') is None
+            
+            # Tag counters are never kept in L1
+            CacheService.get_tag_versions(['shop:1'])
+            assert l1_cache.l1.get(CacheService.tag_key('shop:1')) is None
+        finally:
+            local_bus.unsubscribe(other.origin)
+    
+    def test_auto_needs_pubsub(self, app, l1_cache):
+        """Test 'auto' leaves L1 off on backends without pub/sub"""
+        from app.services.cache_service import _CacheTiers
+        app.config['CACHE_L1_ENABLED'] = 'auto'
+        assert _CacheTiers(app).l1 is None
+
+
+@pytest.fixture
+def filesystem_workers(tmp_path, monkeypatch):
+    """Create apps standing in for worker processes that share a filesystem cache"""
+    from flask import Flask
+    from app.services import cache_service
+    from app.utils.local_cache import LocalInvalidationBus
+    
+    def worker(l1_enabled):
+        app = Flask('worker')
+        app.config.update(CACHE_TYPE='FileSystemCache', CACHE_DIR=str(tmp_path), CACHE_KEY_PREFIX='test:',
+                          CACHE_DEFAULT_TIMEOUT=300, CACHE_L1_ENABLED=l1_enabled)
+        cache.init_app(app)
+        # Separate processes share no in-process bus
+        monkeypatch.setattr(cache_service, 'local_bus', LocalInvalidationBus())
+        with app.app_context():
+            cache_service._tiers()
+        return app
+    
+    return worker
+
+
+class TestTagsAcrossWorkers:
+    """Tests for tag invalidation between workers without Redis"""
+    
+    @pytest.mark.parametrize('l1_enabled', ['auto', True])
+    def test_invalidation_seen_by_other_worker(self, filesystem_workers, l1_enabled):
+        """Test a tag invalidated by one worker misses in the other at once"""
+        from app.services import cache_service
+        first, second = filesystem_workers(l1_enabled), filesystem_workers(l1_enabled)
+        
+        with first.app_context():
+            key = CacheService.tagged_key('test:tagged', ['shop:1'])
+            CacheService.set(key, 'old', timeout=60)
+        with second.app_context():
+            assert CacheService.get(CacheService.tagged_key('test:tagged', ['shop:1'])) == 'old'
+            assert (cache_service._tiers().l1 is not None) == (l1_enabled is True)
+        
+        with first.app_context():
+            CacheService.invalidate_tags('shop:1')
+        with second.app_context():
+            # No pub/sub between processes: nothing told this worker
+            assert CacheService.tagged_key('test:tagged', ['shop:1']) != key
+            assert CacheService.get(CacheService.tagged_key('test:tagged', ['shop:1'])) is None
+
+
+class TestLRUCache:
+    """Tests for the L1 LRU structure"""
+    
+    def test_byte_budget_evicts_least_recently_used(self):
+        from app.utils.local_cache import LRUCache
+        lru = LRUCache(max_bytes=100, max_item_bytes=60, default_ttl=60)
+        lru.set('a', b'x' * 40)
+        lru.set('b', b'x' * 40)
+        assert lru.get('a') is not None
+        lru.set('c', b'x' * 40)
+        assert lru.get('b') is None
+        assert lru.get('a') is not None
+        assert lru.stats()['bytes'] == 80
+        assert lru.stats()['evictions'] == 1
+        
+        assert lru.set('big', b'x' * 61) is False
+        assert lru.stats()['oversized'] == 1
+    
+    def test_ttl(self, monkeypatch):
+        from app.utils.local_cache import LRUCache
+        lru = LRUCache(max_bytes=100, max_item_bytes=100, default_ttl=30)
+        lru.set('short', b'1', ttl=5)
+        lru.set('capped', b'1', ttl=3600)
+        now = time.monotonic()
+        monkeypatch.setattr(time, 'monotonic', lambda: now + 10)
+        assert lru.get('short') is None
+        assert lru.get('capped') is not None
+        monkeypatch.setattr(time, 'monotonic', lambda: now + 31)
+        assert lru.get('capped') is None
+        assert lru.stats()['expirations'] == 2
+
+
+class TestConditionalGet:
+    """Tests for validators and 304 responses from cache_response"""
+    
+    def test_etag_and_not_modified(self, app, client):
+        """Test cached responses carry an ETag and matching requests get 304"""
+        from flask import jsonify
+        calls = []
+        
+        @cache_public(timeout=120)
+        def product_list():
+            calls.append(1)
+            return jsonify({'products': [1, 2, 3]})
+        
+        with app.test_request_context('/api/test/etag'):
+            first = product_list()
+        etag = first.headers['ETag']
+        assert first.status_code == 200
+        assert etag.startswith('"') and not etag.startswith('W/')
+        assert first.headers['Cache-Control'] == 'public, max-age=120'
+        assert first.headers['Last-Modified']
+        
+        with app.test_request_context('/api/test/etag', headers={'If-None-Match': etag}) as ctx:
+            second = product_list()
+            # Werkzeug drops the body of a 304 when it is sent
+            assert b''.join(second.get_app_iter(ctx.request.environ)) == b''
+        assert second.status_code == 304
+        assert second.headers['ETag'] == etag
+        
+        with app.test_request_context('/api/test/etag', headers={'If-None-Match': '"stale"'}):
+            third = product_list()
+        assert third.status_code == 200
+        assert third.get_json() == {'products': [1, 2, 3]}
+        
+        with app.test_request_context('/api/test/etag', headers={'If-Modified-Since': first.headers['Last-Modified']}):
+            assert product_list().status_code == 304
+        
+        # If-None-Match wins over a matching If-Modified-Since
+        with app.test_request_context('/api/test/etag', headers={
+            'If-None-Match': '"other"', 'If-Modified-Since': first.headers['Last-Modified']
+        }):
+            assert product_list().status_code == 200
+        assert calls == [1]
+    
+    def test_tagged_public_responses_revalidate(self, app, client, db):
+        """Test tagged public responses are not cached by clients for the server TTL"""
+        from flask import jsonify
+        
+        @cache_public(timeout=600, tags=['etag_tagged'])
+        def tagged_list():
+            return jsonify({'items': [1]})
+        
+        @cache_public(timeout=600, tags=['etag_tagged'], max_age=30)
+        def short_list():
+            return jsonify({'items': [2]})
+        
+        with app.test_request_context('/api/test/tagged'):
+            first = tagged_list()
+        assert first.headers['Cache-Control'] == 'public, no-cache'
+        with app.test_request_context('/api/test/tagged', headers={'If-None-Match': first.headers['ETag']}):
+            assert tagged_list().status_code == 304
+        with app.test_request_context('/api/test/short'):
+            assert short_list().headers['Cache-Control'] == 'public, max-age=30'
+        
+        response = client.get('/api/categories')
+        assert response.headers['Cache-Control'] == 'public, no-cache'
+    
+    def test_fresh_response_honours_validators(self, app, client):
+        """Test a client's ETag from another worker still gets a 304 after recomputing"""
+        from flask import jsonify
+        
+        @cache_response(timeout=60, key_prefix='etag_fresh')
+        def shop_list():
+            return jsonify({'shops': ['a']})
+        
+        with app.test_request_context('/api/test/fresh'):
+            etag = shop_list().headers['ETag']
+        CacheService.clear()
+        with app.test_request_context('/api/test/fresh', headers={'If-None-Match': etag}):
+            assert shop_list().status_code == 304
+    
+    def test_private_headers(self, app, client):
+        """Test private responses must be revalidated and vary by credentials"""
+        from flask import jsonify
+        
+        @cache_private(timeout=60)
+        def dashboard():
+            return jsonify({'orders': 2})
+        
+        with app.test_request_context('/api/test/private', headers={'Authorization': 'Bearer a'}):
+            response = dashboard()
+        assert response.headers['Cache-Control'] == 'private, no-cache'
+        assert {'Authorization', 'Cookie'} <= set(response.vary)
+    
+    def test_unsafe_methods_not_cached(self, app, client):
+        """Test non-GET requests bypass the cache"""
+        calls = []
+        
+        @cache_response(timeout=60, key_prefix='etag_post')
+        def create():
+            calls.append(1)
+            return {'ok': True}
+        
+        for _ in range(2):
+            with app.test_request_context('/api/test/post', method='POST'):
+                create()
+        assert calls == [1, 1]
+
+
+class _StubUser:
+    """Minimal Flask-Login user for response cache tests"""
+    
+    def __init__(self, user_id):
+        self.id = user_id
+        self.is_authenticated = True
+    
+    def get_id(self):
+        return str(self.id)
+
+
+class TestPerUserResponseCache:
+    """Tests for per-user keys, canonical query strings and stored bodies"""
+    
+    def test_entries_are_per_user(self, app, client, monkeypatch):
+        """Test each user gets their own entry, dropped by invalidate_user"""
+        from flask import jsonify
+        from app.utils import response_cache
+        calls = []
+        
+        @cache_private(timeout=60)
+        def dashboard():
+            calls.append(response_cache.current_user.id)
+            return jsonify({'user': response_cache.current_user.id})
+        
+        def fetch(user_id):
+            monkeypatch.setattr(response_cache, 'current_user', _StubUser(user_id))
+            with app.test_request_context('/api/test/user-dashboard'):
+                return dashboard().get_json()
+        
+        assert fetch(1) == {'user': 1}
+        assert fetch(2) == {'user': 2}
+        assert fetch(1) == {'user': 1}
+        assert calls == [1, 2]
+        
+        CacheService.invalidate_user(1)
+        assert fetch(1) == {'user': 1}
+        assert fetch(2) == {'user': 2}
+        assert calls == [1, 2, 1]
+    
+    def test_canonical_query_string(self, app, client):
+        """Test parameter order and cache busters do not split entries"""
+        from app.utils.response_cache import canonical_query_string
+        calls = []
+        
+        @cache_public(timeout=60)
+        def listing():
+            calls.append(1)
+            return {'ok': True}
+        
+        for url in ('/api/test/list?b=2&a=1&a=0', '/api/test/list?a=0&b=2&a=1&_=12345'):
+            with app.test_request_context(url):
+                listing()
+        assert calls == [1]
+        
+        with app.test_request_context('/api/test/list?a=1&b=2'):
+            listing()
+        assert calls == [1, 1]
+        
+        with app.test_request_context('/?z=1&y=&x=2&x=1'):
+            from flask import request
+            assert canonical_query_string(request.args) == 'x=1&x=2&z=1'
+    
+    def test_large_bodies(self, app, client):
+        """Test bodies are compressed when stored and skipped when too large"""
+        calls = []
+        
+        @cache_response(timeout=60, key_prefix='large', max_body_size=64 * 1024)
+        def report(size):
+            calls.append(size)
+            return {'rows': 'x' * size}
+        
+        for _ in range(2):
+            with app.test_request_context('/api/test/report-medium'):
+                body = report(8 * 1024).get_json()
+        assert body == {'rows': 'x' * 8 * 1024}
+        assert calls == [8 * 1024]
+        
+        for _ in range(2):
+            with app.test_request_context('/api/test/report-huge'):
+                report(128 * 1024)
+        assert calls == [8 * 1024, 128 * 1024, 128 * 1024]
+    
+    def test_endpoint_cached_per_user(self, app, auth_client):
+        """Test the dashboard endpoint is served per user and private"""
+        auth_client, _ = auth_client
+        first = auth_client.get('/api/user/dashboard')
+        if first.status_code != 200:
+            pytest.skip('dashboard not available in this configuration')
+        assert first.headers['Cache-Control'] == 'private, no-cache'
+        assert 'Cookie' in first.vary
+        second = auth_client.get('/api/user/dashboard', headers={'If-None-Match': first.headers['ETag']})
+        assert second.status_code == 304
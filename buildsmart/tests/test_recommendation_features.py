@@ -0,0 +1,371 @@
+"""
+Tests for recommendation features.
+
+This module tests:
+- Category price snapshots
+- Material cost estimation
+- Shopping plan optimization
+- Project description matching
+- Recommendation result caching
+"""
+import itertools
+import os
+import pytest
+import numpy as np
+from contextlib import contextmanager
+from decimal import Decimal
+from sqlalchemy import event
+from app.extensions import cache
+from app.models import Shop, Product, Recommendation
+from app.ai.cost_estimator import get_category_prices, cheapest_offers, shop_offers
+from app.ai.recommender import MaterialRecommender, ShopOptimizer, generate_full_recommendation
+from app.ai.shop_optimizer import ShoppingPlanOptimizer
+from app.ai.text_matcher import fit_text_model, get_text_model
+from app.services.recommendation_service import RecommendationService
+
+
+KAMPALA = (0.3476, 32.5825)
+
+
+@contextmanager
+def count_queries(db):
+    """Count SQL statements executed inside the block"""
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_execute)
+
+
+@pytest.fixture
+def priced_products(db, test_user):
+    """Create cement and sand offers in two verified shops and one unverified shop"""
+    cache.clear()
+    shops = []
+    for name, lat, lon, verified in [
+        ('Central Hardware', 0.3480, 32.5830, True),
+        ('Ntinda Supplies', 0.3537, 32.6136, True),
+        ('Unverified Depot', 0.3490, 32.5840, False),
+    ]:
+        shop = Shop(name=name, address=f'{name} Road', latitude=lat, longitude=lon,
+                    owner_id=test_user.id, is_verified=verified)
+        db.session.add(shop)
+        shops.append(shop)
+    db.session.flush()
+
+    offers = [
+        (0, 'cement', '32000'), (0, 'cement', '35000'), (0, 'sand', '90000'),
+        (1, 'cement', '30000'), (1, 'cement', '31000'),
+        (2, 'cement', '10000'),
+    ]
+    products = []
+    for shop_index, category, price in offers:
+        product = Product(name=f'{category.title()} {price}', category=category, price=Decimal(price),
+                          unit='bags', quantity_available=10, shop_id=shops[shop_index].id)
+        db.session.add(product)
+        products.append(product)
+    db.session.commit()
+    yield products
+    cache.clear()
+
+
+class TestPriceSnapshots:
+    """Tests for cached category price snapshots"""
+
+    def test_snapshot_ranks_offers(self, db, priced_products):
+        """Test snapshots hold the cheapest offers overall and per shop"""
+        snapshot = get_category_prices(['cement'])['cement']
+        assert [p['price'] for p in cheapest_offers(snapshot)] == [30000.0, 31000.0, 32000.0]
+        assert sorted(p['price'] for p in shop_offers(snapshot)) == [30000.0, 32000.0]
+        assert {shop['name'] for shop in snapshot['shops'].values()} == {'Central Hardware', 'Ntinda Supplies'}
+
+    def test_one_query_then_cached(self, db, priced_products):
+        """Test all categories load in one query and are then served from cache"""
+        with count_queries(db) as statements:
+            snapshots = get_category_prices(['cement', 'sand', 'timber'])
+        assert len(statements) == 1
+        assert snapshots['timber'] == {'products': [], 'shops': {}}
+
+        with count_queries(db) as statements:
+            get_category_prices(['cement', 'sand', 'timber'])
+        assert statements == []
+
+    def test_invalidated_on_product_change(self, db, priced_products):
+        """Test committed product changes drop the affected snapshots"""
+        get_category_prices(['cement', 'sand'])
+
+        priced_products[3].price = Decimal('20000')
+        db.session.commit()
+
+        with count_queries(db) as statements:
+            snapshots = get_category_prices(['cement', 'sand'])
+        assert len(statements) == 1
+        assert cheapest_offers(snapshots['cement'])[0]['price'] == 20000.0
+
+    def test_invalidated_on_recategorize_and_shop_change(self, db, priced_products):
+        """Test old and new categories and a shop's categories are invalidated"""
+        get_category_prices(['cement', 'sand'])
+        priced_products[2].category = 'cement'
+        db.session.commit()
+        assert get_category_prices(['cement', 'sand'])['sand']['products'] == []
+
+        shop = Shop.query.filter_by(name='Unverified Depot').one()
+        shop.is_verified = True
+        db.session.commit()
+        assert cheapest_offers(get_category_prices(['cement'])['cement'])[0]['price'] == 10000.0
+
+
+class TestRecommender:
+    """Tests for cost estimation and shop optimization"""
+
+    def test_estimate_cost(self, db, priced_products):
+        """Test unit prices average the cheapest verified offers"""
+        materials = {
+            'cement': {'quantity': 10, 'unit': 'bags', 'category': 'cement'},
+            'sand': {'quantity': 2, 'unit': 'tons', 'category': 'sand'},
+            'timber': {'quantity': 1, 'unit': 'cubic_meters', 'category': 'timber'},
+        }
+        estimate = MaterialRecommender().estimate_cost(materials)
+        assert estimate['breakdown']['cement']['unit_price'] == 31000.0
+        assert estimate['breakdown']['sand']['subtotal'] == 180000.0
+        assert 'timber' not in estimate['breakdown']
+        assert estimate['total'] == 490000.0
+
+    def test_cost_estimate_and_plan_share_one_query(self, db, priced_products):
+        """Test estimation and planning together cost a single query"""
+        materials = MaterialRecommender().recommend_materials('2 bedroom house')
+        with count_queries(db) as statements:
+            MaterialRecommender().estimate_cost(materials)
+            plan = ShopOptimizer().optimize_shopping_plan(materials, *KAMPALA)
+        assert len(statements) == 1
+
+        # Cement is cheaper at Ntinda; sand is only sold by Central Hardware
+        by_name = {entry['shop']['name']: entry for entry in plan}
+        assert set(by_name) == {'Central Hardware', 'Ntinda Supplies'}
+        assert [p['material'] for p in by_name['Ntinda Supplies']['products']] == ['cement']
+        assert by_name['Ntinda Supplies']['total_cost'] == 250 * 30000.0
+        assert [p['material'] for p in by_name['Central Hardware']['products']] == ['sand']
+
+    def test_plan_summary(self, db, priced_products):
+        """Test the plan reports totals and materials no shop sells"""
+        materials = {
+            'cement': {'quantity': 10, 'unit': 'bags', 'category': 'cement'},
+            'timber': {'quantity': 1, 'unit': 'cubic_meters', 'category': 'timber'},
+        }
+        plan = ShopOptimizer().build_plan(materials, *KAMPALA, max_shops=1)
+        assert [stop['shop']['name'] for stop in plan['stops']] == ['Ntinda Supplies']
+        assert plan['summary']['material_cost'] == 300000.0
+        assert plan['summary']['unavailable'] == ['timber']
+        assert plan['summary']['total_cost'] > plan['summary']['material_cost']
+
+
+def brute_force(problem_args, max_shops):
+    """Cheapest plan by enumerating every shop subset"""
+    requirements, offers, locations, origin = problem_args
+    optimizer = ShoppingPlanOptimizer(time_budget_ms=10000)
+    best = None
+    for size in range(1, max_shops + 1):
+        for subset in itertools.combinations(sorted(locations), size):
+            allowed = {c: [o for o in offs if o['shop_id'] in subset] for c, offs in offers.items()}
+            plan = optimizer.solve(requirements, allowed, locations, origin, max_shops=size)
+            if not plan['unavailable'] and (best is None or plan['total_cost'] < best):
+                best = plan['total_cost']
+    return best
+
+
+def random_problem(seed, n_shops, n_categories, coverage=0.5):
+    """Build a random catalog around Kampala"""
+    rng = np.random.default_rng(seed)
+    locations = {
+        shop_id: (KAMPALA[0] + rng.uniform(-0.2, 0.2), KAMPALA[1] + rng.uniform(-0.2, 0.2))
+        for shop_id in range(1, n_shops + 1)
+    }
+    categories = [f'category_{i}' for i in range(n_categories)]
+    offers = {category: [] for category in categories}
+    for shop_id in locations:
+        for category in categories:
+            if rng.random() < coverage:
+                offers[category].append({'shop_id': shop_id, 'price': float(rng.integers(1000, 5000))})
+    for category in categories:
+        if not offers[category]:
+            offers[category].append({'shop_id': 1, 'price': 5000.0})
+    requirements = [(category, category, float(rng.integers(1, 50))) for category in categories]
+    return requirements, offers, locations, KAMPALA
+
+
+class TestShoppingPlanOptimizer:
+    """Tests for the shopping plan engine"""
+
+    def test_assigns_each_material_to_cheapest_chosen_shop(self):
+        """Test materials are split across shops when that is cheaper"""
+        offers = {
+            'cement': [{'shop_id': 1, 'price': 100.0}, {'shop_id': 2, 'price': 80.0}],
+            'sand': [{'shop_id': 1, 'price': 50.0}, {'shop_id': 2, 'price': 90.0}],
+        }
+        locations = {1: (0.3480, 32.5830), 2: (0.3490, 32.5840)}
+        requirements = [('cement', 'cement', 100), ('sand', 'sand', 100)]
+
+        plan = ShoppingPlanOptimizer().solve(requirements, offers, locations, KAMPALA, max_shops=2)
+        assignment = {item['material']: stop['shop_id'] for stop in plan['stops'] for item in stop['items']}
+        assert assignment == {'cement': 2, 'sand': 1}
+        assert plan['material_cost'] == 13000.0
+
+        plan = ShoppingPlanOptimizer().solve(requirements, offers, locations, KAMPALA, max_shops=1)
+        assert [stop['shop_id'] for stop in plan['stops']] == [1]
+        assert plan['unavailable'] == []
+
+    def test_travel_cost_outweighs_small_savings(self):
+        """Test a distant shop is skipped when the saving does not cover the trip"""
+        offers = {'cement': [{'shop_id': 1, 'price': 100.0}, {'shop_id': 2, 'price': 99.0}]}
+        locations = {1: (0.3480, 32.5830), 2: (0.4244, 33.2042)}  # Kampala vs Jinja
+        plan = ShoppingPlanOptimizer().solve([('cement', 'cement', 10)], offers, locations, KAMPALA)
+        assert [stop['shop_id'] for stop in plan['stops']] == [1]
+
+    def test_matches_exhaustive_search(self):
+        """Test plans on small catalogs are as cheap as exhaustive search"""
+        for seed in range(5):
+            problem = random_problem(seed, n_shops=8, n_categories=5)
+            plan = ShoppingPlanOptimizer(time_budget_ms=1000).solve(*problem, max_shops=3)
+            assert not plan['unavailable']
+            assert plan['total_cost'] <= brute_force(problem, 3) * 1.01
+
+    def test_latency_budget(self):
+        """Test large catalogs stay within the latency budget"""
+        problem = random_problem(42, n_shops=2000, n_categories=12, coverage=0.3)
+        plan = ShoppingPlanOptimizer(time_budget_ms=100).solve(*problem, max_shops=5)
+        assert plan['elapsed_ms'] < 250
+        assert len(plan['stops']) <= 5
+        assert not plan['unavailable']
+
+
+@pytest.fixture
+def text_model(app, db, priced_products, tmp_path):
+    """Fit a text model on the priced products and configure it"""
+    priced_products[0].description = 'Portland cement 50kg bag for foundations and plastering'
+    priced_products[2].description = 'Washed river sand for concrete and mortar'
+    db.session.commit()
+    path = str(tmp_path / 'text_model')
+    fit_text_model(path)
+    app.config['TEXT_MODEL_PATH'] = path
+    yield path
+    app.config['TEXT_MODEL_PATH'] = None
+
+
+class TestTextModel:
+    """Tests for precomputed description matching"""
+
+    def test_matches_project_types(self, text_model):
+        """Test descriptions are matched to the closest project type"""
+        model = get_text_model()
+        assert model.match_project_types('a 3 bedroom family house with ensuite')[0][0] == '3_bedroom_house'
+        assert model.match_project_types('two bedroom bungalow')[0][0] == '2_bedroom_house'
+        assert model.match_project_types('office block with retail shops')[0][0] == 'commercial_building'
+
+    def test_matches_products(self, text_model, priced_products):
+        """Test product descriptions are ranked by similarity"""
+        matches = get_text_model().match_products('river sand for mortar', limit=2)
+        assert matches[0][0] == priced_products[2].id
+        assert get_text_model().match_products('zzz unknown words') == []
+
+    def test_loaded_once_and_reloaded_after_refit(self, text_model):
+        """Test workers reuse the loaded model until a new one is saved"""
+        model = get_text_model()
+        assert get_text_model() is model
+
+        stat = os.stat(os.path.join(text_model, 'vocabulary.json'))
+        fit_text_model(text_model)
+        os.utime(os.path.join(text_model, 'vocabulary.json'), (stat.st_atime, stat.st_mtime + 10))
+        assert get_text_model() is not model
+
+    def test_recommendation_infers_project_type(self, db, text_model, priced_products, test_user):
+        """Test the description picks the project type when none is given"""
+        recommendation = generate_full_recommendation(test_user.id, 'commercial office block', None)
+        assert recommendation['project_type'] == 'commercial_building'
+        assert recommendation['materials']['cement']['quantity'] == 600
+
+        recommendation = generate_full_recommendation(test_user.id, 'cement for foundations', '3_bedroom_house')
+        assert recommendation['project_type'] == '3_bedroom_house'
+        assert recommendation['matched_products'][0]['name'] == priced_products[0].name
+
+    def test_without_model(self, app, db, test_user):
+        """Test recommendations still work before a model is fitted"""
+        assert get_text_model() is None
+        recommendation = generate_full_recommendation(test_user.id, 'commercial office block', None)
+        assert recommendation['project_type'] == '2_bedroom_house'
+        assert recommendation['matched_products'] == []
+
+
+class TestRecommendationService:
+    """Tests for cached recommendations"""
+
+    def test_same_spec_served_from_cache(self, db, priced_products, test_user):
+        """Test repeated specs reuse the cached result and the recorded row"""
+        first = RecommendationService.get_recommendation(
+            test_user.id, 'my house', '2_bedroom_house', {'area_sq_meters': 80.0, 'colour': 'blue'}, *KAMPALA)
+        assert first['source'] == 'computed'
+
+        # Same normalized specs, a few hundred metres away
+        with count_queries(db) as statements:
+            second = RecommendationService.get_recommendation(
+                test_user.id, 'my house', '2_bedroom_house', {'area_sq_meters': 80}, 0.3491, 32.5802)
+        assert second['source'] == 'cache'
+        assert second['spec_hash'] == first['spec_hash']
+        assert second['shopping_plan'] == first['shopping_plan']
+        assert not any(statement.lstrip().upper().startswith(('INSERT', 'UPDATE')) for statement in statements)
+        # Nothing is recorded until the user saves
+        assert first['recommendation_id'] is None
+        assert Recommendation.query.filter_by(user_id=test_user.id).count() == 0
+
+        other = RecommendationService.get_recommendation(
+            test_user.id, 'my house', '2_bedroom_house', {'area_sq_meters': 120}, *KAMPALA)
+        assert other['source'] == 'computed'
+
+    def test_price_change_invalidates(self, db, priced_products, test_user):
+        """Test committed price changes make cached recommendations miss"""
+        first = RecommendationService.get_recommendation(test_user.id, 'house', '2_bedroom_house')
+        assert first['cost_estimate']['breakdown']['cement']['unit_price'] == 31000.0
+
+        priced_products[3].price = Decimal('20000')
+        db.session.commit()
+
+        second = RecommendationService.get_recommendation(test_user.id, 'house', '2_bedroom_house')
+        assert second['source'] == 'computed'
+        assert second['cost_estimate']['breakdown']['cement']['unit_price'] == 27666.67
+
+    def test_saved_recommendation_served(self, db, priced_products, test_user):
+        """Test a recommendation the user saved is served as saved"""
+        first = RecommendationService.get_recommendation(test_user.id, 'house', '3_bedroom_house')
+        record = RecommendationService.save_recommendation(test_user.id, 'house', first)
+        assert record.is_saved and record.spec_hash == first['spec_hash']
+        assert float(record.total_estimated_cost) == first['cost_estimate']['total']
+
+        priced_products[3].price = Decimal('20000')
+        db.session.commit()
+
+        saved = RecommendationService.get_recommendation(test_user.id, 'another house', '3_bedroom_house')
+        assert saved['source'] == 'saved'
+        assert saved['is_saved'] is True
+        assert saved['cost_estimate'] == first['cost_estimate']
+        assert saved['recommendation_id'] == record.id
+    
+    def test_save_endpoint(self, db, client, priced_products, test_user):
+        """Test saving a generated recommendation creates one saved row per spec"""
+        # Log in through the session; /auth/login is rate limited across the test run
+        with client.session_transaction() as session:
+            session['_user_id'] = str(test_user.id)
+            session['_fresh'] = True
+        generated = client.post('/api/recommend', json={
+            'project_description': 'house', 'project_type': '2_bedroom_house'
+        }).get_json()
+        payload = {'project_description': 'house', 'recommendation_data': generated}
+        
+        response = client.post('/api/user/recommendations', json=payload)
+        assert response.status_code == 201
+        assert response.get_json()['recommendation']['is_saved'] is True
+        client.post('/api/user/recommendations', json=payload)
+        assert Recommendation.query.filter_by(user_id=test_user.id, is_saved=True).count() == 1
@@ -0,0 +1,299 @@
+"""
+Tests for search features.
+
+This module tests:
+- Full-text index maintenance
+- Relevance-ranked product, shop and service search
+- In-memory search suggestion index
+- Buffered search analytics
+- Search API endpoints
+"""
+import pytest
+from decimal import Decimal
+from sqlalchemy.dialects import postgresql
+from app.models import Shop, Product, TrendingSearch, SearchHistory
+from app.services.search_service import SearchService
+from app.services.suggestion_service import SuggestionIndex, SuggestionService, apply_operation
+from app.services.search_analytics_service import SearchAnalyticsService, SearchEventBuffer
+
+
+@pytest.fixture
+def search_shop(db, test_user):
+    """Create a shop to hold searchable products"""
+    shop = Shop(
+        name='Kampala Cement Centre',
+        description='Cement, sand and aggregate supplier',
+        address='Industrial Area, Kampala',
+        latitude=0.3136,
+        longitude=32.6010,
+        owner_id=test_user.id,
+        is_verified=True
+    )
+    db.session.add(shop)
+    db.session.commit()
+    return shop
+
+
+@pytest.fixture
+def search_products(db, search_shop):
+    """Create products with different text matches"""
+    products = [
+        Product(name='Portland Cement 50kg', description='General purpose cement',
+                category='cement', price=Decimal('35000.00'), unit='bags', shop_id=search_shop.id),
+        Product(name='Tile Adhesive', description='Cement based adhesive for tiles',
+                category='finishing', price=Decimal('28000.00'), unit='bags', shop_id=search_shop.id),
+        Product(name='Steel Bars 12mm', description='High-tensile reinforcement',
+                category='steel', price=Decimal('4500.00'), unit='kg', shop_id=search_shop.id),
+    ]
+    db.session.add_all(products)
+    db.session.commit()
+    return products
+
+
+class TestSearchIndex:
+    """Tests for the full-text index"""
+
+    def test_sqlite_backend_active(self, db):
+        """Test the FTS5 backend is used for SQLite databases"""
+        assert SearchService.backend_name() == 'sqlite'
+
+    def test_tokenize_strips_operators(self):
+        """Test query operators cannot reach the FTS engine"""
+        assert SearchService.tokenize('cement "OR" NEAR(*') == ['cement', 'or', 'near']
+
+    def test_ranks_name_matches_first(self, db, search_products):
+        """Test title matches rank above description-only matches"""
+        query, relevance = SearchService.apply_text_search(Product.query, Product, 'cement')
+        names = [p.name for p in query.order_by(relevance.desc()).all()]
+        assert names == ['Portland Cement 50kg', 'Tile Adhesive']
+
+    def test_prefix_and_stemming(self, db, search_products):
+        """Test partial words and plural forms match"""
+        query, _ = SearchService.apply_text_search(Product.query, Product, 'reinforc')
+        assert [p.name for p in query.all()] == ['Steel Bars 12mm']
+
+        query, _ = SearchService.apply_text_search(Product.query, Product, 'tiles adhesives')
+        assert [p.name for p in query.all()] == ['Tile Adhesive']
+
+    def test_index_follows_updates_and_deletes(self, db, search_products):
+        """Test the index is kept in sync with model changes"""
+        steel = search_products[2]
+        steel.name = 'Rebar 12mm'
+        db.session.commit()
+
+        query, _ = SearchService.apply_text_search(Product.query, Product, 'rebar')
+        assert [p.id for p in query.all()] == [steel.id]
+
+        db.session.delete(steel)
+        db.session.commit()
+        query, _ = SearchService.apply_text_search(Product.query, Product, 'rebar')
+        assert query.all() == []
+
+    def test_rebuild_index(self, db, search_products):
+        """Test rebuilding repopulates every index"""
+        counts = SearchService.rebuild_index()
+        assert counts['products_fts'] == 3
+        assert counts['shops_fts'] == 1
+
+    def test_postgres_query_uses_index_expression(self, app):
+        """Test the PostgreSQL query matches the GIN index expression"""
+        query, relevance = SearchService._postgres_search(Product.query, Product, ['cement'])
+        sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+        assert "to_tsvector('english'::regconfig, (coalesce(products.name, '') || ' ')" in sql
+        assert '@@ to_tsquery' in sql
+        assert 'ts_rank' in str(relevance.compile(dialect=postgresql.dialect()))
+
+
+class TestSuggestionIndex:
+    """Tests for the in-memory suggestion index"""
+
+    def test_word_prefix_completion(self):
+        """Test any word of an entry can be completed"""
+        index = SuggestionIndex()
+        index.put('products', 1, 'Portland Cement 50kg', 1)
+        index.put('products', 2, 'Cement Mixer', 3)
+        index.put('products', 3, 'Ceramic Tiles', 2)
+
+        assert [key for key, _, _ in index.top('products', 'cem', 10)] == [2, 1]
+        assert [key for key, _, _ in index.top('products', 'ce', 10)] == [2, 3, 1]
+        assert [key for key, _, _ in index.top('products', 'cement port', 10)] == [1]
+        assert index.top('shops', 'cem', 10) == []
+
+    def test_updates_invalidate_cached_results(self):
+        """Test reweighting and removal are reflected immediately"""
+        index = SuggestionIndex()
+        index.put('products', 1, 'Cement A', 1)
+        index.put('products', 2, 'Cement B', 2)
+        assert index.top('products', 'cem', 1)[0][0] == 2
+
+        index.put('products', 1, 'Cement A', 5)
+        assert index.top('products', 'cem', 1)[0][0] == 1
+
+        index.remove('products', 1)
+        index.remove('products', 2)
+        assert index.top('products', 'c', 10) == []
+        assert len(index) == 0
+
+    def test_multi_term_beyond_cache(self):
+        """Test multi-term queries find entries outside the cached top results"""
+        index = SuggestionIndex()
+        for i in range(SuggestionIndex.CACHE_SIZE + 5):
+            index.put('products', i, f'Cement grade {i}', 100 - i)
+        index.put('products', 'rare', 'Cement special', 0)
+        assert [key for key, _, _ in index.top('products', 'cement spec', 5)] == ['rare']
+
+    def test_trending_counts_weight_names(self):
+        """Test names matching popular queries rank first"""
+        index = SuggestionIndex()
+        apply_operation(index, ['catalog', 'products', 1, 'Cement Bag'])
+        apply_operation(index, ['catalog', 'products', 2, 'Cement Mixer'])
+        apply_operation(index, ['trending', 'products', 'cement mixer', 7])
+
+        assert index.top('products', 'cem', 1)[0][0] == 2
+        assert index.top('trending:products', 'mix', 5) == [('cement mixer', 'cement mixer', 7.0)]
+
+        apply_operation(index, ['untrending', 'products', 'cement mixer'])
+        assert index.top('products', 'cem', 1)[0][0] == 1
+
+
+class TestSuggestionService:
+    """Tests for suggestion index maintenance"""
+
+    def test_follows_committed_changes(self, db, search_products):
+        """Test committed catalog changes reach the index without a rebuild"""
+        assert SuggestionService.suggest('steel')['suggestions'][0]['text'] == 'Steel Bars 12mm'
+
+        steel = search_products[2]
+        steel.name = 'Rebar 12mm'
+        db.session.commit()
+        assert SuggestionService.suggest('steel')['suggestions'] == []
+        assert SuggestionService.suggest('reb')['suggestions'][0]['id'] == steel.id
+
+        steel.is_available = False
+        db.session.commit()
+        assert SuggestionService.suggest('reb')['suggestions'] == []
+
+    def test_ignores_rolled_back_changes(self, db, search_products):
+        """Test uncommitted changes never reach the index"""
+        SuggestionService.suggest('steel')
+        search_products[2].name = 'Rebar 12mm'
+        db.session.flush()
+        db.session.rollback()
+        assert SuggestionService.suggest('reb')['suggestions'] == []
+
+    def test_snapshot_shared_between_workers(self, app, db, search_products, tmp_path):
+        """Test workers share the index through the snapshot and journal"""
+        app.config['SUGGESTION_SNAPSHOT_PATH'] = str(tmp_path / 'suggestions.jsonl')
+        app.config['SUGGESTION_SYNC_INTERVAL'] = 0
+        try:
+            assert SuggestionService.rebuild() == 4
+            assert (tmp_path / 'suggestions.jsonl').exists()
+
+            # A change committed by a worker without a loaded index is journaled
+            app.extensions.pop('suggestion_index')
+            db.session.add(TrendingSearch(query='steel bars 12mm', search_type='products', count=3))
+            db.session.commit()
+
+            # and seen by a worker starting from the snapshot
+            result = SuggestionService.suggest('stee')
+            assert result['suggestions'][0]['text'] == 'Steel Bars 12mm'
+            assert result['trending'] == [{'text': 'steel bars 12mm', 'count': 3}]
+        finally:
+            app.config['SUGGESTION_SNAPSHOT_PATH'] = None
+
+
+@pytest.fixture
+def analytics(app):
+    """Provide an empty search analytics buffer"""
+    app.extensions.pop('search_analytics', None)
+    yield SearchAnalyticsService
+    app.extensions.pop('search_analytics', None)
+
+
+class TestSearchAnalytics:
+    """Tests for buffered search analytics"""
+
+    def test_events_written_in_bulk_on_flush(self, db, test_user, analytics):
+        """Test events are buffered and aggregated into one upsert per query"""
+        db.session.add(TrendingSearch(query='cement', search_type='products', count=5))
+        db.session.commit()
+
+        analytics.record_search('Cement', user_id=test_user.id, results_count=3)
+        analytics.record_search('cement ', results_count=3)
+        analytics.record_search('sand', user_id=test_user.id, results_count=0)
+        assert db.session.query(SearchHistory).count() == 0
+
+        assert analytics.flush() == 3
+        db.session.expire_all()
+        counts = dict(db.session.query(TrendingSearch.query, TrendingSearch.count).all())
+        assert counts == {'cement': 7, 'sand': 1}
+        assert db.session.query(SearchHistory).filter_by(user_id=test_user.id).count() == 2
+
+        stats = analytics.get_stats()
+        assert (stats['recorded'], stats['flushed'], stats['batches'], stats['pending']) == (3, 3, 1, 0)
+
+    def test_full_buffer_drops_events(self, app, db):
+        """Test a full buffer drops and counts events instead of blocking"""
+        buffer = SearchEventBuffer(app, max_size=2, batch_size=10, flush_interval=60, run_worker=False)
+        results = [buffer.record({'query': f'q{i}'}) for i in range(5)]
+        assert results == [True, True, False, False, False]
+        assert buffer.stats()['dropped'] == 3
+        assert buffer.stats()['pending'] == 2
+
+    def test_failed_batch_is_counted(self, db, analytics):
+        """Test a failing batch is rolled back and counted"""
+        analytics.get_buffer().record({'query': None})
+        assert analytics.flush() == 0
+        assert analytics.get_stats()['failed'] == 1
+
+    def test_trending_counts_reach_suggestions(self, db, analytics):
+        """Test flushed counts update the suggestion index"""
+        SuggestionService.suggest('cem')
+        analytics.record_search('cement mixer')
+        analytics.record_search('cement mixer')
+        analytics.flush()
+        assert SuggestionService.suggest('cem')['trending'] == [{'text': 'cement mixer', 'count': 2}]
+
+    def test_search_request_does_not_write(self, client, db, search_products, analytics):
+        """Test product search only buffers its analytics"""
+        client.get('/api/products/search?q=cement')
+        assert db.session.query(TrendingSearch).count() == 0
+        assert analytics.get_stats()['pending'] == 1
+
+        analytics.flush()
+        assert db.session.query(TrendingSearch.count).scalar() == 1
+
+
+class TestSearchAPI:
+    """Tests for search endpoints"""
+
+    def test_product_search_relevance(self, client, search_products):
+        """Test product search orders by relevance by default"""
+        data = client.get('/api/products/search?q=cement').get_json()
+        assert [p['name'] for p in data['products']] == ['Portland Cement 50kg', 'Tile Adhesive']
+        assert data['total'] == 2
+
+    def test_product_search_relevance_keyset(self, client, search_products):
+        """Test cursors work with relevance ordering"""
+        data = client.get('/api/products/search?q=cement&per_page=1').get_json()
+        assert data['products'][0]['name'] == 'Portland Cement 50kg'
+        data = client.get(f"/api/products/search?q=cement&per_page=1&cursor={data['next_cursor']}").get_json()
+        assert [p['name'] for p in data['products']] == ['Tile Adhesive']
+        assert data['next_cursor'] is None
+
+    def test_shop_search(self, client, search_products):
+        """Test shop search uses the index"""
+        data = client.get('/api/shops/search?q=aggregate').get_json()
+        assert [s['name'] for s in data['shops']] == ['Kampala Cement Centre']
+
+    def test_search_suggestions(self, client, db, search_products):
+        """Test suggestions and trending queries come from the index"""
+        db.session.add(TrendingSearch(query='portland cement', search_type='products', count=4))
+        db.session.commit()
+
+        data = client.get('/api/search/suggestions?q=portl').get_json()
+        assert [s['text'] for s in data['suggestions']] == ['Portland Cement 50kg']
+        assert data['trending'] == [{'text': 'portland cement', 'count': 4}]
+
+        data = client.get('/api/search/suggestions?q=kamp&type=shops').get_json()
+        assert data['suggestions'][0]['type'] == 'shop'